@@ -0,0 +1,134 @@
+# dispatcher.py — параллельная обработка апдейтов с порядком внутри одного пользователя
+import asyncio, time
+from collections import deque
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_key(update: object) -> Optional[int]:
+    """Ключ сериализации: user_id, иначе chat_id. None — апдейт без владельца (идёт сразу)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class _Slot:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных пользователей обрабатываются параллельно (не больше `parallelism` сразу),
+    апдейты одного пользователя — строго по очереди, в порядке поступления.
+
+    Базовый семафор PTB ограничивает общее число ожидающих апдейтов (`max_pending`),
+    а слот воркера берётся только после пользовательского лока — иначе один пользователь,
+    насыпавший десяток нажатий, занял бы все слоты своим ожиданием.
+    """
+
+    def __init__(self, parallelism: int = 8, max_pending: int = 1024, window: int = 512,
+                 around: Optional[Callable[[object], ContextManager]] = None):
+        super().__init__(max(parallelism, max_pending))
+        self.parallelism = parallelism
+        self.around = around  # контекст вокруг обработки апдейта (например, корневой span трассировки)
+        self._workers = asyncio.BoundedSemaphore(parallelism)
+        self._slots: Dict[int, _Slot] = {}
+        self._waits: deque = deque(maxlen=window)
+        self.in_flight = 0
+        self.waiting = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_key(update)
+        t0 = time.monotonic()
+        self.waiting += 1
+        slot = None
+        if key is not None:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+            slot.depth += 1
+        started = locked = False
+        try:
+            if slot is not None:
+                await slot.lock.acquire()
+                locked = True
+            try:
+                async with self._workers:
+                    started = True
+                    self.waiting -= 1
+                    self._record_wait(time.monotonic() - t0)
+                    self.in_flight += 1
+                    try:
+                        if self.around is None:
+                            await coroutine
+                        else:
+                            with self.around(update):
+                                await coroutine
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+            finally:
+                if locked:
+                    slot.lock.release()
+        finally:
+            if not started:
+                self.waiting -= 1  # отменили, пока ждали очереди
+            if slot is not None:
+                slot.depth -= 1
+                if slot.depth == 0 and self._slots.get(key) is slot:
+                    del self._slots[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    # ---- метрики ----
+    def _record_wait(self, dt: float) -> None:
+        self._waits.append(dt)
+        self.wait_total += dt
+        if dt > self.wait_max:
+            self.wait_max = dt
+
+    def queue_depth(self, key: int) -> int:
+        """Сколько апдейтов пользователя сейчас в работе + в очереди."""
+        slot = self._slots.get(key)
+        return slot.depth if slot else 0
+
+    def busiest(self, n: int = 5) -> list[tuple[int, int]]:
+        return sorted(((k, s.depth) for k, s in list(self._slots.items())), key=lambda x: x[1], reverse=True)[:n]
+
+    def stats(self) -> Dict[str, Any]:
+        # может вызываться из потока Flask: list() снимает копию атомарно под GIL
+        waits = sorted(list(self._waits))
+        slots = list(self._slots.values())
+
+        def pct(p: float) -> float:
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "parallelism": self.parallelism,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "users_queued": len(slots),
+            "max_user_depth": max((s.depth for s in slots), default=0),
+            "processed": self.processed,
+            "wait_avg": (self.wait_total / self.processed) if self.processed else 0.0,
+            "wait_p50": pct(0.50),
+            "wait_p95": pct(0.95),
+            "wait_max": self.wait_max,
+        }
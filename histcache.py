@@ -0,0 +1,75 @@
+# histcache.py — кэш представления истории пользователя и отрендеренных записей
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class HistoryView:
+    __slots__ = ("entries", "by_ts", "built_at")
+
+    def __init__(self, entries: List[Dict[str, Any]]):
+        self.entries = entries
+        self.by_ts: Dict[int, Dict[str, Any]] = {int(e["ts"]): e for e in entries}
+        self.built_at = time.monotonic()
+
+
+class HistoryCache:
+    """
+    views    — LRU uid -> HistoryView (уже слитые локальные и удалённые записи + индекс по ts);
+               сбрасывается save_history через invalidate(uid), удалённую часть (Sheets) держим ttl секунд.
+               Представление читается в потоке: begin(uid) перед чтением, put(uid, entries, mark) —
+               если между ними был invalidate, прочитанное уже устарело и в кэш не идёт.
+    rendered — LRU (uid, ts) -> готовый HTML записи: текст записи по ts не меняется,
+               поэтому инвалидировать его не нужно, только вытеснять.
+    Используется только из event loop.
+    """
+
+    def __init__(self, max_users: int = 2000, max_rendered: int = 512, ttl: Optional[float] = None):
+        self.max_users = max_users
+        self.max_rendered = max_rendered
+        self.ttl = ttl
+        self._views: "OrderedDict[int, HistoryView]" = OrderedDict()
+        self._rendered: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._loading: Dict[int, object] = {}  # uid -> метка незавершённого чтения
+
+    def view(self, uid: int) -> Optional[HistoryView]:
+        v = self._views.get(uid)
+        if v is None:
+            return None
+        if self.ttl is not None and time.monotonic() - v.built_at > self.ttl:
+            del self._views[uid]
+            return None
+        self._views.move_to_end(uid)
+        return v
+
+    def begin(self, uid: int) -> object:
+        mark = self._loading[uid] = object()
+        return mark
+
+    def put(self, uid: int, entries: List[Dict[str, Any]], mark: Optional[object] = None) -> HistoryView:
+        v = HistoryView(entries)
+        if mark is not None:
+            if self._loading.get(uid) is not mark:  # invalidate (или более новое чтение) после begin
+                return v
+            del self._loading[uid]
+        self._views[uid] = v
+        self._views.move_to_end(uid)
+        while len(self._views) > self.max_users:
+            self._views.popitem(last=False)
+        return v
+
+    def invalidate(self, uid: int) -> None:
+        self._views.pop(uid, None)
+        self._loading.pop(uid, None)
+
+    def rendered(self, uid: int, ts: int) -> Optional[str]:
+        html = self._rendered.get((uid, ts))
+        if html is not None:
+            self._rendered.move_to_end((uid, ts))
+        return html
+
+    def put_rendered(self, uid: int, ts: int, html: str) -> None:
+        self._rendered[(uid, ts)] = html
+        self._rendered.move_to_end((uid, ts))
+        while len(self._rendered) > self.max_rendered:
+            self._rendered.popitem(last=False)
@@ -0,0 +1,208 @@
+# histstore.py — упакованный архив истории: один append-only файл на пользователя + индекс смещений
+import io, os, zlib, struct, shutil, logging, threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger("beauty-nano-bot.histstore")
+
+# запись: заголовок | миниатюра JPEG | текст zlib
+_HDR = struct.Struct("<4sqII")  # magic, ts, img_len, txt_len
+_MAGIC = b"HST1"
+
+Loc = Tuple[int, int, int]  # offset, img_len, txt_len
+
+
+def make_thumbnail(jpeg_bytes: bytes, max_side: int, quality: int = 80) -> bytes:
+    from PIL import Image
+    im = Image.open(io.BytesIO(jpeg_bytes)).convert("RGB")
+    im.thumbnail((max_side, max_side))
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+class HistoryStore:
+    """
+    DATA_DIR/history/<uid>.pack — записи только дописываются; какие из них живые, решает индекс
+    HISTORY (history.json) — сюда приходит retain(uid, ts_живых) после его обрезки до HISTORY_LIMIT.
+    Новые записи получают ts больше всех в файле (add), поэтому retain выбрасывает только то, что
+    старше самой старой живой: запись, дописанную, пока HISTORY ещё не обновлён, он не тронет.
+    Смещения записей держим в памяти (строятся проходом по заголовкам при первом обращении),
+    когда мёртвых байт становится не меньше живых — файл переписывается (tmp + os.replace).
+    Все операции с файлом пользователя — под его threading.Lock (вызывается из to_thread).
+    """
+
+    def __init__(self, root: str, thumb_px: int = 512):
+        self.root = root
+        self.thumb_px = thumb_px
+        self._locks: Dict[int, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._index: Dict[int, Dict[int, Loc]] = {}
+
+    def path(self, uid: int) -> str:
+        return os.path.join(self.root, f"{uid}.pack")
+
+    def _lock(self, uid: int) -> threading.Lock:
+        with self._locks_guard:
+            lk = self._locks.get(uid)
+            if lk is None:
+                lk = self._locks[uid] = threading.Lock()
+            return lk
+
+    # ---- индекс ----
+    def _load(self, uid: int) -> Dict[int, Loc]:
+        idx = self._index.get(uid)
+        if idx is not None:
+            return idx
+        idx = {}
+        p = self.path(uid)
+        if os.path.exists(p):
+            size = os.path.getsize(p)
+            with open(p, "rb") as f:
+                off = 0
+                while off + _HDR.size <= size:
+                    f.seek(off)
+                    magic, ts, il, tl = _HDR.unpack(f.read(_HDR.size))
+                    end = off + _HDR.size + il + tl
+                    if magic != _MAGIC or end > size:
+                        break
+                    idx[ts] = (off, il, tl)
+                    off = end
+            if off < size:
+                # оборванная запись (падение посреди append) — отрезаем хвост
+                log.warning("history pack %s: truncating torn tail at %d/%d", p, off, size)
+                with open(p, "r+b") as f:
+                    f.truncate(off)
+        self._index[uid] = idx
+        return idx
+
+    # ---- запись ----
+    def add(self, uid: int, ts: int, jpeg_bytes: Optional[bytes], text: str, thumb: Optional[bytes] = None) -> int:
+        """Новая запись: ts — не меньше данного и больше всех в файле (два анализа за секунду). Возвращает ключ."""
+        return self.append(uid, ts, jpeg_bytes, text, thumb, unique=True)
+
+    def append(self, uid: int, ts: int, jpeg_bytes: Optional[bytes], text: str, thumb: Optional[bytes] = None,
+               unique: bool = False) -> int:
+        if thumb is None:
+            thumb = make_thumbnail(jpeg_bytes, self.thumb_px) if jpeg_bytes else b""
+        return self._append_raw(uid, ts, thumb, text, unique)
+
+    def _append_raw(self, uid: int, ts: int, thumb: bytes, text: str, unique: bool = False) -> int:
+        z = zlib.compress(text.encode("utf-8"), 6)
+        with self._lock(uid):
+            idx = self._load(uid)
+            if unique and idx:
+                ts = max(ts, max(idx) + 1)
+            with open(self.path(uid), "ab") as f:
+                off = f.tell()
+                f.write(_HDR.pack(_MAGIC, ts, len(thumb), len(z)) + thumb + z)
+                f.flush()
+                os.fsync(f.fileno())
+            idx[ts] = (off, len(thumb), len(z))
+        return ts
+
+    # ---- чтение ----
+    def has(self, uid: int, ts: int) -> bool:
+        with self._lock(uid):
+            return ts in self._load(uid)
+
+    def read_image(self, uid: int, ts: int) -> Optional[bytes]:
+        with self._lock(uid):
+            loc = self._load(uid).get(ts)
+            if not loc or not loc[1]:
+                return None
+            with open(self.path(uid), "rb") as f:
+                f.seek(loc[0] + _HDR.size)
+                return f.read(loc[1])
+
+    def read_text(self, uid: int, ts: int) -> Optional[str]:
+        with self._lock(uid):
+            loc = self._load(uid).get(ts)
+            if not loc:
+                return None
+            with open(self.path(uid), "rb") as f:
+                f.seek(loc[0] + _HDR.size + loc[1])
+                z = f.read(loc[2])
+        return zlib.decompress(z).decode("utf-8")
+
+    # ---- сборка мусора ----
+    def retain(self, uid: int, keep: Iterable[int]) -> int:
+        """
+        Забыть записи не из keep и старше min(keep); при необходимости переписать файл. Новее — не трогаем:
+        их мог дописать параллельный анализ, которого в снимке HISTORY ещё нет. Возвращает число выброшенных.
+        """
+        keep = set(keep)
+        if not keep:
+            return 0
+        cutoff = min(keep)
+        with self._lock(uid):
+            idx = self._load(uid)
+            dropped = [ts for ts in idx if ts < cutoff and ts not in keep]
+            for ts in dropped:
+                del idx[ts]
+            p = self.path(uid)
+            if not idx:
+                if os.path.exists(p):
+                    os.remove(p)
+                return len(dropped)
+            live = sum(_HDR.size + il + tl for _, il, tl in idx.values())
+            if os.path.getsize(p) - live >= live:
+                self._compact(uid, idx)
+            return len(dropped)
+
+    def _compact(self, uid: int, idx: Dict[int, Loc]) -> None:
+        p = self.path(uid)
+        tmp = p + ".tmp"
+        new: Dict[int, Loc] = {}
+        with open(p, "rb") as src, open(tmp, "wb") as dst:
+            for ts, (off, il, tl) in sorted(idx.items(), key=lambda kv: kv[1][0]):
+                src.seek(off)
+                new[ts] = (dst.tell(), il, tl)
+                dst.write(src.read(_HDR.size + il + tl))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, p)
+        self._index[uid] = new
+
+    # ---- разовая миграция со старой раскладки <uid>/<ts>.jpg + <ts>.txt ----
+    def migrate_legacy(self, history: Dict[str, List[Dict]]) -> Tuple[Dict[str, List[int]], Dict[str, List[int]]]:
+        """
+        Переносит живые записи из индекса в .pack и удаляет каталоги пользователей целиком
+        (вместе с осиротевшими файлами). Возвращает ({uid: [перенесённые ts]}, {uid: [ts без .txt]}) —
+        вторые после удаления каталога не открыть, их надо убрать из индекса.
+        """
+        moved: Dict[str, List[int]] = {}
+        skipped: Dict[str, List[int]] = {}
+        for name in os.listdir(self.root):
+            d = os.path.join(self.root, name)
+            if not os.path.isdir(d) or not name.lstrip("-").isdigit():
+                continue
+            uid = int(name)
+            failed = False
+            for e in history.get(name, []):
+                ts = int(e["ts"])
+                if self.has(uid, ts):  # перенесена прошлым (прерванным) запуском
+                    moved.setdefault(name, []).append(ts)
+                    continue
+                if not e.get("txt"):
+                    continue
+                if not os.path.exists(e["txt"]):
+                    log.warning("history migrate %s/%s: %s missing, dropping entry", name, ts, e["txt"])
+                    skipped.setdefault(name, []).append(ts)
+                    continue
+                try:
+                    with open(e["txt"], "r", encoding="utf-8") as f:
+                        text = f.read()
+                    img = None
+                    if e.get("img") and os.path.exists(e["img"]):
+                        with open(e["img"], "rb") as f:
+                            img = f.read()
+                    self.append(uid, ts, img, text)
+                    moved.setdefault(name, []).append(ts)
+                except Exception as ex:
+                    log.warning("history migrate %s/%s failed: %s", name, ts, ex)
+                    failed = True
+            if not failed:  # иначе каталог остаётся до следующего запуска
+                shutil.rmtree(d, ignore_errors=True)
+            else:
+                skipped.pop(name, None)  # каталог остался — запись ещё может перенестись
+        return moved, skipped
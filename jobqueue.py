@@ -0,0 +1,419 @@
+# jobqueue.py — очередь анализов в SQLite: бот кладёт фото, воркеры (процессы или поток) считают, бот доставляет
+import os, json, time, signal, asyncio, sqlite3, logging, threading, multiprocessing
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("beauty-nano-bot.jobqueue")
+
+# handler(payload, image) -> (result, blob): выполняется в воркере, всё нужное для анализа — в payload
+Handler = Callable[[Dict[str, Any], bytes], Tuple[Dict[str, Any], Optional[bytes]]]
+
+# статусы: queued -> running -> done | failed -> sent -> delivered
+#   done/failed — результат ждёт бота; sent — ответ пользователю ушёл, осталась история и Sheets
+#   sent_parts — сколько частей ответа уже у пользователя: повтор доставки их не шлёт
+
+
+class JobQueue:
+    """
+    Таблица analysis_jobs. Каждый вызов открывает своё соединение (как PaymentLedger): в базу
+    одновременно пишут бот и процессы-воркеры, WAL + BEGIN IMMEDIATE на захвате задания.
+    Воркер берёт задание в аренду на lease_sec; если он умер посреди работы — по истечении аренды
+    задание достаётся другому, после max_attempts захватов оно считается failed.
+    Исходное фото хранится до конца анализа, миниатюра для истории — до доставки.
+    """
+
+    def __init__(self, path: str, lease_sec: float = 300.0, max_attempts: int = 3):
+        self.path = path
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        c = self._conn()
+        try:
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("""CREATE TABLE IF NOT EXISTS analysis_jobs (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id      INTEGER,
+                status       TEXT NOT NULL,
+                payload      TEXT NOT NULL,
+                image        BLOB,
+                result       TEXT,
+                blob         BLOB,
+                error        TEXT,
+                worker       TEXT,
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                lease_until  REAL,
+                created_at   REAL,
+                started_at   REAL,
+                finished_at  REAL,
+                sent_parts   INTEGER NOT NULL DEFAULT 0
+            )""")
+            if "sent_parts" not in {r[1] for r in c.execute("PRAGMA table_info(analysis_jobs)")}:
+                c.execute("ALTER TABLE analysis_jobs ADD COLUMN sent_parts INTEGER NOT NULL DEFAULT 0")
+            c.execute("CREATE INDEX IF NOT EXISTS analysis_jobs_status ON analysis_jobs(status, id)")
+        finally:
+            c.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        c = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        c.execute("PRAGMA synchronous=NORMAL")
+        return c
+
+    # ---- бот ----
+    def put(self, payload: Dict[str, Any], image: bytes) -> int:
+        c = self._conn()
+        try:
+            cur = c.execute("INSERT INTO analysis_jobs(user_id, status, payload, image, created_at) "
+                            "VALUES (?, 'queued', ?, ?, ?)",
+                            (payload.get("user_id"), json.dumps(payload, ensure_ascii=False), image, time.time()))
+            return int(cur.lastrowid)
+        finally:
+            c.close()
+
+    def ready(self, limit: int = 50, exclude: Tuple[int, ...] = ()) -> List[Dict[str, Any]]:
+        """Задания, которые бот должен довести до пользователя (done/failed/sent), старые первыми."""
+        c = self._conn()
+        try:
+            rows = c.execute("SELECT id, status, payload, result, blob, error, created_at, started_at, finished_at, "
+                             "sent_parts "
+                             "FROM analysis_jobs WHERE status IN ('done', 'failed', 'sent') ORDER BY id LIMIT ?",
+                             (limit + len(exclude),)).fetchall()
+        finally:
+            c.close()
+        skip = set(exclude)
+        return [{"id": r[0], "status": r[1], "payload": json.loads(r[2]),
+                 "result": json.loads(r[3]) if r[3] else {}, "blob": r[4], "error": r[5],
+                 "created_at": r[6], "started_at": r[7], "finished_at": r[8], "sent_parts": r[9]}
+                for r in rows if r[0] not in skip][:limit]
+
+    def mark(self, job_id: int, status: str) -> None:
+        c = self._conn()
+        try:
+            if status == "delivered":
+                c.execute("UPDATE analysis_jobs SET status=?, blob=NULL, image=NULL WHERE id=?", (status, job_id))
+            else:
+                c.execute("UPDATE analysis_jobs SET status=? WHERE id=?", (status, job_id))
+        finally:
+            c.close()
+
+    def sent_part(self, job_id: int, n: int) -> None:
+        """Часть ответа n (с 1) доставлена."""
+        c = self._conn()
+        try:
+            c.execute("UPDATE analysis_jobs SET sent_parts=? WHERE id=?", (n, job_id))
+        finally:
+            c.close()
+
+    def requeue_running(self, worker: Optional[str] = None) -> int:
+        """
+        Вернуть running в очередь: при старте бота — все (воркеров прошлого запуска нет),
+        при падении процесса — его задания, не дожидаясь конца аренды.
+        """
+        c = self._conn()
+        try:
+            sql = "UPDATE analysis_jobs SET status='queued', worker=NULL, lease_until=NULL WHERE status='running'"
+            if worker is None:
+                return c.execute(sql).rowcount
+            return c.execute(sql + " AND worker=?", (worker,)).rowcount
+        finally:
+            c.close()
+
+    def purge(self, older_than_sec: float) -> int:
+        c = self._conn()
+        try:
+            return c.execute("DELETE FROM analysis_jobs WHERE status='delivered' AND created_at<?",
+                             (time.time() - older_than_sec,)).rowcount
+        finally:
+            c.close()
+
+    def counts(self) -> Dict[str, int]:
+        c = self._conn()
+        try:
+            return dict(c.execute("SELECT status, COUNT(*) FROM analysis_jobs "
+                                  "WHERE status!='delivered' GROUP BY status").fetchall())
+        finally:
+            c.close()
+
+    # ---- воркер ----
+    def claim(self, worker: str) -> Optional[Tuple[int, int, Dict[str, Any], bytes]]:
+        """Взять старейшее задание: (id, attempt, payload, image) или None. attempt — жетон для finish/fail."""
+        now = time.time()
+        c = self._conn()
+        try:
+            # дешёвая проверка без блокировки записи: простаивающие воркеры не мешают боту класть задания
+            if c.execute("SELECT 1 FROM analysis_jobs WHERE status='queued' "
+                         "OR (status='running' AND lease_until<?) LIMIT 1", (now,)).fetchone() is None:
+                return None
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    row = c.execute("SELECT id, attempts FROM analysis_jobs WHERE status='queued' "
+                                    "OR (status='running' AND lease_until<?) ORDER BY id LIMIT 1", (now,)).fetchone()
+                    if row is None:
+                        c.execute("COMMIT")
+                        return None
+                    job_id, attempts = row
+                    if attempts >= self.max_attempts:
+                        c.execute("UPDATE analysis_jobs SET status='failed', image=NULL, finished_at=?, "
+                                  "error=COALESCE(error, 'worker died') WHERE id=?", (now, job_id))
+                        log.warning("job %d: %d attempts, giving up", job_id, attempts)
+                        continue
+                    c.execute("UPDATE analysis_jobs SET status='running', worker=?, attempts=attempts+1, "
+                              "started_at=?, lease_until=? WHERE id=?", (worker, now, now + self.lease_sec, job_id))
+                    payload, image = c.execute("SELECT payload, image FROM analysis_jobs WHERE id=?",
+                                               (job_id,)).fetchone()
+                    c.execute("COMMIT")
+                    return job_id, attempts + 1, json.loads(payload), image
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+        finally:
+            c.close()
+
+    def finish(self, job_id: int, attempt: int, result: Dict[str, Any], blob: Optional[bytes]) -> bool:
+        """False — аренда ушла другому воркеру (этот результат опоздал и не нужен)."""
+        c = self._conn()
+        try:
+            return c.execute("UPDATE analysis_jobs SET status='done', result=?, blob=?, image=NULL, finished_at=? "
+                             "WHERE id=? AND status='running' AND attempts=?",
+                             (json.dumps(result, ensure_ascii=False), blob, time.time(), job_id, attempt)).rowcount == 1
+        finally:
+            c.close()
+
+    def fail(self, job_id: int, attempt: int, error: str) -> bool:
+        c = self._conn()
+        try:
+            return c.execute("UPDATE analysis_jobs SET status='failed', error=?, image=NULL, finished_at=? "
+                             "WHERE id=? AND status='running' AND attempts=?",
+                             (error[:500], time.time(), job_id, attempt)).rowcount == 1
+        finally:
+            c.close()
+
+
+def run_worker(path: str, handler: Handler, name: str, threads: int, poll_sec: float,
+               stop: threading.Event, wake: Optional[threading.Event] = None, lease_sec: float = 300.0,
+               parent_pid: Optional[int] = None) -> None:
+    """
+    Цикл воркера: один поток захватывает задания, пока есть свободный из threads, и отдаёт их пулу
+    (анализ — это в основном ожидание Gemini, одному процессу есть смысл держать несколько).
+    Без заданий ждёт poll_sec или wake. После stop дорабатывает взятые задания и выходит;
+    parent_pid — выйти и тогда, когда бот умер, не остановив воркер.
+    """
+    q = JobQueue(path, lease_sec=lease_sec)
+    free = threading.Semaphore(threads)
+
+    def work(job_id: int, attempt: int, payload: Dict[str, Any], image: bytes) -> None:
+        try:
+            try:
+                result, blob = handler(payload, image)
+            except Exception as e:
+                log.warning("job %d failed: %s", job_id, e)
+                q.fail(job_id, attempt, f"{type(e).__name__}: {e}")
+                return
+            if not q.finish(job_id, attempt, result, blob):
+                log.warning("job %d: lease lost, result dropped", job_id)
+        except Exception:
+            log.exception("job %d: queue write failed", job_id)
+        finally:
+            free.release()
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name) as pool:
+        while not stop.is_set():
+            if parent_pid is not None and os.getppid() != parent_pid:
+                log.warning("%s: bot process is gone, exiting", name)
+                break
+            if not free.acquire(timeout=poll_sec):
+                continue
+            try:
+                job = q.claim(name)
+            except Exception:
+                log.exception("%s: claim failed", name)
+                job = None
+            if job is None:
+                free.release()
+                if wake is not None and wake.wait(poll_sec):
+                    wake.clear()
+                elif wake is None:
+                    stop.wait(poll_sec)
+                continue
+            pool.submit(work, *job)
+
+
+def _process_main(path: str, handler: Handler, name: str, threads: int, poll_sec: float,
+                  lease_sec: float, parent_pid: int) -> None:
+    # останавливаем SIGTERM'ом, а не общим multiprocessing.Event: убитый (OOM) процесс может унести
+    # с собой его блокировку, и тогда повиснет уже бот. Ctrl+C получает вся группа — его игнорируем
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(path, handler, name, threads, poll_sec, stop, None, lease_sec, parent_pid)
+
+
+class WorkerPool:
+    """
+    processes > 0 — столько процессов-воркеров (spawn: дочерний процесс импортирует модуль handler'а
+    заново, без состояния бота), новое задание они замечают опросом раз в poll_sec; упавший процесс
+    перезапускается при check(). processes == 0 — один поток-воркер в процессе бота, notify() будит
+    его сразу (разработка, тесты, подмена модели в tools/loadtest.py).
+    """
+
+    def __init__(self, queue: JobQueue, handler: Handler, processes: int = 2, threads: int = 4,
+                 poll_sec: float = 0.2):
+        self.queue = queue
+        self.handler = handler
+        self.processes = processes
+        self.threads = threads
+        self.poll_sec = poll_sec
+        self.restarts = 0
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stopping = False
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._procs: List[Any] = []
+
+    def _spawn(self, i: int) -> Any:
+        name = f"analysis-{i}"
+        if not self.processes:
+            t = threading.Thread(target=run_worker, name=name, daemon=True,
+                                 args=(self.queue.path, self.handler, name, self.threads, self.poll_sec,
+                                       self._stop, self._wake, self.queue.lease_sec))
+            t.start()
+            return t
+        p = self._ctx.Process(target=_process_main, name=name, daemon=True,
+                              args=(self.queue.path, self.handler, name, self.threads, self.poll_sec,
+                                    self.queue.lease_sec, os.getpid()))
+        p.start()
+        return p
+
+    def start(self) -> None:
+        n = self.queue.requeue_running()
+        if n:
+            log.info("jobqueue: %d unfinished jobs requeued", n)
+        self._procs = [self._spawn(i) for i in range(max(1, self.processes))]
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def dead(self) -> bool:
+        return not self._stopping and any(not p.is_alive() for p in self._procs)
+
+    def check(self) -> None:
+        """Перезапустить умершие процессы (OOM, segfault в декодере); их задания — сразу обратно в очередь."""
+        if self._stopping:
+            return
+        for i, p in enumerate(self._procs):
+            if not p.is_alive():
+                self.restarts += 1
+                n = self.queue.requeue_running(p.name)
+                log.warning("analysis worker %s died (exit %s), %d jobs requeued, restarting",
+                            p.name, getattr(p, "exitcode", None), n)
+                self._procs[i] = self._spawn(i)
+
+    def alive(self) -> int:
+        return sum(1 for p in self._procs if p.is_alive())
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stopping = True
+        self._stop.set()
+        self._wake.set()
+        for p in self._procs:
+            if self.processes and p.is_alive():
+                p.terminate()  # SIGTERM: воркер доделывает взятые задания и выходит
+        deadline = time.monotonic() + timeout
+        for p in self._procs:
+            p.join(max(0.0, deadline - time.monotonic()))
+        for p in self._procs:
+            if self.processes and p.is_alive():
+                p.kill()  # задание недоделано — вернётся в очередь при следующем старте
+                p.join(1.0)
+
+
+class JobPump:
+    """
+    Сторона бота: раз в poll_sec забирает готовые задания и зовёт deliver(job) (у каждого — своя
+    задача: ответы разным пользователям не ждут друг друга). Заодно перезапускает упавшие воркеры,
+    раз в минуту чистит доставленные старше keep_sec и держит свежие counts для метрик.
+    """
+
+    def __init__(self, queue: JobQueue, pool: WorkerPool, deliver: Callable[[Dict[str, Any]], Awaitable[None]],
+                 poll_sec: float = 0.2, keep_sec: float = 86400.0, max_parallel: int = 32,
+                 max_delivery_attempts: int = 5):
+        self.queue = queue
+        self.pool = pool
+        self.deliver = deliver
+        self.poll_sec = poll_sec
+        self.keep_sec = keep_sec
+        self.max_parallel = max_parallel
+        self.max_delivery_attempts = max_delivery_attempts
+        self.counts: Dict[str, int] = {}
+        self.delivered = 0
+        self._active: Dict[int, asyncio.Task] = {}
+        self._failures: Dict[int, int] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queued(self) -> int:
+        return self.counts.get("queued", 0) + self.counts.get("running", 0)
+
+    async def start(self) -> None:
+        self._wake = asyncio.Event()
+        await asyncio.to_thread(self.pool.start)
+        self._task = asyncio.create_task(self._run(), name="job-pump")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+        if self._active:
+            await asyncio.wait(list(self._active.values()), timeout=10)
+        await asyncio.to_thread(self.pool.stop)
+
+    def notify(self) -> None:
+        """Новое задание в очереди — разбудить воркеры (из event loop)."""
+        self.pool.notify()
+
+    async def _run(self) -> None:
+        last_housekeeping = 0.0
+        while True:
+            try:
+                free = self.max_parallel - len(self._active)
+                if free > 0:
+                    for job in await asyncio.to_thread(self.queue.ready, free, tuple(self._active)):
+                        t = asyncio.create_task(self._deliver(job))
+                        self._active[job["id"]] = t
+                if self.pool.dead():
+                    await asyncio.to_thread(self.pool.check)
+                now = time.monotonic()
+                if now - last_housekeeping >= 60:
+                    last_housekeeping = now
+                    n = await asyncio.to_thread(self.queue.purge, self.keep_sec)
+                    if n:
+                        log.info("jobqueue: purged %d delivered jobs", n)
+                self.counts = await asyncio.to_thread(self.queue.counts)
+            except Exception:
+                log.exception("job pump iteration failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _deliver(self, job: Dict[str, Any]) -> None:
+        try:
+            await self.deliver(job)
+            self.delivered += 1
+            self._failures.pop(job["id"], None)
+        except Exception:
+            # статус не сдвинулся — следующий проход попробует снова, но не бесконечно
+            n = self._failures[job["id"]] = self._failures.get(job["id"], 0) + 1
+            log.exception("job %d delivery failed (%d/%d)", job["id"], n, self.max_delivery_attempts)
+            if n >= self.max_delivery_attempts:
+                self._failures.pop(job["id"], None)
+                with suppress(Exception):
+                    await asyncio.to_thread(self.queue.mark, job["id"], "delivered")
+            else:
+                await asyncio.sleep(5)
+        finally:
+            self._active.pop(job["id"], None)
+            self._wake.set()
@@ -0,0 +1,69 @@
+# loopmon.py — задержка event loop и детектор блокировок (со стеком виновника)
+import sys, time, asyncio, logging, threading, traceback
+from typing import Optional
+
+log = logging.getLogger("beauty-nano-bot.loop")
+
+
+class LoopMonitor:
+    """
+    Heartbeat-корутина раз в `interval` засыпает и меряет, на сколько позже проснулась —
+    это задержка loop (lag). В режиме debug дополнительно работает сторожевой поток:
+    если heartbeat не отмечался дольше `threshold`, он снимает стек потока loop
+    (sys._current_frames) и пишет в лог — видно, какой колбэк держит loop.
+    Без debug стоимость — одна короткая корутина раз в `interval`.
+    """
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.25, debug: bool = False):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_tid: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._loop_tid = threading.get_ident()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+            threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-heartbeat")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+
+    async def _heartbeat(self) -> None:
+        while True:
+            t0 = time.monotonic()
+            self._beat = t0
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - t0 - self.interval)
+            if self.lag > self.max_lag:
+                self.max_lag = self.lag
+            if self.lag > self.threshold:
+                self.stalls += 1
+                if not self.debug:
+                    log.warning("event loop lag %.0f ms", self.lag * 1000)
+
+    def _watchdog(self) -> None:
+        reported_beat = None
+        step = max(0.01, self.threshold / 4)
+        while not self._stop.wait(step):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked <= self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_tid)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+            log.warning("event loop blocked > %.0f ms, stack:\n%s", blocked * 1000, stack)
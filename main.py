@@ -1,66 +1,122 @@
 # === main.py (Beauty Nano Bot) — персонализация профилем + админ-меню ===
-import os, io, re, time, json, base64, asyncio, logging, uuid
+import os, io, re, time, json, hmac, base64, asyncio, logging
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock
+from contextlib import suppress, contextmanager
+from contextvars import ContextVar
 from typing import Dict, Any, List
 
 from dotenv import load_dotenv
-from PIL import Image
-import google.generativeai as genai
-
-# --- Sheets
-import gspread
-from google.oauth2.service_account import Credentials
-
-# --- Flask Endpoints
-from flask import Flask, request, jsonify
+# google.generativeai, gspread/google-auth, PIL и Flask импортируются при первом использовании
+# (gemini_model, sheets_init, _prep_image, start_flask_endpoints) — импорт main должен быть дешёвым
 
 # --- Telegram
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+    Update, Chat, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 )
 from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ContextTypes,
     CallbackQueryHandler, ConversationHandler, filters, PreCheckoutQueryHandler
 )
 
-# --- YooKassa
-from yookassa import Configuration as YKConf, Payment as YKPayment
+from dispatcher import PerUserUpdateProcessor
+from state import StateWriter
+from yk import YooKassaClient, PaymentLedger, PaymentWorker, is_yookassa_ip
+from scheduler import PremiumScheduler, REMIND, RENEW, EXPIRE
+from loopmon import LoopMonitor
+from userdir import UserDirectory, ALL as DIR_ALL, PREMIUM as DIR_PREMIUM, ADMIN as DIR_ADMIN
+from stats import StatsCounters, sparkline
+from metrics import REGISTRY
+from tracing import Tracer, JsonlExporter, OtlpHttpExporter
+from profiler import SamplingProfiler
+from histcache import HistoryCache
+from histstore import HistoryStore, make_thumbnail
+from persistence import SqlitePersistence
+from rules import RuleEngine
+from outbound import SendGovernor, append_tail
+from membudget import MemoryBudget, BudgetExhausted, estimate_image_bytes, queued_image_bytes
+from jobqueue import JobQueue, WorkerPool, JobPump
+import prescreen
+from userctx import UserContext, UserScope
+from recommend import Recommender
 
 # --- RefData
 try:
     from refdata import REF
 except Exception:
     class _DummyRef:
-        def reload_all(self): pass
+        configured = False
+        def reload_all(self): return 0
+        def get_profile_rules(self): return []
+        def get_catalog(self, active_only=True): return []
     REF = _DummyRef()
 
 # ========== ЛОГИ ==========
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s | %(message)s")
 log = logging.getLogger("beauty-nano-bot")
-for noisy in ("httpx", "gspread", "google", "werkzeug", "yookassa"):
+for noisy in ("httpx", "gspread", "google", "werkzeug"):
     logging.getLogger(noisy).setLevel(logging.WARNING)
 
 # ========== ENV / CONFIG ==========
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not BOT_TOKEN: raise RuntimeError("Не задан BOT_TOKEN")
-if not GEMINI_API_KEY: raise RuntimeError("Не задан GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+BOT_API_URL = os.getenv("BOT_API_URL", "")   # свой Bot API сервер (или заглушка tools/fakes.py)
+# Sheets, справочники и прогрев Gemini стартуют параллельно уже после запуска polling;
+# кто не успел за BOOT_TIMEOUT_SEC — бот работает без него, подсистема догонит в фоне
+BOOT_TIMEOUT_SEC = float(os.getenv("BOOT_TIMEOUT_SEC", "20"))
+GEMINI_WARMUP = os.getenv("GEMINI_WARMUP", "1") == "1"
 
 PORT = int(os.getenv("PORT", "8080"))
 DATA_DIR = os.getenv("DATA_DIR", "./data")
-os.makedirs(DATA_DIR, exist_ok=True)
 
 RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", "10"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "8"))      # сколько пользователей обслуживаем параллельно
+# исходящие вызовы Bot API (outbound.py): лимиты Telegram на бота и на чат, пул соединений для отправок
+TG_OVERALL_RATE = float(os.getenv("TG_OVERALL_RATE", "25"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_SEND_POOL = int(os.getenv("TG_SEND_POOL", "64"))
+USER_DATA_FLUSH_SEC = float(os.getenv("USER_DATA_FLUSH_SEC", "30"))  # как часто PTB сбрасывает user_data в USER_DATA_DB
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))
+# LOOP_MONITOR: 0 — выкл, 1 — только задержка loop, debug — ещё и стек колбэка, заблокировавшего loop
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "1").lower()
+LOOP_STALL_MS = int(os.getenv("LOOP_STALL_MS", "250"))
+# /healthz отвечает 503, если очередь апдейтов или задержка loop выше порога
+HEALTH_MAX_BACKLOG = int(os.getenv("HEALTH_MAX_BACKLOG", "200"))
+HEALTH_MAX_LAG_MS = int(os.getenv("HEALTH_MAX_LAG_MS", "2000"))
+# трассировка: доля апдейтов с trace (0 — выкл); OTLP-эндпоинт, иначе — JSONL-файл с ротацией
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_FILE_MAX_MB = int(os.getenv("TRACE_FILE_MAX_MB", "10"))
+# профайлер: длительность из админки; HTTP /debug/profile работает, только если задан PROFILER_TOKEN
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "30"))
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
 IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "896"))
+# сколько памяти в процессе бота могут занимать скачиваемые и записываемые в очередь фото (анализ — в воркерах);
+# сверх — ждём до IMAGE_MEM_WAIT_SEC, потом просим прислать позже.
+# Ожидание идёт внутри слота диспетчера — долгое заняло бы слоты и остановило бы текст и кнопки
+IMAGE_MEM_BUDGET_MB = int(os.getenv("IMAGE_MEM_BUDGET_MB", "128"))
+IMAGE_MEM_WAIT_SEC = float(os.getenv("IMAGE_MEM_WAIT_SEC", "1.5"))
+# очередь анализов (jobqueue.py): процессы-воркеры и потоков в каждом (анализ — в основном ожидание Gemini);
+# ANALYSIS_WORKERS=0 — один поток-воркер в процессе бота. Сверх JOB_QUEUE_MAX заданий новые фото просим прислать позже
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+ANALYSIS_WORKER_THREADS = int(os.getenv("ANALYSIS_WORKER_THREADS", "4"))
+JOB_POLL_SEC = float(os.getenv("JOB_POLL_SEC", "0.2"))
+JOB_LEASE_SEC = float(os.getenv("JOB_LEASE_SEC", "300"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "500"))
+RECOMMEND_TOP_K = int(os.getenv("RECOMMEND_TOP_K", "3"))  # товаров каталога под ответом; 0 — не показывать
 
 DEFAULT_FREE_LIMIT = int(os.getenv("FREE_LIMIT", "5"))
 DEFAULT_PRICE_RUB  = int(os.getenv("PRICE_RUB",  "299"))
 
 HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
 HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "10"))
+HISTORY_CACHE_TTL_SEC = float(os.getenv("HISTORY_CACHE_TTL_SEC", "300"))
+HISTORY_THUMB_PX = int(os.getenv("HISTORY_THUMB_PX", "512"))
 
 SHEETS_ENABLED = os.getenv("SHEETS_ENABLED", "1") == "1"
 SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
@@ -73,18 +129,28 @@ STARS_PAY_DESC  = os.getenv("STARS_PAY_DESC", "Безлимит анализов
 YK_SHOP_ID = os.getenv("YK_SHOP_ID")
 YK_SECRET_KEY = os.getenv("YK_SECRET_KEY")
 YK_RETURN_URL = os.getenv("YK_RETURN_URL", "https://example.com/yk/success")
-if YK_SHOP_ID and YK_SECRET_KEY:
-    YKConf.account_id = YK_SHOP_ID
-    YKConf.secret_key = YK_SECRET_KEY
+# пускать вебхук только с адресов ЮKassa; за обратным прокси remote_addr — адрес прокси, поэтому выключено по умолчанию
+YK_WEBHOOK_CHECK_IP = os.getenv("YK_WEBHOOK_CHECK_IP", "0") == "1"
+
+PREMIUM_REMIND_DAYS = int(os.getenv("PREMIUM_REMIND_DAYS", "3"))
+PREMIUM_RENEW_BEFORE_SEC = int(os.getenv("PREMIUM_RENEW_BEFORE_SEC", "3600"))
+PREMIUM_RENEW_RETRY_SEC = float(os.getenv("PREMIUM_RENEW_RETRY_SEC", "60"))   # первый повтор упавшего автосписания, дальше ×2
+STARS_GRACE_SEC = int(os.getenv("STARS_GRACE_SEC", "86400"))   # Telegram сам продлевает Stars-подписку
+SCHED_BATCH = int(os.getenv("SCHED_BATCH", "20"))
 
 # файлы данных
 ADMINS_FILE   = os.path.join(DATA_DIR, "admins.json")
 USERS_FILE    = os.path.join(DATA_DIR, "users.json")
+USERNAMES_FILE= os.path.join(DATA_DIR, "usernames.json")
 USAGE_FILE    = os.path.join(DATA_DIR, "usage.json")
 CONFIG_FILE   = os.path.join(DATA_DIR, "config.json")
 FEEDBACK_FILE = os.path.join(DATA_DIR, "feedback.json")
 HISTORY_FILE  = os.path.join(DATA_DIR, "history.json")
-HISTORY_DIR   = os.path.join(DATA_DIR, "history"); os.makedirs(HISTORY_DIR, exist_ok=True)
+HISTORY_DIR   = os.path.join(DATA_DIR, "history")
+PAYMENTS_DB   = os.path.join(DATA_DIR, "payments.sqlite")
+USER_DATA_DB  = os.path.join(DATA_DIR, "user_data.sqlite")   # user_data и состояния диалогов (persistence.py)
+JOBS_DB       = os.path.join(DATA_DIR, "jobs.sqlite")        # очередь анализов (jobqueue.py)
+STATS_FILE    = os.path.join(DATA_DIR, "stats.json")
 
 def load_json(path, default):
     try:
@@ -106,27 +172,175 @@ def parse_admin_ids(val: str | None) -> set[int]:
 
 seed_admins: set[int] = parse_admin_ids(os.getenv("ADMIN_IDS"))
 
-ADMINS: set[int] = set(load_json(ADMINS_FILE, []))
-if seed_admins: ADMINS |= seed_admins
-save_json(ADMINS_FILE, list(ADMINS))
-
-USERS: set[int] = set(load_json(USERS_FILE, []))
-USAGE: Dict[int, Dict[str, Any]] = {int(k): v for k, v in load_json(USAGE_FILE, {}).items()}
-CONFIG: Dict[str, Any] = load_json(CONFIG_FILE, {"FREE_LIMIT": DEFAULT_FREE_LIMIT, "PRICE_RUB": DEFAULT_PRICE_RUB})
-FEEDBACK: Dict[str, int] = load_json(FEEDBACK_FILE, {"up": 0, "down": 0})
-HISTORY: Dict[str, List[Dict[str, Any]]] = load_json(HISTORY_FILE, {})
+# заполняются в bootstrap(); объекты не пересоздаются — ссылки на них можно держать с импорта
+ADMINS: set[int] = set()
+USERS: set[int] = set()
+USERNAMES: Dict[int, str] = {}
+USAGE: Dict[int, Dict[str, Any]] = {}
+CONFIG: Dict[str, Any] = {"FREE_LIMIT": DEFAULT_FREE_LIMIT, "PRICE_RUB": DEFAULT_PRICE_RUB}
+FEEDBACK: Dict[str, int] = {"up": 0, "down": 0}
+HISTORY: Dict[str, List[Dict[str, Any]]] = {}
+
+# единственный писатель: сохраняем снимки пачками из event loop (см. state.py)
+STATE = StateWriter(delay=float(os.getenv("PERSIST_DELAY_SEC", "1.0")))
+STATE.register("admins",   ADMINS_FILE,   lambda: list(ADMINS))
+STATE.register("users",    USERS_FILE,    lambda: list(USERS))
+STATE.register("usernames",USERNAMES_FILE,lambda: dict(USERNAMES))
+STATE.register("usage",    USAGE_FILE,    lambda: {k: dict(v) for k, v in USAGE.items()})
+STATE.register("config",   CONFIG_FILE,   lambda: dict(CONFIG))
+STATE.register("feedback", FEEDBACK_FILE, lambda: dict(FEEDBACK))
+STATE.register("history",  HISTORY_FILE,  lambda: {k: [dict(e) for e in v] for k, v in HISTORY.items()})
+
+# счётчики для админ-статистики: инкремент по событию, свёртки по часам/дням
+STATS = StatsCounters(on_change=lambda: persist("stats"))
+STATE.register("stats",    STATS_FILE,    STATS.to_json)
+
+def persist(*names: str):
+    STATE.persist(*names)
 
 def persist_all():
-    save_json(ADMINS_FILE, list(ADMINS))
-    save_json(USERS_FILE, list(USERS))
-    save_json(USAGE_FILE, USAGE)
-    save_json(CONFIG_FILE, CONFIG)
-    save_json(FEEDBACK_FILE, FEEDBACK)
-    save_json(HISTORY_FILE, HISTORY)
+    STATE.persist()
+
+# ---------- Трассировка ----------
+TRACER = Tracer(
+    sample_rate=TRACE_SAMPLE_RATE,
+    exporter=(OtlpHttpExporter(TRACE_OTLP_ENDPOINT) if TRACE_OTLP_ENDPOINT else
+              JsonlExporter(os.getenv("TRACE_FILE", os.path.join(DATA_DIR, "traces.jsonl")),
+                            max_bytes=TRACE_FILE_MAX_MB*1024*1024)),
+)
+
+def _trace_update(update: object):
+    attrs: Dict[str, Any] = {}
+    if isinstance(update, Update):
+        attrs["update_id"] = update.update_id
+        if update.effective_user: attrs["user_id"] = update.effective_user.id
+        if update.callback_query: attrs["kind"] = "callback"; attrs["data"] = (update.callback_query.data or "")[:32]
+        elif update.message: attrs["kind"] = "photo" if update.message.photo else "message"
+    return TRACER.trace("update", **attrs)
+
+@contextmanager
+def _around_update(update: object):
+    # корневой span + область UserContext: пользователь резолвится один раз, USAGE пишется один раз
+    with _trace_update(update), user_scope():
+        yield
+
+# апдейты разных пользователей — параллельно, одного пользователя — по очереди
+DISPATCHER = PerUserUpdateProcessor(parallelism=CONCURRENT_UPDATES, max_pending=MAX_PENDING_UPDATES,
+                                    around=_around_update)
+LOOPMON = LoopMonitor(threshold=LOOP_STALL_MS/1000, debug=(LOOP_MONITOR == "debug"))
+PROFILER = SamplingProfiler()
+
+# ---------- Метрики (/metrics) ----------
+M_STAGE = REGISTRY.histogram("bot_analysis_stage_seconds", "Длительность этапов анализа фото", ["stage"])
+M_ERRORS = REGISTRY.counter("bot_errors_total", "Ошибки по этапам", ["kind"])
+M_CACHE_HITS = REGISTRY.counter("bot_cache_hits_total", "Попадания в кэши", ["cache"])
+M_RATE_LIMITED = REGISTRY.counter("bot_rate_limited_total", "Фото, отклонённые по RATE_LIMIT_SECONDS")
+M_ANALYSES_IN_FLIGHT = REGISTRY.gauge("bot_analyses_in_flight", "Анализы фото в работе")
+REGISTRY.gauge("bot_update_queue_depth", "Апдейты, ждущие обработки", fn=lambda: DISPATCHER.waiting)
+REGISTRY.gauge("bot_updates_in_flight", "Апдейты в обработке", fn=lambda: DISPATCHER.in_flight)
+REGISTRY.gauge("bot_update_wait_p95_seconds", "p95 ожидания апдейта в очереди", fn=lambda: DISPATCHER.stats()["wait_p95"])
+REGISTRY.gauge("bot_event_loop_lag_seconds", "Задержка event loop", fn=lambda: LOOPMON.lag)
+REGISTRY.gauge("bot_state_dirty_sections", "Разделы состояния, ждущие записи", fn=lambda: STATE.dirty)
+REGISTRY.gauge("bot_premium_active", "Активные премиум-подписки", fn=lambda: SCHED.count_active())
+REGISTRY.gauge("bot_premium_grace", "Stars-подписки после срока, ждут продления Telegram", fn=lambda: SCHED.count_grace())
+MEMBUDGET = MemoryBudget(IMAGE_MEM_BUDGET_MB * 1024 * 1024)
+REGISTRY.gauge("bot_image_mem_budget_bytes", "Бюджет памяти на скачивание фото и запись в очередь", fn=lambda: MEMBUDGET.capacity)
+REGISTRY.gauge("bot_image_mem_used_bytes", "Занято из бюджета памяти на фото", fn=lambda: MEMBUDGET.used)
+REGISTRY.gauge("bot_image_mem_waiting", "Фото, ждущие места в бюджете памяти", fn=lambda: MEMBUDGET.waiting)
+M_IMAGE_DEFERRED = REGISTRY.counter("bot_image_deferred_total", "Фото, отложенные из-за бюджета памяти")
+M_PRESCREEN_REJECTED = REGISTRY.counter("bot_prescreen_rejected_total", "Фото, отбракованные до Gemini", ["reason"])
+REGISTRY.gauge("bot_jobs_pending", "Задания анализа в очереди и в работе", fn=lambda: JOB_PUMP.queued if JOB_PUMP else 0)
+REGISTRY.gauge("bot_jobs_undelivered", "Готовые задания, ещё не доведённые до пользователя",
+               fn=lambda: sum(JOB_PUMP.counts.get(k, 0) for k in ("done", "failed", "sent")) if JOB_PUMP else 0)
+REGISTRY.gauge("bot_analysis_workers_alive", "Живые воркеры анализа", fn=lambda: JOB_PUMP.pool.alive() if JOB_PUMP else 0)
+GOVERNOR = SendGovernor(overall_rate=TG_OVERALL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST)
+REGISTRY.gauge("bot_tg_send_delayed_total", "Вызовы Bot API, ждавшие лимита", fn=lambda: GOVERNOR.delayed)
+REGISTRY.gauge("bot_tg_send_delay_seconds_total", "Суммарное ожидание лимитов Bot API", fn=lambda: GOVERNOR.delay_seconds)
+REGISTRY.gauge("bot_tg_retry_after_total", "Пойманные flood wait (RetryAfter)", fn=lambda: GOVERNOR.retry_after)
+M_SUBSYSTEM_UP = REGISTRY.gauge("bot_subsystem_up", "Подсистема поднята (1) или нет (0)", ["subsystem"])
+
+# telegram | sheets | refdata | gemini -> {"status": pending|starting|up|disabled|down|timeout, "ms", "error"}
+SUBSYSTEMS: Dict[str, Dict[str, Any]] = {}
+
+def set_subsystem(name: str, status: str, started: float | None = None, error: Any = None):
+    info: Dict[str, Any] = {"status": status}
+    if started is not None: info["ms"] = round((time.monotonic() - started) * 1000)
+    if error is not None: info["error"] = str(error)[:200]
+    SUBSYSTEMS[name] = info
+    M_SUBSYSTEM_UP.set(1 if status == "up" else 0, subsystem=name)
+
+@contextmanager
+def stage(name: str, **attrs: Any):
+    """Этап пайплайна: гистограмма bot_analysis_stage_seconds + span трассировки."""
+    with M_STAGE.time(stage=name), TRACER.span(name, **attrs) as sp:
+        yield sp
+
+def readiness() -> tuple[Dict[str, Any], bool]:
+    """Готовность принимать трафик: реальный бэклог, а не просто «процесс жив»."""
+    ds = DISPATCHER.stats()
+    subs = {k: dict(v) for k, v in list(SUBSYSTEMS.items())}
+    ok = (ds["waiting"] <= HEALTH_MAX_BACKLOG and LOOPMON.lag * 1000 <= HEALTH_MAX_LAG_MS
+          and subs.get("telegram", {}).get("status") == "up")
+    degraded = any(v["status"] not in ("up", "disabled") for v in subs.values())
+    return {
+        "status": "overloaded" if not ok else "degraded" if degraded else "ok",
+        "subsystems": subs,
+        "updates_waiting": ds["waiting"],
+        "updates_in_flight": ds["in_flight"],
+        "analyses_in_flight": int(M_ANALYSES_IN_FLIGHT.value()),
+        "image_mem_used_mb": round(MEMBUDGET.used / 2**20, 1),
+        "image_mem_waiting": MEMBUDGET.waiting,
+        "jobs_pending": JOB_PUMP.queued if JOB_PUMP else 0,
+        "wait_p95_ms": round(ds["wait_p95"] * 1000),
+        "loop_lag_ms": round(LOOPMON.lag * 1000),
+        "state_dirty": STATE.dirty,
+    }, ok
+
+# индексы для админ-справочника пользователей
+USERDIR = UserDirectory()
+
+def bootstrap():
+    """
+    Явная инициализация процесса (зовёт main()): проверка env, каталоги, чтение состояния с диска.
+    Сам импорт main ничего не читает и не пишет.
+    """
+    global YK_LEDGER, JOBS
+    if not BOT_TOKEN: raise RuntimeError("Не задан BOT_TOKEN")
+    if not GEMINI_API_KEY: raise RuntimeError("Не задан GEMINI_API_KEY")
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+
+    ADMINS.update(load_json(ADMINS_FILE, []))
+    USERS.update(load_json(USERS_FILE, []))
+    USERNAMES.update({int(k): v for k, v in load_json(USERNAMES_FILE, {}).items()})
+    USAGE.update({int(k): v for k, v in load_json(USAGE_FILE, {}).items()})
+    CONFIG.update(load_json(CONFIG_FILE, {}))
+    FEEDBACK.update(load_json(FEEDBACK_FILE, {}))
+    HISTORY.update(load_json(HISTORY_FILE, {}))
+    STATS.load(load_json(STATS_FILE, {}))
+    if seed_admins - ADMINS:
+        ADMINS.update(seed_admins); persist("admins")
+
+    USERDIR.load(USERS, USERNAMES,
+                 premium=[uid for uid, u in USAGE.items() if int(u.get("premium_until", 0)) > int(time.time())],
+                 admins=ADMINS)
+    YK_LEDGER = PaymentLedger(PAYMENTS_DB)
+    JOBS = JobQueue(JOBS_DB, lease_sec=JOB_LEASE_SEC)
 
 # ========== GEMINI ==========
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+_model = None
+_model_lock = Lock()
+
+def gemini_model():
+    """SDK импортируется и настраивается при первом анализе (из потока to_thread), а не при старте."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
 
 # (остальной код, включая Sheets, Users, Premium, Style, Режимы, History, Admin keyboards и Профиль)
 # ---------- Профиль (опросник) ----------
@@ -149,7 +363,8 @@ async def profile_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def profile_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t=(update.message.text or "").strip()
     if not t.isdigit() or not (5 <= int(t) <= 100):
-        return await update.message.reply_text("Введи возраст числом от 5 до 100.")
+        await update.message.reply_text("Введи возраст числом от 5 до 100.")
+        return P_AGE
     get_profile(context.user_data)["age"]=int(t)
     await update.message.reply_text("Опиши тип/состояние кожи (например: комбинированная, чувствительная):")
     return P_SKIN
@@ -172,6 +387,50 @@ async def profile_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # ---------- Персонализация по профилю ----------
+# правила персонализации: лист profile_rules (подгружается вместе со справочниками), иначе встроенные rules.DEFAULT_RULES
+RULES = RuleEngine()
+
+def load_rules():
+    """Перечитать правила из RefData (из потока: старт, перезагрузка справочников)."""
+    rs = RULES.load(REF.get_profile_rules())
+    for err in rs.errors:
+        log.warning("profile_rules: %s", err)
+    log.info("profile rules: %d (%s)", len(rs.rules), RULES.source)
+
+# подбор товаров: индекс по листу catalog, перестраивается вместе с правилами
+RECO = Recommender()
+
+# лимиты планов из листа limits_prices (free_limit): читаются вместе со справочниками, не на каждом апдейте
+REF_LIMITS: Dict[str, int] = {}
+
+def load_limits():
+    """Перечитать лимиты планов из RefData (из потока). Нет строки — остаётся CONFIG из админки."""
+    global REF_LIMITS
+    v = REF.get_limit("free_limit", -1) if REF.configured else -1
+    REF_LIMITS = {"free_limit": v} if v >= 0 else {}
+
+def free_limit() -> int:
+    v = REF_LIMITS.get("free_limit")
+    return v if v is not None else int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT))
+
+def load_catalog():
+    """Перестроить индекс каталога из RefData (из потока: старт, перезагрузка справочников)."""
+    index = RECO.load(REF.get_catalog() if REF.configured else [])
+    log.info("catalog index: %d SKU, %d terms", len(index.items) if index else 0, len(index.postings) if index else 0)
+
+def _recommend_html(profile: Dict[str, Any], answer: str) -> str:
+    items = RECO.recommend(profile, RULES.block(profile), answer, RECOMMEND_TOP_K)
+    if not items: return ""
+    lines = []
+    for it in items:
+        name = html_escape(f"{it['brand']} — {it['title']}" if it["brand"] else it["title"])
+        if it["url"].startswith(("http://", "https://")):  # кривая ссылка — BadRequest на всё сообщение
+            href = html_escape(it["url"]).replace('"', "&quot;")
+            lines.append(f'• <a href="{href}">{name}</a>')
+        else:
+            lines.append(f"• {name}")
+    return "🛍 <b>Подойдёт из нашего каталога:</b>\n" + "\n".join(lines)
+
 def _profile_context(user_data: dict) -> tuple[str, str]:
     pr = get_profile(user_data)
     parts = []
@@ -181,168 +440,258 @@ def _profile_context(user_data: dict) -> tuple[str, str]:
     if pr.get("goals"):parts.append(f"Цели: {pr['goals']}")
     human = "; ".join(parts)
 
-    rules = []
-    age  = pr.get("age")
-    skin = (pr.get("skin") or "").lower()
-    hair = (pr.get("hair") or "").lower()
-    goals= (pr.get("goals") or "").lower()
-
-    try:
-        if age and int(age) < 18:
-            rules.append("До 18 лет: избегай ретиноидов и сильных кислот (>5%); только мягкий уход.")
-    except Exception:
-        pass
-
-    g = f"{skin} {hair} {goals}"
-    if any(k in g for k in ["беремен", "pregnan", "гв", "лактац"]):
-        rules.append("Беременность/лактация: без ретиноидов и BHA >1%, без агрессивных отдушек/эфирных масел; приоритет — ниацинамид, пантенол, церамиды, SPF.")
-    if any(k in g for k in ["розаце", "купероз", "rosacea"]):
-        rules.append("Розацеа/купероз: избегай AHA/BHA высокой концентрации и ретиноидов; только деликатные формулы, без спиртов и отдушек; ежедневный SPF.")
-    if any(k in g for k in ["себор", "sd", "seborr"]):
-        rules.append("Себорейный дерматит: мягкое очищение, противовоспалительные компоненты (цинк PCA, пироктон оламин); избегай агрессивных ПАВ/скрабов.")
-
-    if "чувств" in skin:
-        rules.append("Кожа чувствительная: без отдушек и спиртов; избегай сильных кислот; пантенол/церамиды/алоэ.")
-    if "жир" in skin or "акне" in skin:
-        rules.append("Кожа жирная/склонная к акне: лёгкие формулы; при необходимости BHA 1–2%; SPF без масел.")
-    if "сух" in skin:
-        rules.append("Кожа сухая: мягкое очищение, липидное восстановление, увлажнение вечером.")
-    if "пигмент" in skin:
-        rules.append("Пигментация: дневной SPF обязателен; мягкие осветляющие (ниацинамид, арбутин).")
-
-    if "кудр" in hair:
-        rules.append("Кудрявые волосы: без сульфатов; кондиционирование; диффузор на низком нагреве.")
-    if "крашен" in hair or "осветл" in hair:
-        rules.append("Окрашенные/повреждённые: бережные шампуни, маски с протеинами/липидами, термозащита.")
-
-    if goals:
-        rules.append(f"Приоритизируй цели пользователя: {goals}.")
-
     base = (
         "Учитывай персональные правила ниже. Если правило конфликтует с общим советом — выбирай мягкий и безопасный вариант. "
         "Дай практичные списки для ☀️ утро / 🌤️ день / 🌙 вечер. Не обсуждай качество фото."
     )
-    rules_text = ("Правила персонализации:\n- " + "\n- ".join(rules)) if rules else \
-                 "Правила персонализации: нет особых ограничений."
-    return human, base + "\n" + rules_text
+    return human, base + "\n" + RULES.block(pr)
 
-# ========== АНАЛИЗ ФОТО ==========
-LAST_ANALYSIS_AT: Dict[int,float] = {}
+# ---------- Фоновые задачи ----------
+_BG_TASKS: set[asyncio.Task] = set()
+
+def _bg_done(t: asyncio.Task) -> None:
+    _BG_TASKS.discard(t)
+    if not t.cancelled() and t.exception() is not None:
+        log.error("background task %s failed", t.get_name(), exc_info=t.exception())
+
+def spawn_bg(coro) -> asyncio.Task:
+    """Корутину — отдельной задачей, не дожидаясь; ссылку держим до завершения, ошибку пишем в лог."""
+    t = asyncio.create_task(coro)
+    _BG_TASKS.add(t); t.add_done_callback(_bg_done)
+    return t
+
+def run_bg(fn, *args) -> asyncio.Task:
+    """Синхронную функцию (Sheets, диск) — в поток, не дожидаясь."""
+    return spawn_bg(asyncio.to_thread(fn, *args))
 
-# ===== REPLACE WHOLE FUNCTION _process_image_bytes WITH THIS ONE =====
+# ========== АНАЛИЗ ФОТО ==========
+# фото -> очередь (JOBS, SQLite) -> воркер: подготовка, предпроверка, Gemini, миниатюра для истории
+#      -> JOB_PUMP в боте: списание лимита, ответ, история и Sheets. Переживает перезапуск на любом шаге.
 LAST_ANALYSIS_AT: Dict[int, float] = {}
 
-async def _process_image_bytes(
+def _prep_image(b: bytes):
+    """JPEG для модели (не больше IMAGE_MAX_SIDE), серая миниатюра для prescreen и исходный размер."""
+    from PIL import Image
+    import numpy as np
+    im = Image.open(io.BytesIO(b))
+    orig_size = im.size  # до draft: после него size уже уменьшенный
+    im.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))  # JPEG сразу декодируется в 1/2..1/8 размера
+    if im.mode != "RGB": im = im.convert("RGB")
+    im.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85, optimize=True)
+    return buf.getvalue(), np.asarray(im.convert("L")), orig_size
+
+def _prescreen_limits() -> Dict[str, int]:
+    """Пороги из листа limits_prices (ключи prescreen_*), без справочников — встроенные. Зовётся из потока."""
+    if not REF.configured: return prescreen.DEFAULTS
+    return {k: REF.get_limit(k, v) for k, v in prescreen.DEFAULTS.items()}
+
+def analysis_job(payload: Dict[str, Any], img_bytes: bytes):
+    """
+    Обработчик задания в воркере (отдельный процесс или поток): всё, что нужно, — в payload,
+    состояние бота (USAGE, REF, RULES) здесь не читается. Исключение — задание failed.
+    """
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+    try:
+        jpeg_bytes, gray, orig_size = _prep_image(img_bytes)
+    except Exception as e:
+        log.warning("job prep failed: %s", e)
+        return {"error": "prep"}, None
+    img_bytes = None
+    t1 = time.perf_counter(); timings["prep"] = t1 - t0
+
+    # предпроверка: явно негодное фото отклоняем сразу — без вызова модели и без списания лимита
+    limits = payload.get("limits") or prescreen.DEFAULTS
+    verdict = prescreen.check(gray, orig_size, limits)
+    gray = None
+    t2 = time.perf_counter(); timings["prescreen"] = t2 - t1
+    if not verdict.ok:
+        return {"rejected": verdict.reason, "message": verdict.message(limits), "stats": verdict.stats,
+                "timings": timings}, None
+
+    b64 = base64.b64encode(jpeg_bytes).decode("utf-8")
+    payload_ = [payload["prompt"], {"inline_data": {"mime_type": "image/jpeg", "data": b64}}]
+    resp = gemini_model().generate_content(payload_)
+    text = (getattr(resp, "text", "") or "").strip() or "Ответ пустой."
+    t3 = time.perf_counter(); timings["gemini"] = t3 - t2
+    thumb = make_thumbnail(jpeg_bytes, HISTORY_THUMB_PX) if HISTORY_ENABLED else None
+    timings["thumbnail"] = time.perf_counter() - t3
+    return {"text": text, "jpeg_bytes": len(jpeg_bytes), "timings": timings}, thumb
+
+async def _send_limit_reached(chat):
+    return await chat.send_message(
+        "🚫 Лимит исчерпан. Оформи 🌟 Премиум.",
+        reply_markup=InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton("🌟 Купить Премиум", callback_data="premium")],
+                [InlineKeyboardButton("ℹ️ Лимиты", callback_data="limits")],
+            ]
+        ),
+    )
+
+def _style_response(raw_text: str, mode: str, human_profile: str) -> str:
+    txt = _emoji_bullets(raw_text.strip().replace("\r", "\n"))
+    txt = _themed_headings(txt)
+    head = f"<b>💄 Beauty Nano — {MODES.get(mode, 'Анализ')}</b>\n"
+    badge = f"<i>ℹ️ Профиль: {html_escape(human_profile)}</i>\n" if human_profile else ""
+    sep = "━━━━━━━━━━━━━━━━\n"
+    tail = "\n<i>Готово! Пришли новое фото или измени режим ниже.</i>"
+    return head + badge + sep + txt + tail
+
+async def _enqueue_analysis(
     chat,
     img_bytes: bytes,
-    mode: str,
-    user_data: dict,
-    user_id: int,
+    ctx: UserContext,
     username: str | None,
+    file_id: str | None = None,
 ):
-    """Подготовка фото, формирование персонализированного промпта и вызов Gemini."""
-    # лимит бесплатных попыток
-    if not check_usage(user_id):
-        return await chat.send_message(
-            "🚫 Лимит исчерпан. Оформи 🌟 Премиум.",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("🌟 Купить Премиум", callback_data="premium")],
-                    [InlineKeyboardButton("ℹ️ Лимиты", callback_data="limits")],
-                ]
-            ),
-        )
+    """Лимит, персонализированный промпт и постановка фото в очередь; ответ пришлёт _deliver_job."""
+    # лимит бесплатных попыток: здесь только проверяем, списываем при доставке готового анализа
+    if not ctx.can_analyze:
+        return await _send_limit_reached(chat)
 
-    # мягкая подсказка заполнить профиль, если пустой
-    pr = get_profile(user_data)
-    if not any(pr.get(k) for k in ("age", "skin", "hair", "goals")):
-        try:
-            await chat.send_message(
-                "Хочешь более точные рекомендации? Заполни короткий профиль 🧑‍💼",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🧑‍💼 Заполнить профиль", callback_data="profile")]]
-                ),
-            )
-        except Exception:
-            pass
+    # мягкая подсказка заполнить профиль, если пустой — строкой в последнем сообщении ответа
+    pr = ctx.profile
+    profile_hint = not any(pr.get(k) for k in ("age", "skin", "hair", "goals"))
+    user_id, mode = ctx.uid, ctx.mode
 
-    # подготовка изображения
+    # персональные правила из профиля
+    with TRACER.span("profile_context"):
+        human_profile, rule_block = _profile_context(ctx.user_data)
+    system_prompt = (
+        "Ты бьюти-ассистент. Проанализируй фото в контексте режима: "
+        f"{mode}. Учитывай анкету пользователя и правила ниже.\n\n"
+        f"{rule_block}"
+    )
     try:
-        def _prep(b: bytes) -> bytes:
-            im = Image.open(io.BytesIO(b)).convert("RGB")
-            im.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
-            buf = io.BytesIO()
-            im.save(buf, format="JPEG", quality=85, optimize=True)
-            return buf.getvalue()
-
-        jpeg_bytes = await asyncio.to_thread(_prep, img_bytes)
+        with stage("enqueue", image_bytes=len(img_bytes)) as sp:
+            job = {
+                "user_id": user_id, "chat_id": chat.id, "username": username, "mode": mode, "file_id": file_id,
+                "human_profile": human_profile, "profile_hint": profile_hint, "prompt": system_prompt,
+                "profile": {k: pr.get(k) for k in ("age", "skin", "hair", "goals")},
+                "limits": await asyncio.to_thread(_prescreen_limits),
+            }
+            job_id = await asyncio.to_thread(JOBS.put, job, img_bytes)
+            sp.set(job_id=job_id)
     except Exception:
-        log.exception("PIL convert")
-        return await chat.send_message("Не удалось обработать фото. Попробуй другое.")
-
-    # персональные правила из профиля
-    human_profile, rule_block = _profile_context(user_data)
-
-    # сбор промпта + вызов модели
+        M_ERRORS.inc(kind="enqueue")
+        log.exception("job enqueue")
+        return await chat.send_message("Не удалось обработать фото. Попробуй ещё раз.")
+    if JOB_PUMP: JOB_PUMP.notify()
+
+async def _deliver_job(job: Dict[str, Any], bot) -> None:
+    """Готовое задание -> пользователю. Каждый шаг сдвигает статус, повтор после сбоя продолжает с него."""
+    with user_scope():  # списание лимита попадает в USAGE до записи в Sheets
+        if not await _deliver_answer(job, bot):
+            return
+    # история и Sheets: ответ уже у пользователя, но задание закрываем только после них
+    p, r = job["payload"], job["result"]
+    await asyncio.to_thread(save_history, p["user_id"], p["mode"], None, r["text"], p.get("file_id"), job.get("blob"))
+    await asyncio.to_thread(sheets_log_analysis, p["user_id"], p.get("username"), p["mode"], r["text"])
+    await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+
+async def _deliver_answer(job: Dict[str, Any], bot) -> bool:
+    """Ответ пользователю; True — анализ отправлен (или уже был), остались история и Sheets."""
+    p, r = job["payload"], job["result"]
+    uid = p["user_id"]
+    chat = Chat(p["chat_id"], Chat.PRIVATE); chat.set_bot(bot)
+    if job["status"] != "sent":
+        for name in ("prep", "prescreen", "gemini", "thumbnail"):
+            if name in r.get("timings", {}): M_STAGE.observe(r["timings"][name], stage=name)
+        if job.get("started_at"): M_STAGE.observe(job["started_at"] - job["created_at"], stage="queue_wait")
     try:
-        b64 = base64.b64encode(jpeg_bytes).decode("utf-8")
-
-        system_prompt = (
-            "Ты бьюти-ассистент. Проанализируй фото в контексте режима: "
-            f"{mode}. Учитывай анкету пользователя и правила ниже.\n\n"
-            f"{rule_block}"
-        )
-
-        payload = [
-            system_prompt,
-            {"inline_data": {"mime_type": "image/jpeg", "data": b64}},
-        ]
-
-        resp = await asyncio.to_thread(model.generate_content, payload)
-        text = (getattr(resp, "text", "") or "").strip() or "Ответ пустой."
-        try:
-            # если у тебя есть фильтр качества фото — раскомментируй:
-            # text = remove_photo_tips(text)
-            pass
-        except Exception:
-            pass
-
-        # оформление ответа
-        def style_response(raw_text: str, mode: str) -> str:
-            txt = _emoji_bullets(raw_text.strip().replace("\r", "\n"))
-            txt = _themed_headings(txt)
-            head = f"<b>💄 Beauty Nano — {MODES.get(mode, 'Анализ')}</b>\n"
-            badge = f"<i>ℹ️ Профиль: {html_escape(human_profile)}</i>\n" if human_profile else ""
-            sep = "━━━━━━━━━━━━━━━━\n"
-            tail = "\n<i>Готово! Пришли новое фото или измени режим ниже.</i>"
-            return head + badge + sep + txt + tail
-
-        await send_html_long(chat, style_response(text, mode), keyboard=action_keyboard(user_id, user_data))
-
-        # логирование и история — не блокируем основной поток
-        asyncio.create_task(asyncio.to_thread(save_history, user_id, mode, jpeg_bytes, text))
-        asyncio.create_task(asyncio.to_thread(sheets_log_analysis, user_id, username, mode, text))
-
-        await chat.send_message(get_usage_text(user_id))
-    except Exception as e:
-        log.exception("Gemini error")
-        await chat.send_message(f"Ошибка анализа: {e}")
-# ===== END OF REPLACEMENT =====
+        if job["status"] == "failed":
+            M_ERRORS.inc(kind="analysis")
+            await chat.send_message(f"Ошибка анализа: {job.get('error') or 'неизвестная ошибка'}")
+            await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+            return False
+        if r.get("error") == "prep":
+            M_ERRORS.inc(kind="prep")
+            await chat.send_message("Не удалось обработать фото. Попробуй другое.")
+            await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+            return False
+        if r.get("rejected"):
+            M_PRESCREEN_REJECTED.inc(reason=r["rejected"])
+            log.info("prescreen: user %s photo rejected (%s) %s", uid, r["rejected"], r.get("stats"))
+            LAST_ANALYSIS_AT.pop(uid, None)  # переснять и прислать можно сразу
+            await chat.send_message(r["message"])
+            await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+            return False
+        if job["status"] == "done":
+            ctx = user_ctx(uid)
+            # пока фото было в очереди, лимит мог уйти на другой анализ; часть ответа уже ушла — доотправляем
+            if not job.get("sent_parts") and not ctx.can_analyze:
+                await _send_limit_reached(chat)
+                await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+                return False
+            with stage("format"):
+                html = _style_response(r["text"], p["mode"], p.get("human_profile") or "")
+            # подсказка про профиль и строка лимитов — в том же сообщении, что и конец ответа;
+            # лимит списывается только после отправки, строка показывает остаток уже с этим анализом
+            tail = html_escape(ctx.usage_text(pending=1))
+            if p.get("profile_hint"):
+                tail = "<i>Хочешь более точные рекомендации? Заполни короткий профиль — кнопка «🧑‍💼 Профиль».</i>\n" + tail
+            with stage("recommend"):
+                recs = _recommend_html(p.get("profile") or {}, r["text"])
+            if recs: tail = recs + "\n\n" + tail
+            with stage("send", html_chars=len(html)):
+                await send_html_long(chat, html, keyboard=action_keyboard(uid), tail=tail,
+                                     start=job.get("sent_parts") or 0,
+                                     on_sent=lambda n: asyncio.to_thread(JOBS.sent_part, job["id"], n))
+            STATS.analysis(p["mode"])
+            # статус sent, потом списание: повтор доставки после этой строки видит sent и не списывает второй раз
+            await asyncio.to_thread(JOBS.mark, job["id"], "sent")
+            ctx.charge()
+    except Forbidden:
+        log.info("job %s: user %s blocked the bot", job["id"], uid)
+        await asyncio.to_thread(JOBS.mark, job["id"], "delivered")
+        return False
+    return True
 
 
 async def on_photo(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    uid=update.effective_user.id; ensure_user(uid)
+    uid=update.effective_user.id; ensure_user(uid, update.effective_user.username)
+    ctx=user_ctx(uid, context.user_data)
     now=time.time()
     if now-LAST_ANALYSIS_AT.get(uid,0)<RATE_LIMIT_SECONDS:
+        M_RATE_LIMITED.inc()
         return await update.message.reply_text("Подожди пару секунд ⏳")
     LAST_ANALYSIS_AT[uid]=now
-    file=await update.message.photo[-1].get_file()
-    buf=io.BytesIO(); await file.download_to_memory(out=buf)
-    await _process_image_bytes(
-        update.effective_chat, buf.getvalue(),
-        get_mode(context.user_data), context.user_data, uid,
-        getattr(update.effective_user,"username",None)
-    )
+    TRACER.current().set(mode=ctx.mode)
+    if JOB_PUMP and JOB_PUMP.queued>=JOB_QUEUE_MAX:
+        M_IMAGE_DEFERRED.inc()
+        LAST_ANALYSIS_AT.pop(uid, None)
+        return await update.message.reply_text("Сейчас много фото в обработке 🙏 Пришли это фото ещё раз через минуту.")
+    ph=update.message.photo[-1]
+    # бюджет памяти — на скачанные байты до записи в очередь (анализ идёт в воркере)
+    need=estimate_image_bytes(ph.file_size, ph.width, ph.height)
+    try:
+        with stage("mem_wait", need_bytes=need, used_bytes=MEMBUDGET.used):
+            mem=await MEMBUDGET.reserve(need, timeout=IMAGE_MEM_WAIT_SEC)
+    except BudgetExhausted:
+        M_IMAGE_DEFERRED.inc()
+        LAST_ANALYSIS_AT.pop(uid, None)  # лимит не списан, повторить можно сразу
+        return await update.message.reply_text("Сейчас много фото в обработке 🙏 Пришли это фото ещё раз через минуту.")
+    async with mem:
+        with M_ANALYSES_IN_FLIGHT.track():
+            try:
+                with stage("download") as sp:
+                    file=await ph.get_file()
+                    buf=io.BytesIO(); await file.download_to_memory(out=buf)
+                    sp.set(image_bytes=buf.tell())
+            except Exception:
+                M_ERRORS.inc(kind="download")
+                log.exception("photo download")
+                return await update.message.reply_text("Не удалось скачать фото. Попробуй ещё раз.")
+            img=buf.getvalue(); buf=None
+            mem.shrink(queued_image_bytes(len(img)))  # оценка была с запасом — лишнее сразу другим
+            await _enqueue_analysis(
+                update.effective_chat, img, ctx,
+                getattr(update.effective_user,"username",None),
+                file_id=ph.file_id,
+            )
 
 # ---------- Стиль/текст (хелперы) ----------
 SAFE_CHUNK = 3500
@@ -362,33 +711,103 @@ def _emoji_bullets(text: str) -> str:
     return "\n".join(out)
 
 # --- YooKassa helpers ---
-from yookassa import Configuration as YKConf, Payment as YKPayment
-import uuid
+YK_LEDGER: PaymentLedger | None = None   # создаётся в bootstrap()
+YK_WORKER: PaymentWorker | None = None
+JOBS: JobQueue | None = None      # создаётся в bootstrap()
+JOB_PUMP: JobPump | None = None   # воркеры и доставка — в _post_init
+_yk_client: YooKassaClient | None = None
+
+def yk_configured() -> bool:
+    return bool(YK_SHOP_ID and YK_SECRET_KEY)
+
+def yk_client() -> YooKassaClient:
+    """Один пул соединений на весь процесс."""
+    global _yk_client
+    if not yk_configured():
+        raise RuntimeError("YooKassa не настроена")
+    if _yk_client is None:
+        _yk_client = YooKassaClient(YK_SHOP_ID, YK_SECRET_KEY)
+    return _yk_client
 
-def yk_create_first_payment(user_id: int, amount_rub: int) -> str:
+async def yk_create_first_payment(user_id: int, amount_rub: int) -> str:
     """
     Создаёт оплату в YooKassa и возвращает URL для подтверждения.
     Если YK_SHOP_ID / YK_SECRET_KEY не заданы — бросит RuntimeError.
     """
-    if not (os.getenv("YK_SHOP_ID") and os.getenv("YK_SECRET_KEY")):
-        raise RuntimeError("YooKassa не настроена")
-    YKConf.account_id = os.getenv("YK_SHOP_ID")
-    YKConf.secret_key = os.getenv("YK_SECRET_KEY")
+    payment = await yk_client().create_payment(user_id, amount_rub, YK_RETURN_URL)
+    return payment["confirmation"]["confirmation_url"]
 
-    idemp = str(uuid.uuid4())
-    payment = YKPayment.create({
-        "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
-        "capture": True,
-        "confirmation": {"type": "redirect", "return_url": os.getenv("YK_RETURN_URL", "https://example.com/yk/success")},
-        "save_payment_method": True,  # попросим сохранить карту для автопродления
-        "description": f"Beauty Nano Premium 30d (uid {user_id})",
-        "metadata": {"user_id": str(user_id), "purpose": "premium_monthly", "first": "1"},
-    }, idempotency_key=idemp)
-    return payment.confirmation.confirmation_url
+async def yk_on_succeeded(payment: Dict[str, Any], bot) -> None:
+    """
+    Платёж подтверждён API ЮKassa (вызывает PaymentWorker). После сбоя PaymentWorker зовёт снова —
+    grant_premium запоминает payment_id вместе с начислением, второго начисления нет.
+    """
+    uid = int((payment.get("metadata") or {}).get("user_id") or 0)
+    if not uid:
+        log.warning("yk payment %s without user_id", payment.get("id")); return
+    pid = str(payment.get("id") or "")
+    u = usage_entry(uid)
+    if pid and pid in u.get("yk_granted", []):
+        till = int(u.get("premium_until", 0))
+    else:
+        till = grant_premium(uid, 30, payment_id=pid)
+        STATS.conversion("yk" if (payment.get("metadata") or {}).get("first") != "0" else "yk_renew")
+    pm = payment.get("payment_method") or {}
+    if pm.get("saved") and pm.get("id"):
+        usage_entry(uid)["yk_payment_method_id"] = pm["id"]; persist("usage"); sched_track(uid)
+    try:
+        await bot.send_message(uid, f"✅ Оплата получена. Премиум активен до {datetime.fromtimestamp(till):%d.%m.%Y}.")
+    except Exception as e:
+        log.warning("yk notify %s failed: %s", uid, e)
+
+async def yk_on_failed(payment: Dict[str, Any], error: str, bot) -> None:
+    """Деньги списаны, начислить премиум не вышло за все попытки — админам, разбирать руками."""
+    uid = (payment.get("metadata") or {}).get("user_id")
+    text = (f"⚠️ ЮKassa: платёж {payment.get('id')} (uid {uid}, {(payment.get('amount') or {}).get('value')} ₽) "
+            f"оплачен, но премиум не начислен.\n{error}")
+    for admin in list(ADMINS):
+        with suppress(Exception):
+            await bot.send_message(admin, text)
+
+
+# --- Планировщик подписок ---
+SCHED = PremiumScheduler(remind_before=PREMIUM_REMIND_DAYS*86400, renew_before=PREMIUM_RENEW_BEFORE_SEC,
+                         batch=SCHED_BATCH, renew_retry_sec=PREMIUM_RENEW_RETRY_SEC)
+
+async def _sched_remind(bot, uid:int, until:int):
+    u=USAGE.get(uid) or {}
+    auto=u.get("yk_payment_method_id") or (u.get("stars_charge_id") and not u.get("stars_auto_canceled"))
+    tail="Продлим автоматически 💳" if auto else "Продли, чтобы не потерять безлимит 🌟"
+    with suppress(Exception):
+        await bot.send_message(uid, f"⏳ Премиум действует до {datetime.fromtimestamp(until):%d.%m.%Y %H:%M}. {tail}",
+                               reply_markup=None if auto else premium_menu_kb())
+
+async def _sched_renew(bot, uid:int, until:int):
+    pm=(USAGE.get(uid) or {}).get("yk_payment_method_id")
+    if not (pm and yk_configured()): return
+    # ключ идемпотентности привязан к сроку — повтор события не спишет деньги дважды
+    p=await yk_client().create_recurring_payment(uid, int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB)), pm,
+                                                 idempotency_key=f"renew-{uid}-{until}")
+    if await asyncio.to_thread(YK_LEDGER.add, "payment.renew", p) and YK_WORKER:
+        YK_WORKER.notify()
+
+async def _sched_expire(bot, uid:int, until:int):
+    u=usage_entry(uid)
+    if int(u.get("premium_until",0))!=until: return
+    u["premium"]=False; persist("usage"); USERDIR.set_flag(uid, DIR_PREMIUM, False)
+    with suppress(Exception):
+        await bot.send_message(uid, "Премиум закончился. Бесплатные анализы снова по лимиту.",
+                               reply_markup=premium_menu_kb())
+
+def _sched_bootstrap(bot):
+    SCHED.handlers={REMIND: lambda uid, t: _sched_remind(bot, uid, t),
+                    RENEW:  lambda uid, t: _sched_renew(bot, uid, t),
+                    EXPIRE: lambda uid, t: _sched_expire(bot, uid, t)}
+    for uid in list(USAGE):
+        if int(USAGE[uid].get("premium_until",0)): sched_track(uid)
 
 
 # --- Telegram Stars helpers ---
-from telegram import LabeledPrice
 
 STARS_PRICE_XTR = int(os.getenv("STARS_PRICE_XTR", "1200"))
 STARS_PAY_TITLE = os.getenv("STARS_PAY_TITLE", "Премиум на 30 дней")
@@ -406,65 +825,65 @@ async def send_stars_invoice_chat(chat_id: int, context):
         subscription_period=2592000  # 30 дней
     )
 
-    # --- Promos (Google Sheets) ---
-    def sheets_promo_get(code: str) -> dict | None:
-        """
-        Ищет промокод в листе 'promos'.
-        Ожидаемые колонки: code | bonus_days | uses_left | expires_ts | note
-        Возвращает dict строки или None, если промокод не найден/Sheets не настроены.
-        """
-        if not ('_sh' in globals() and _sh):
-            return None
-        try:
-            ws = _sh.worksheet("promos")
-            rows = ws.get_all_records(numericise_ignore=["all"])
-            code_l = (code or "").strip().lower()
-            for r in rows:
-                if (str(r.get("code") or "").strip().lower()) == code_l:
-                    return r
-        except Exception as e:
-            log.warning("sheets_promo_get failed: %s", e)
+# --- Promos (Google Sheets) ---
+def sheets_promo_get(code: str) -> dict | None:
+    """
+    Ищет промокод в листе 'promos'.
+    Ожидаемые колонки: code | bonus_days | uses_left | expires_ts | note
+    Возвращает dict строки или None, если промокод не найден/Sheets не настроены.
+    """
+    if not _sh:
         return None
+    try:
+        ws = _sh.worksheet("promos")
+        rows = ws.get_all_records(numericise_ignore=["all"])
+        code_l = (code or "").strip().lower()
+        for r in rows:
+            if (str(r.get("code") or "").strip().lower()) == code_l:
+                return r
+    except Exception as e:
+        log.warning("sheets_promo_get failed: %s", e)
+    return None
 
-    def sheets_promo_decrement(code: str) -> bool:
-        """
-        Уменьшает uses_left на 1 для указанного промокода в листе 'promos'.
-        Возвращает True, если успешно; False — если лист недоступен/промокод не найден.
-        """
-        if not ('_sh' in globals() and _sh):
-            return False
-        try:
-            ws = _sh.worksheet("promos")
-            data = ws.get_all_values()  # первая строка — заголовки
-            # ожидаемый порядок: code | bonus_days | uses_left | expires_ts | note
-            for i in range(1, len(data)):
-                row = data[i]
-                if (row[0] or "").strip().lower() == (code or "").strip().lower():
-                    try:
-                        uses = int(row[2]) if str(row[2]).strip().isdigit() else 0
-                        if uses <= 0:
-                            return False
-                        row[2] = str(uses - 1)
-                        ws.update(f"A{i + 1}:E{i + 1}", [row])
-                        return True
-                    except Exception as e:
-                        log.warning("promo decrement parse error: %s", e)
-                        return False
-        except Exception as e:
-            log.warning("sheets_promo_decrement failed: %s", e)
+def sheets_promo_decrement(code: str) -> bool:
+    """
+    Уменьшает uses_left на 1 для указанного промокода в листе 'promos'.
+    Возвращает True, если успешно; False — если лист недоступен/промокод не найден.
+    """
+    if not _sh:
         return False
+    try:
+        ws = _sh.worksheet("promos")
+        data = ws.get_all_values()  # первая строка — заголовки
+        # ожидаемый порядок: code | bonus_days | uses_left | expires_ts | note
+        for i in range(1, len(data)):
+            row = data[i]
+            if (row[0] or "").strip().lower() == (code or "").strip().lower():
+                try:
+                    uses = int(row[2]) if str(row[2]).strip().isdigit() else 0
+                    if uses <= 0:
+                        return False
+                    row[2] = str(uses - 1)
+                    ws.update(f"A{i + 1}:E{i + 1}", [row])
+                    return True
+                except Exception as e:
+                    log.warning("promo decrement parse error: %s", e)
+                    return False
+    except Exception as e:
+        log.warning("sheets_promo_decrement failed: %s", e)
+    return False
 
 
 # --- Промокоды / триал ---
 USER_STATE: dict[int, dict] = {}  # если уже есть — оставь один
 
-def apply_promo(user_id: int, code: str) -> str:
+async def apply_promo(user_id: int, code: str) -> str:
     """
     Пробуем применить промокод из Google Sheets (если подключены),
     иначе — встроенные «free1d».
     Возвращает текст результата для пользователя.
     """
-    rec = sheets_promo_get(code) if '_sh' in globals() and _sh else None
+    rec = await asyncio.to_thread(sheets_promo_get, code) if _sh else None
     if rec:
         try:
             exp   = int(rec.get("expires_ts") or "0")
@@ -475,15 +894,15 @@ def apply_promo(user_id: int, code: str) -> str:
             if uses <= 0:
                 return "❌ Промокод уже исчерпан."
             if days > 0:
-                grant_premium(user_id, days)
-                sheets_promo_decrement(code)
+                grant_premium(user_id, days); STATS.conversion("promo")
+                await asyncio.to_thread(sheets_promo_decrement, code)
                 return f"✅ Активирован {days} дн. Премиума!"
             return "ℹ️ Промокод валиден, но бонус не задан."
         except Exception:
             return "⚠️ Не удалось применить промокод."
     # встроенный пример
     if code.strip().lower() == "free1d":
-        grant_premium(user_id, 1)
+        grant_premium(user_id, 1); STATS.conversion("promo")
         return "✅ 1 день Премиума активирован."
     return "❌ Промокод не найден."
 
@@ -530,15 +949,19 @@ async def safe_answer(q):
         await q.answer(cache_time=1)
 
 
-async def send_html_long(chat, html_text:str, keyboard=None):
-    chunks=_split_chunks(html_text, SAFE_CHUNK)
-    if not chunks: return
-    for part in chunks[:-1]:
-        try: await chat.send_message(part, parse_mode="HTML")
-        except BadRequest: await chat.send_message(re.sub(r"<[^>]+>","",part))
-    last=chunks[-1]
-    try: await chat.send_message(last, parse_mode="HTML", reply_markup=keyboard)
-    except BadRequest: await chat.send_message(re.sub(r"<[^>]+>","",last), reply_markup=keyboard)
+async def send_html_long(chat, html_text:str, keyboard=None, tail:str|None=None, start:int=0, on_sent=None):
+    """
+    Ответ частями по SAFE_CHUNK; короткий tail (HTML) дописывается к последней части, если влезает.
+    start — сколько частей уже отправлено (повтор после сбоя), on_sent(n) — после каждой отправленной.
+    """
+    chunks=append_tail(_split_chunks(html_text, SAFE_CHUNK), tail)
+    for i in range(start, len(chunks)):
+        part=chunks[i]; last=i==len(chunks)-1
+        kb=keyboard if last else None
+        with TRACER.span("tg.send", chars=len(part), last=last):
+            try: await chat.send_message(part, parse_mode="HTML", reply_markup=kb)
+            except BadRequest: await chat.send_message(re.sub(r"<[^>]+>","",part), reply_markup=kb)
+        if on_sent: await on_sent(i+1)
 
 
 # ---------- Режимы ----------
@@ -563,41 +986,96 @@ def mode_keyboard(active: str) -> InlineKeyboardMarkup:
     ])
 
 # ---------- История (локально + Sheets) ----------
-def _hist_user_dir(uid:int)->str:
-    p=os.path.join(HISTORY_DIR,str(uid)); os.makedirs(p,exist_ok=True); return p
+# записи пользователя — в одном history/<uid>.pack (миниатюра + сжатый текст), см. histstore.py
+HSTORE = HistoryStore(HISTORY_DIR, thumb_px=HISTORY_THUMB_PX)
 
-def save_history(uid:int, mode:str, jpeg_bytes:bytes, text:str)->None:
+def save_history(uid:int, mode:str, jpeg_bytes:bytes|None, text:str, file_id:str|None=None, thumb:bytes|None=None)->None:
+    """thumb — готовая миниатюра (её делает воркер анализа), иначе строится из jpeg_bytes."""
     if not HISTORY_ENABLED: return
+    with TRACER.span("history.save", image_bytes=len(thumb or jpeg_bytes or b"")):
+        _save_history(uid, mode, jpeg_bytes, text, file_id, thumb)
+
+def _save_history(uid:int, mode:str, jpeg_bytes:bytes|None, text:str, file_id:str|None=None, thumb:bytes|None=None)->None:
     try:
-        ts=int(time.time()); udir=_hist_user_dir(uid)
-        img=os.path.join(udir,f"{ts}.jpg"); txt=os.path.join(udir,f"{ts}.txt")
-        with open(img,"wb") as f: f.write(jpeg_bytes)
-        with open(txt,"w",encoding="utf-8") as f: f.write(text)
-        key=str(uid); items=HISTORY.get(key,[])
-        items.append({"ts":ts,"mode":mode,"img":img,"txt":txt})
-        items=sorted(items,key=lambda x:x["ts"],reverse=True)[:HISTORY_LIMIT]
-        HISTORY[key]=items; persist_all()
+        ts=HSTORE.add(uid, int(time.time()), jpeg_bytes, text, thumb=thumb)  # два анализа за секунду — разные ключи
+        entry={"ts":ts,"mode":mode}
+        if file_id: entry["file_id"]=file_id  # исходное фото уже лежит у Telegram — при просмотре шлём по id
+        STATE.submit(_history_add, str(uid), entry)
     except Exception as e: log.warning("history save failed: %s", e)
 
+def _history_add(key:str, entry:Dict[str,Any])->None:
+    # выполняется в event loop (команда StateWriter)
+    items=sorted(HISTORY.get(key,[])+[entry],key=lambda x:x["ts"],reverse=True)
+    HISTORY[key]=items[:HISTORY_LIMIT]
+    HCACHE.invalidate(int(key))
+    persist("history")
+    if len(items)>HISTORY_LIMIT:
+        _history_gc(int(key), [int(e["ts"]) for e in HISTORY[key]])
+
+def _history_set_file_id(uid:int, ts:int, file_id:str|None)->None:
+    for e in HISTORY.get(str(uid), []):
+        if int(e["ts"])==ts:
+            if file_id: e["file_id"]=file_id
+            else: e.pop("file_id", None)
+            persist("history"); break
+    v=HCACHE.view(uid)
+    if v and ts in v.by_ts:
+        v.by_ts[ts]["file_id"]=file_id
+
+def _history_gc(uid:int, keep:List[int])->None:
+    try: asyncio.get_running_loop()
+    except RuntimeError: return HSTORE.retain(uid, keep)  # StateWriter не запущен — мы и так в потоке
+    run_bg(HSTORE.retain, uid, keep)
+
+async def _history_migrate()->None:
+    """Разовая упаковка старой раскладки history/<uid>/<ts>.jpg|.txt; после неё каталогов не остаётся."""
+    if not await asyncio.to_thread(lambda: any(os.path.isdir(os.path.join(HISTORY_DIR, n)) for n in os.listdir(HISTORY_DIR))):
+        return
+    snap={k:[dict(e) for e in v] for k,v in HISTORY.items()}
+    moved, skipped=await asyncio.to_thread(HSTORE.migrate_legacy, snap)
+    for key, done in moved.items():
+        done=set(done)
+        for e in HISTORY.get(key, []):
+            if int(e["ts"]) in done:
+                e.pop("img", None); e.pop("txt", None)
+        HCACHE.invalidate(int(key))
+    for key, lost in skipped.items():
+        # текста не было уже на диске, каталог удалён — в списке осталась бы битая кнопка
+        lost=set(lost)
+        HISTORY[key]=[e for e in HISTORY.get(key, []) if int(e["ts"]) not in lost]
+        HCACHE.invalidate(int(key))
+    persist("history")
+    log.info("history migrated: %d users, %d entries; dropped %d entries without text",
+             len(moved), sum(len(v) for v in moved.values()), sum(len(v) for v in skipped.values()))
+
+_gc = None
+_sh = None
+SHEETS_LAYOUT = {
+    "users":    ["ts","user_id","username","is_admin","premium"],
+    "analyses": ["ts","user_id","username","mode","premium","free_used","text"],
+    "feedback": ["ts","user_id","value"],
+    "promos":   ["code","bonus_days","uses_left","expires_ts","note"],
+}
+
 def sheets_init():
     global _gc,_sh
     if not SHEETS_ENABLED: return
     if not SPREADSHEET_ID or not SERVICE_JSON_B64:
         log.warning("Sheets env missing"); return
+    import gspread
+    from google.oauth2.service_account import Credentials
     try:
         creds_info=json.loads(base64.b64decode(SERVICE_JSON_B64))
         scopes=["https://www.googleapis.com/auth/spreadsheets"]
         credentials=Credentials.from_service_account_info(creds_info, scopes=scopes)
-        _gc=gspread.authorize(credentials); _sh=_gc.open_by_key(SPREADSHEET_ID)
-        def _ensure_ws(title: str, headers: List[str]):
-            try: return _sh.worksheet(title)
-            except gspread.WorksheetNotFound:
-                ws=_sh.add_worksheet(title=title, rows="200", cols=str(max(20, len(headers)+5)))
-                ws.append_row(headers); return ws
-        _ensure_ws("users",    ["ts","user_id","username","is_admin","premium"])
-        _ensure_ws("analyses", ["ts","user_id","username","mode","premium","free_used","text"])
-        _ensure_ws("feedback", ["ts","user_id","value"])
-        _ensure_ws("promos",   ["code","bonus_days","uses_left","expires_ts","note"])
+        gc=gspread.authorize(credentials); sh=gc.open_by_key(SPREADSHEET_ID)
+        # список листов — одним запросом; создаём только недостающие
+        have={ws.title for ws in sh.worksheets()}
+        for title, headers in SHEETS_LAYOUT.items():
+            if title not in have:
+                ws=sh.add_worksheet(title=title, rows="200", cols=str(max(20, len(headers)+5)))
+                ws.append_row(headers)
+        _gc,_sh=gc,sh  # до конца инициализации остальной код видит «Sheets нет»
         log.info("Sheets connected")
     except Exception as e:
         log.exception("Sheets init failed: %s", e)
@@ -612,6 +1090,10 @@ def sheets_log_user(user_id:int, username:str|None):
 
 def sheets_log_analysis(user_id:int, username:str|None, mode:str, text:str):
     if not _sh: return
+    with TRACER.span("sheets.log_analysis"):
+        _sheets_log_analysis(user_id, username, mode, text)
+
+def _sheets_log_analysis(user_id:int, username:str|None, mode:str, text:str):
     try:
         u=USAGE.get(user_id, {})
         _sh.worksheet("analyses").append_row(
@@ -650,7 +1132,7 @@ def list_history(uid:int)->List[Dict[str,Any]]:
     remote=sheets_fetch_history(uid, limit=20) if _sh else []
     norm=[]
     for e in local:
-        norm.append({"ts":int(e["ts"]), "mode":e.get("mode","both"),
+        norm.append({"ts":int(e["ts"]), "mode":e.get("mode","both"), "packed":not e.get("txt"), "file_id":e.get("file_id"),
                      "img":e.get("img"), "txt":e.get("txt"), "txt_inline":None})
     for e in remote:
         norm.append({"ts":int(e["ts"]), "mode":e.get("mode","both"),
@@ -661,8 +1143,66 @@ def list_history(uid:int)->List[Dict[str,Any]]:
     items=sorted(uniq.values(), key=lambda x:x["ts"], reverse=True)
     return items[:HISTORY_LIMIT]
 
-def history_keyboard(uid:int)->InlineKeyboardMarkup:
-    entries=list_history(uid)
+# представление истории (локальные + строки Sheets) собирается один раз и живёт в HCACHE
+# до следующего save_history; удалённую часть перечитываем не чаще раза в HISTORY_CACHE_TTL_SEC
+HCACHE = HistoryCache(ttl=HISTORY_CACHE_TTL_SEC)
+
+async def history_view(uid:int):
+    v=HCACHE.view(uid)
+    if v is not None:
+        M_CACHE_HITS.inc(cache="history_view"); return v
+    mark=HCACHE.begin(uid)  # пока читаем в потоке, _history_add может добавить свежий анализ
+    return HCACHE.put(uid, await asyncio.to_thread(list_history, uid), mark)
+
+def _read_file_text(path:str)->str:
+    try:
+        with open(path,"r",encoding="utf-8") as f: return f.read()
+    except Exception: return ""
+
+def _read_file_bytes(path:str)->bytes|None:
+    try:
+        with open(path,"rb") as f: return f.read()
+    except Exception: return None
+
+async def send_history_photo(chat, uid:int, entry:Dict[str,Any], caption:str)->None:
+    """Сначала по file_id (без выгрузки); если Telegram его не принял — заливаем миниатюру и запоминаем новый id."""
+    ts=int(entry["ts"]); fid=entry.get("file_id")
+    if fid:
+        try:
+            with TRACER.span("tg.send", what="history_photo", by="file_id"):
+                await chat.send_photo(photo=fid, caption=caption)
+            M_CACHE_HITS.inc(cache="tg_file_id"); return
+        except BadRequest as e:
+            log.info("history file_id rejected (%s/%s): %s", uid, ts, e)
+            _history_set_file_id(uid, ts, None)
+        except Exception as e:
+            log.warning("send_photo failed: %s", e); return
+    if entry.get("packed"): img = await asyncio.to_thread(HSTORE.read_image, uid, ts)
+    else: img = await asyncio.to_thread(_read_file_bytes, entry["img"]) if entry.get("img") else None
+    if not img: return
+    try:
+        with TRACER.span("tg.send", what="history_photo", by="upload", image_bytes=len(img)):
+            msg = await chat.send_photo(photo=img, caption=caption)
+        if msg.photo: _history_set_file_id(uid, ts, msg.photo[-1].file_id)
+    except Exception as e: log.warning("send_photo failed: %s", e)
+
+async def history_entry_html(uid:int, entry:Dict[str,Any])->str:
+    ts=int(entry["ts"])
+    html=HCACHE.rendered(uid, ts)
+    if html is not None:
+        M_CACHE_HITS.inc(cache="history_html"); return html
+    dt=datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")
+    mode_title={"face":"Лицо","hair":"Волосы","both":"Лицо + Волосы"}.get(entry.get("mode","both"),"Анализ")
+    head=f"<b>💄 История — {mode_title}</b>\n<i>{dt}</i>\n━━━━━━━━━━━━━━━━\n"
+    if entry.get("txt_inline"): text=entry["txt_inline"]
+    elif entry.get("packed"): text=await asyncio.to_thread(HSTORE.read_text, uid, ts)
+    else: text=await asyncio.to_thread(_read_file_text, entry.get("txt") or "")
+    text=text or "Текст отсутствует."
+    html=head+_themed_headings(_emoji_bullets(text))
+    HCACHE.put_rendered(uid, ts, html)
+    return html
+
+def history_keyboard(entries:List[Dict[str,Any]])->InlineKeyboardMarkup:
     if not entries:
         return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад",callback_data="home")]])
     rows=[]
@@ -674,55 +1214,93 @@ def history_keyboard(uid:int)->InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 # ---------- Пользователи/лимиты/цены ----------
+# на время апдейта (см. _around_update) пользователь резолвится один раз — user_ctx(); лимиты, премиум и
+# клавиатуры читают этот UserContext, изменения пишутся в USAGE одним commit в конце апдейта
+_USER_SCOPE: ContextVar[UserScope | None] = ContextVar("user_scope", default=None)
+
+def user_ctx(user_id:int, user_data:dict|None=None)->UserContext:
+    scope=_USER_SCOPE.get()
+    if scope is not None and scope.closed: scope=None  # фоновая задача пережила свой апдейт
+    ctx=scope.get(user_id) if scope is not None else None
+    if ctx is None:
+        ctx=UserContext.resolve(user_id, USAGE, free_limit(), user_id in ADMINS, user_data)
+        if scope is not None: scope[user_id]=ctx
+    elif user_data is not None and ctx.user_data is None:
+        ctx.user_data=user_data
+    return ctx
+
+def _user_changed(ctx:UserContext)->None:
+    # вне апдейта (доставка анализа, планировщик) общего commit не будет — пишем сразу
+    scope=_USER_SCOPE.get()
+    if (scope is None or scope.closed) and ctx.commit(USAGE): persist("usage")
+
+@contextmanager
+def user_scope():
+    """Контексты апдейта; в USAGE — только при нормальном выходе: упавшая доставка/хендлер ничего не списывает."""
+    scope=UserScope(); token=_USER_SCOPE.set(scope)
+    try: yield scope
+    except BaseException:
+        scope.closed=True; _USER_SCOPE.reset(token)
+        raise
+    scope.closed=True; _USER_SCOPE.reset(token)
+    if sum(ctx.commit(USAGE) for ctx in scope.values()): persist("usage")
+
 def usage_entry(user_id:int)->Dict[str,Any]:
-    now=datetime.utcnow(); m=now.month
-    u=USAGE.setdefault(user_id, {"count":0,"month":m,"premium":False})
-    if int(u.get("premium_until", 0)) < int(time.time()):
-        u["premium"] = False
-    if u.get("month")!=m: u["count"]=0; u["month"]=m
-    return u
+    """Запись USAGE для прямого изменения (платежи, админка): контекст апдейта сбрасывается в неё и забывается."""
+    scope=_USER_SCOPE.get()
+    ctx=scope.pop(user_id, None) if scope is not None and not scope.closed else None
+    if ctx is None:
+        ctx=UserContext.resolve(user_id, USAGE, free_limit(), user_id in ADMINS)
+    ctx.commit(USAGE)
+    return USAGE.setdefault(user_id, {"count":0,"month":ctx.month,"premium":False})
 
 def has_premium(user_id:int)->bool:
-    u=usage_entry(user_id)
-    if u.get("premium"): return True
-    pu=int(u.get("premium_until",0))
-    if pu and pu>int(time.time()):
-        u["premium"]=True; return True
-    return False
+    return user_ctx(user_id).premium
 
-def grant_premium(user_id:int, days:int=30):
+def grant_premium(user_id:int, days:int=30, payment_id:str|None=None):
     u=usage_entry(user_id)
     base=max(int(time.time()), int(u.get("premium_until",0)))
     till=base+days*24*3600
     u["premium"]=True; u["premium_until"]=till
-    persist_all(); return till
+    # платёж — в той же записи и тем же шагом: повтор обработки после сбоя ниже видит, что начислено
+    if payment_id: u["yk_granted"]=(u.get("yk_granted",[])+[payment_id])[-5:]
+    persist("usage"); sched_track(user_id); return till
+
+def sched_track(user_id:int):
+    """Сообщить планировщику актуальный premium_until пользователя."""
+    u=USAGE.get(user_id) or {}
+    USERDIR.set_flag(user_id, DIR_PREMIUM, int(u.get("premium_until",0)) > int(time.time()))
+    stars_auto=bool(u.get("stars_charge_id") and not u.get("stars_auto_canceled"))
+    SCHED.track(user_id, int(u.get("premium_until",0)),
+                grace=STARS_GRACE_SEC if stars_auto else 0,
+                renew=bool(u.get("yk_payment_method_id")))
 
 def extend_premium_days(user_id:int, days:int=30)->int:
     return grant_premium(user_id, days)
 
+def usage_allowed(user_id:int)->bool:
+    """Как check_usage, но без списания попытки."""
+    return user_ctx(user_id).can_analyze
+
 def check_usage(user_id:int)->bool:
-    u=usage_entry(user_id)
-    if has_premium(user_id): return True
-    limit=int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT))
-    if u["count"]<limit:
-        u["count"]+=1; persist_all(); return True
-    return False
+    ctx=user_ctx(user_id)
+    ok=ctx.charge()
+    _user_changed(ctx)
+    return ok
 
 def get_usage_text(user_id:int)->str:
-    u=usage_entry(user_id)
-    if has_premium(user_id):
-        exp=datetime.fromtimestamp(int(u.get("premium_until", time.time()))).strftime("%d.%m.%Y")
-        return f"🌟 Премиум активен до {exp}."
-    limit=int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT))
-    left=max(0, limit-u["count"])
-    return f"Осталось бесплатных анализов: {left} из {limit}."
+    return user_ctx(user_id).usage_text()
 
-def ensure_user(user_id:int):
-    if user_id not in USERS: USERS.add(user_id); persist_all()
+def ensure_user(user_id:int, username:str|None=None):
+    if user_id not in USERS:
+        USERS.add(user_id); USERDIR.add(user_id); persist("users"); STATS.new_user()
+    if username and USERNAMES.get(user_id)!=username:
+        USERNAMES[user_id]=username; USERDIR.set_username(user_id, username); persist("usernames")
 
 # ---------- Кнопки главные ----------
 def action_keyboard(for_user_id: int, user_data: dict | None = None) -> InlineKeyboardMarkup:
-    premium = has_premium(for_user_id)
+    ctx = user_ctx(for_user_id, user_data)
+    premium = ctx.premium
     rows: list[list[InlineKeyboardButton]] = [
         [InlineKeyboardButton("🔄 Новый анализ", callback_data="home")],
         [InlineKeyboardButton("⚙️ Режим", callback_data="mode_menu"),
@@ -736,7 +1314,7 @@ def action_keyboard(for_user_id: int, user_data: dict | None = None) -> InlineKe
         rows.append([InlineKeyboardButton("💳 Мои платежи", callback_data="payments_me")])
     else:
         rows.append([InlineKeyboardButton("🌟 Премиум", callback_data="premium")])
-    if for_user_id in ADMINS:
+    if ctx.is_admin:
         rows.append([InlineKeyboardButton("🛠 Администратор", callback_data="admin")])
     return InlineKeyboardMarkup(rows)
 
@@ -765,6 +1343,7 @@ def admin_main_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("🎁 Бонусы",      callback_data="admin:bonus"),
          InlineKeyboardButton("⚙️ Настройки",   callback_data="admin:settings")],
         [InlineKeyboardButton("🔄 Обновить справочники", callback_data="admin:reload_refs")],
+        [InlineKeyboardButton(f"🔥 Профилировать {PROFILE_SECONDS}с", callback_data="admin:profile")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="home")]
     ])
 
@@ -776,17 +1355,22 @@ def _user_short_row(u_id: int) -> str:
     if prem: badges.append("🌟")
     if adm:  badges.append("⭐")
     tag = " ".join(badges)
+    name = USERDIR.username(u_id)
+    who = f"{u_id} @{name}" if name else str(u_id)
     exp = datetime.fromtimestamp(u.get("premium_until",0)).strftime("%d.%m.%Y %H:%M") if u.get("premium_until") else "—"
-    return f"{u_id} • до {exp} {tag}".strip()
+    return f"{who} • до {exp} {tag}".strip()
 
-def admin_users_list_kb(page: int = 0, per_page: int = 10) -> InlineKeyboardMarkup:
-    ids = sorted(list(USERS))
-    total = len(ids)
-    start = max(0, page * per_page)
-    end   = min(total, start + per_page)
-    page_ids = ids[start:end]
+USER_FILTERS = {DIR_ALL: "Все", DIR_PREMIUM: "🌟 Премиум", DIR_ADMIN: "⭐ Админы"}
 
-    rows: list[list[InlineKeyboardButton]] = []
+def admin_users_list_kb(flt: str = DIR_ALL, after: int | None = None, before: int | None = None,
+                        per_page: int = 10) -> InlineKeyboardMarkup:
+    # страница по курсору из индекса USERDIR: O(log n + per_page)
+    page_ids, has_prev, has_next = USERDIR.page(flt, after=after, before=before, size=per_page)
+
+    rows: list[list[InlineKeyboardButton]] = [[
+        InlineKeyboardButton(("• " if k == flt else "") + title, callback_data=f"admin:users:{k}")
+        for k, title in USER_FILTERS.items()
+    ]]
     if not page_ids:
         rows.append([InlineKeyboardButton("Пока пусто", callback_data="noop")])
     else:
@@ -794,16 +1378,24 @@ def admin_users_list_kb(page: int = 0, per_page: int = 10) -> InlineKeyboardMark
             rows.append([InlineKeyboardButton(_user_short_row(uid), callback_data=f"admin:user:{uid}")])
 
     nav = []
-    if start > 0:
-        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin:users_page:{page-1}"))
-    if end < total:
-        nav.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"admin:users_page:{page+1}"))
+    if page_ids and has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin:users:{flt}:p:{page_ids[0]}"))
+    if page_ids and has_next:
+        nav.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"admin:users:{flt}:n:{page_ids[-1]}"))
     if nav:
         rows.append(nav)
 
+    rows.append([InlineKeyboardButton("🔎 Поиск (id / @ник)", callback_data="admin:users_search")])
     rows.append([InlineKeyboardButton("🏠 В админ-меню", callback_data="admin")])
     return InlineKeyboardMarkup(rows)
 
+def admin_users_found_kb(ids: list[int]) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(_user_short_row(uid), callback_data=f"admin:user:{uid}")] for uid in ids]
+    if not ids:
+        rows.append([InlineKeyboardButton("Ничего не найдено", callback_data="noop")])
+    rows.append([InlineKeyboardButton("⬅️ К списку", callback_data="admin:pick_users")])
+    return InlineKeyboardMarkup(rows)
+
 def admin_user_card_kb(target_id: int) -> InlineKeyboardMarkup:
     is_admin = (target_id in ADMINS)
     rows = [
@@ -823,7 +1415,8 @@ def admin_settings_kb() -> InlineKeyboardMarkup:
     L = int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT))
     P = int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB))
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"FREE_LIMIT: {L}", callback_data="noop")],
+        [InlineKeyboardButton(f"FREE_LIMIT: {L}" + (f" (действует {REF_LIMITS['free_limit']} из RefData)"
+                              if "free_limit" in REF_LIMITS else ""), callback_data="noop")],
         [InlineKeyboardButton("−1", callback_data="admin:cfg:limit:-1"),
          InlineKeyboardButton("+1", callback_data="admin:cfg:limit:+1"),
          InlineKeyboardButton("+10", callback_data="admin:cfg:limit:+10")],
@@ -834,16 +1427,16 @@ def admin_settings_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⬅️ Назад", callback_data="admin")]
     ])
 
-def admin_subs_list_kb() -> InlineKeyboardMarkup:
-    now = int(time.time()); candidates = []
-    for uid, u in USAGE.items():
-        if int(u.get("premium_until", 0)) > now:
-            candidates.append(int(uid))
-    candidates = sorted(candidates, key=lambda i: int(USAGE.get(i, {}).get("premium_until", 0)), reverse=True)[:12]
+def admin_subs_list_kb(expiring: bool = False) -> InlineKeyboardMarkup:
+    # срез индекса планировщика — O(k), без обхода USAGE
+    items = SCHED.expiring(PREMIUM_REMIND_DAYS*86400, 12) if expiring else SCHED.active(12)
     rows = []
-    for i in candidates:
-        u = usage_entry(i); exp = datetime.fromtimestamp(u.get("premium_until",0)).strftime("%d.%m.%Y %H:%M") if u.get("premium_until") else "—"
-        rows.append([InlineKeyboardButton(f"{i} • до {exp}", callback_data=f"admin:subs_user:{i}")])
+    for i, until in items:
+        rows.append([InlineKeyboardButton(f"{i} • до {datetime.fromtimestamp(until):%d.%m.%Y %H:%M}", callback_data=f"admin:subs_user:{i}")])
+    if not items:
+        rows.append([InlineKeyboardButton("Пока пусто", callback_data="noop")])
+    rows.append([InlineKeyboardButton("💳 Активные", callback_data="admin:subs_list"),
+                 InlineKeyboardButton("⏳ Истекают скоро", callback_data="admin:subs_expiring")])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin")])
     return InlineKeyboardMarkup(rows)
 
@@ -863,16 +1456,18 @@ async def tg_successful_payment(update: Update, context: ContextTypes.DEFAULT_TY
     if not sp: return
     uid = update.effective_user.id
     if sp.currency == "XTR":  # Stars
+        STATS.conversion("stars")
         try:
             u = usage_entry(uid)
             u["stars_charge_id"] = sp.telegram_payment_charge_id
             u["stars_auto_canceled"] = False
-            persist_all()
+            persist("usage")
         except Exception:
             pass
         exp_ts = getattr(sp, "subscription_expiration_date", None)
         if isinstance(exp_ts, int) and exp_ts > 0:
-            u = usage_entry(uid); u["premium"] = True; u["premium_until"] = exp_ts; persist_all()
+            u = usage_entry(uid); u["premium"] = True; u["premium_until"] = exp_ts; persist("usage")
+            sched_track(uid)
         else:
             grant_premium(uid, 30)
         await update.message.reply_text("✅ Премиум оплачен через ⭐️ Stars. Спасибо!",
@@ -896,28 +1491,64 @@ def payments_me_kb(uid: int) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="home")])
     return InlineKeyboardMarkup(rows)
 
+def payments_me_text(uid: int) -> str:
+    u = usage_entry(uid)
+    exp = datetime.fromtimestamp(u.get("premium_until", 0)).strftime("%d.%m.%Y %H:%M") if u.get(
+        "premium_until") else "—"
+    return (
+        "💳 <b>Мои платежи</b>\n"
+        f"• Премиум: {'активен' if has_premium(uid) else 'не активен'} (до {exp})\n"
+        f"• Stars авто: {('включено' if (u.get('stars_charge_id') and not u.get('stars_auto_canceled')) else 'отключено')}\n"
+        f"• YooKassa авто: {('включено' if u.get('yk_payment_method_id') else 'отключено')}"
+    )
+
+async def stars_set_auto(bot, uid: int, enabled: bool) -> bool:
+    """Stars продлевает сам Telegram — флаг меняем только если Telegram принял отмену/возобновление."""
+    u = usage_entry(uid)
+    charge_id = u.get("stars_charge_id")
+    if not charge_id:
+        return False
+    try:
+        # editUserStarSubscription: в PTB 21.4 обёртки нет
+        await bot.do_api_request("editUserStarSubscription", api_kwargs={
+            "user_id": uid, "telegram_payment_charge_id": charge_id, "is_canceled": not enabled})
+    except Exception as e:
+        log.warning("stars auto %s for %s failed: %s", "enable" if enabled else "cancel", uid, e)
+        return False
+    u["stars_auto_canceled"] = not enabled
+    persist("usage"); sched_track(uid)
+    return True
+
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     data = (q.data or "").strip()
     uid = update.effective_user.id
-    ensure_user(uid)
+    ensure_user(uid, update.effective_user.username)
+    user_ctx(uid, context.user_data)
 
     if data == "payments_me":
-        u = usage_entry(uid)
-        exp = datetime.fromtimestamp(u.get("premium_until", 0)).strftime("%d.%m.%Y %H:%M") if u.get(
-            "premium_until") else "—"
-        txt = (
-            "💳 <b>Мои платежи</b>\n"
-            f"• Премиум: {'активен' if has_premium(uid) else 'не активен'} (до {exp})\n"
-            f"• Stars авто: {('включено' if (u.get('stars_charge_id') and not u.get('stars_auto_canceled')) else 'отключено')}\n"
-            f"• YooKassa авто: {('включено' if u.get('yk_payment_method_id') else 'отключено')}"
-        )
-        return await q.message.reply_text(txt, parse_mode="HTML", reply_markup=payments_me_kb(uid))
+        return await q.message.reply_text(payments_me_text(uid), parse_mode="HTML", reply_markup=payments_me_kb(uid))
 
     # ВАЖНО: отвечаем сразу, ДО любых долгих операций
     await safe_answer(q)
 
+    # отключение автопродления: sched_track снимает RENEW, срок премиума не трогаем
+    if data == "me:yk_disable":
+        if usage_entry(uid).pop("yk_payment_method_id", None):
+            persist("usage"); sched_track(uid)
+        return await q.message.reply_text("Автопродление YooKassa отключено — карта больше не будет списываться.\n\n"
+                                          + payments_me_text(uid), parse_mode="HTML", reply_markup=payments_me_kb(uid))
+
+    if data in ("me:stars_cancel", "me:stars_enable"):
+        enable = data == "me:stars_enable"
+        if not await stars_set_auto(context.bot, uid, enable):
+            return await q.message.reply_text("⚠️ Не удалось изменить автопродление Stars, попробуй позже.",
+                                              reply_markup=payments_me_kb(uid))
+        head = "Автопродление Stars включено." if enable else "Автопродление Stars отключено."
+        return await q.message.reply_text(head + "\n\n" + payments_me_text(uid), parse_mode="HTML",
+                                          reply_markup=payments_me_kb(uid))
+
     # дальше твоя логика:
     if data == "home":
         return await q.message.reply_text("Пришли фото — сделаю анализ 💄",
@@ -943,10 +1574,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data=="limits":
         await q.answer()
-        free_limit = int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT))
         price_rub  = int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB))
         txt = ("ℹ️ <b>Лимиты и цена</b>\n"
-               f"• Бесплатно: {free_limit} анализов/день\n"
+               f"• Бесплатно: {free_limit()} анализов/день\n"
                f"• Премиум: безлимит на 30 дней\n"
                f"• Цена: {price_rub} ₽  /  ⭐️ {STARS_PRICE_XTR}")
         return await q.message.reply_text(txt, parse_mode="HTML")
@@ -954,11 +1584,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- YooKassa ---
     # --- YooKassa ---
     if data == "pay:yookassa":
-        if not (os.getenv("YK_SHOP_ID") and os.getenv("YK_SECRET_KEY")):
+        if not yk_configured():
             miss = []
-            if not os.getenv("YK_SHOP_ID"):
+            if not YK_SHOP_ID:
                 miss.append("YK_SHOP_ID")
-            if not os.getenv("YK_SECRET_KEY"):
+            if not YK_SECRET_KEY:
                 miss.append("YK_SECRET_KEY")
             return await q.message.reply_text(
                 "⚠️ ЮKassa ещё не настроена.\n"
@@ -967,7 +1597,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=premium_menu_kb()
             )
         try:
-            url = yk_create_first_payment(uid, int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB)))
+            url = await yk_create_first_payment(uid, int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB)))
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("💳 Открыть YooKassa", url=url)],
                 [InlineKeyboardButton("⬅️ Назад", callback_data="premium")],
@@ -998,8 +1628,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if u.get("trial_used"):
             return await q.message.reply_text("⏳ Триал уже использован.", reply_markup=premium_menu_kb())
         u["trial_used"] = True
-        till = grant_premium(uid, 1)
-        persist_all()
+        till = grant_premium(uid, 1); STATS.conversion("trial")
+        persist("usage")
         return await q.message.reply_text(
             f"✅ Триал активирован до {datetime.fromtimestamp(till):%d.%m.%Y %H:%M}.",
             reply_markup=action_keyboard(uid, context.user_data)
@@ -1015,43 +1645,33 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # история
     if data=="history":
         await q.answer()
-        entries = list_history(uid)
+        entries = (await history_view(uid)).entries
         if not entries:
             return await q.message.reply_text(
                 "История пуста. Пришли фото — и я сохраню результат 📒",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Домой", callback_data="home")]])
             )
-        return await q.message.reply_text("Выбери запись из истории:", reply_markup=history_keyboard(uid))
+        return await q.message.reply_text("Выбери запись из истории:", reply_markup=history_keyboard(entries))
 
     if data.startswith("hist:"):
         await q.answer()
+        view = await history_view(uid)
         try: ts = int(data.split(":",1)[1])
-        except Exception: return await q.message.reply_text("Некорректная запись истории.", reply_markup=history_keyboard(uid))
-        entry = next((e for e in list_history(uid) if int(e["ts"]) == ts), None)
-        if not entry: return await q.message.reply_text("Запись не найдена.", reply_markup=history_keyboard(uid))
-        async def _read_file_text(path:str)->str:
-            try:
-                with open(path,"r",encoding="utf-8") as f: return f.read()
-            except Exception: return ""
-        dt=datetime.fromtimestamp(int(entry["ts"])).strftime("%d.%m.%Y %H:%M")
-        mode_title={"face":"Лицо","hair":"Волосы","both":"Лицо + Волосы"}.get(entry.get("mode","both"),"Анализ")
-        head=f"<b>💄 История — {mode_title}</b>\n<i>{dt}</i>\n━━━━━━━━━━━━━━━━\n"
-        text=entry.get("txt_inline") or (await asyncio.to_thread(_read_file_text, entry.get("txt",""))) or "Текст отсутствует."
-        styled=_themed_headings(_emoji_bullets(text))
+        except Exception: return await q.message.reply_text("Некорректная запись истории.", reply_markup=history_keyboard(view.entries))
+        entry = view.by_ts.get(ts)
+        if not entry: return await q.message.reply_text("Запись не найдена.", reply_markup=history_keyboard(view.entries))
+        dt=datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")
+        html=await history_entry_html(uid, entry)
         kb=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data="history")],
                                  [InlineKeyboardButton("🏠 Домой", callback_data="home")]])
-        if entry.get("img") and os.path.exists(entry["img"]):
-            try:
-                with open(entry["img"], "rb") as f: await q.message.chat.send_photo(photo=f, caption=f"📸 {dt}")
-            except Exception as e: log.warning("send_photo failed: %s", e)
-        await send_html_long(q.message.chat, head+styled, keyboard=kb)
+        await send_history_photo(q.message.chat, uid, entry, f"📸 {dt}")
+        await send_html_long(q.message.chat, html, keyboard=kb)
 
     # фидбек
     if data == "fb:up":
         FEEDBACK["up"] = FEEDBACK.get("up", 0) + 1
-        persist_all()
-        try: sheets_log_feedback(uid, "up")
-        except Exception: pass
+        persist("feedback"); STATS.feedback("up")
+        run_bg(sheets_log_feedback, uid, "up")
         await q.answer("Спасибо! 💜")
         return await q.message.reply_text(
             f"👍 {FEEDBACK.get('up',0)}  |  👎 {FEEDBACK.get('down',0)}",
@@ -1059,9 +1679,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     if data == "fb:down":
         FEEDBACK["down"] = FEEDBACK.get("down", 0) + 1
-        persist_all()
-        try: sheets_log_feedback(uid, "down")
-        except Exception: pass
+        persist("feedback"); STATS.feedback("down")
+        run_bg(sheets_log_feedback, uid, "down")
         await q.answer("Принято 👌")
         return await q.message.reply_text(
             f"👍 {FEEDBACK.get('up',0)}  |  👎 {FEEDBACK.get('down',0)}",
@@ -1096,17 +1715,24 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = data.split(":"); cmd = parts[1] if len(parts)>1 else ""
 
         if cmd == "pick_users":
-            return await q.message.reply_text("👥 Пользователи", reply_markup=admin_users_list_kb(page=0))
-        if cmd == "users_page" and len(parts) >= 3:
-            try: page = int(parts[2])
-            except Exception: page = 0
-            return await q.message.reply_text("👥 Пользователи", reply_markup=admin_users_list_kb(page=page))
+            return await q.message.reply_text(f"👥 Пользователи ({USERDIR.count()})", reply_markup=admin_users_list_kb())
+        if cmd == "users" and len(parts) >= 3 and parts[2] in USER_FILTERS:
+            # admin:users:<фильтр>[:n|p:<курсор user_id>]
+            flt = parts[2]; after = before = None
+            if len(parts) >= 5 and parts[4].lstrip("-").isdigit():
+                if parts[3] == "p": before = int(parts[4])
+                else: after = int(parts[4])
+            return await q.message.reply_text(f"👥 {USER_FILTERS[flt]} ({USERDIR.count(flt)})",
+                                              reply_markup=admin_users_list_kb(flt, after=after, before=before))
+        if cmd == "users_search":
+            ADMIN_STATE[uid] = {"await": "user_search"}
+            return await q.message.reply_text("🔎 Пришли начало user_id или @ника.")
         if cmd == "user" and len(parts) >= 3 and parts[2].isdigit():
             target = int(parts[2]); u = usage_entry(target)
             exp = datetime.fromtimestamp(u.get('premium_until',0)).strftime("%d.%m.%Y %H:%M") if u.get("premium_until") else "—"
             txt = (f"👤 Пользователь {target}\n"
                    f"• Премиум до: {exp}\n"
-                   f"• Бесплатных использовано: {u.get('count',0)} / {CONFIG.get('FREE_LIMIT', DEFAULT_FREE_LIMIT)}\n"
+                   f"• Бесплатных использовано: {u.get('count',0)} / {free_limit()}\n"
                    f"• Админ: {'да' if target in ADMINS else 'нет'}")
             return await q.message.reply_text(txt, reply_markup=admin_user_card_kb(target))
         if cmd == "user_action" and len(parts) >= 4:
@@ -1118,36 +1744,57 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 till = extend_premium_days(target, 30)
                 return await q.message.reply_text(f"✅ Продлено до {datetime.fromtimestamp(till):%d.%m.%Y %H:%M}", reply_markup=admin_user_card_kb(target))
             if action == "clear":
-                u["premium"] = False; u["premium_until"] = 0; persist_all()
+                u["premium"] = False; u["premium_until"] = 0; persist("usage"); sched_track(target)
                 return await q.message.reply_text("✅ Премиум снят.", reply_markup=admin_user_card_kb(target))
             if action == "resetfree":
-                u["count"] = 0; persist_all()
+                u["count"] = 0; persist("usage")
                 return await q.message.reply_text("✅ Бесплатные попытки сброшены.", reply_markup=admin_user_card_kb(target))
             if action == "admin":
-                ADMINS.add(target); persist_all()
+                ADMINS.add(target); USERDIR.set_flag(target, DIR_ADMIN, True); persist("admins")
                 return await q.message.reply_text("✅ Пользователь назначен админом.", reply_markup=admin_user_card_kb(target))
             if action == "unadmin":
-                if target in ADMINS: ADMINS.remove(target); persist_all()
+                if target in ADMINS: ADMINS.remove(target); USERDIR.set_flag(target, DIR_ADMIN, False); persist("admins")
                 return await q.message.reply_text("✅ Права админа сняты.", reply_markup=admin_user_card_kb(target))
 
         if cmd == "stats":
-            total_users = len(USERS)
-            premium_active = sum(1 for u in USAGE.values() if int(u.get("premium_until",0)) > int(time.time()))
+            # только готовые счётчики — без обхода USAGE и выгрузки листа analyses
             up = int(FEEDBACK.get("up",0)); down = int(FEEDBACK.get("down",0))
-            analyses = 0
-            if _sh:
-                try:
-                    analyses = len(_sh.worksheet("analyses").get_all_values()) - 1
-                    if analyses < 0: analyses = 0
-                except Exception: pass
-            else:
-                analyses = sum(len(v) for v in HISTORY.values())
+            today = STATS.series_days("analyses", 1)[0][1]
+            modes = " / ".join(f"{MODES[m]} {STATS.total('mode:'+m)}" for m in MODES)
+            conv = ", ".join(f"{k[5:]} {v}" for k, v in sorted(STATS.totals.items()) if k.startswith("conv:")) or "—"
+            ds = DISPATCHER.stats()
+            yk_failed = len(await asyncio.to_thread(YK_LEDGER.failed)) if YK_LEDGER else 0
+            grace = SCHED.count_grace()
             txt = ("📊 <b>Статистика</b>\n"
-                   f"• Пользователей: {total_users}\n"
-                   f"• Премиум активных: {premium_active}\n"
-                   f"• Анализов: {analyses}\n"
-                   f"• Отзывы: 👍 {up} / 👎 {down}")
-            return await q.message.reply_text(txt, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin")]]))
+                   f"• Пользователей: {len(USERS)} (новых сегодня: {STATS.series_days('new_users', 1)[0][1]})\n"
+                   f"• Премиум активных: {SCHED.count_active()}"
+                   + (f" (+{grace} ждут продления Stars)" if grace else "") + "\n"
+                   f"• Анализов: {STATS.total('analyses')} (сегодня: {today})\n"
+                   f"• По режимам: {modes}\n"
+                   f"• Оплаты/активации: {conv}\n"
+                   + (f"• ⚠️ ЮKassa: не обработано после повторов: {yk_failed}\n" if yk_failed else "") +
+                   f"• Отзывы: 👍 {up} / 👎 {down}\n"
+                   f"• Очередь: в работе {ds['in_flight']}/{ds['parallelism']}, ждут {ds['waiting']}, "
+                   f"макс. у одного {ds['max_user_depth']}\n"
+                   f"• Ожидание: p50 {ds['wait_p50']*1000:.0f} мс, p95 {ds['wait_p95']*1000:.0f} мс\n"
+                   f"<i>Учёт с {datetime.fromtimestamp(STATS.since):%d.%m.%Y}</i>")
+            return await q.message.reply_text(txt, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📈 Тренды", callback_data="admin:trends")],
+                [InlineKeyboardButton("⬅️ Назад", callback_data="admin")]]))
+
+        if cmd == "trends":
+            days = STATS.series_days("analyses", 14)
+            hours = STATS.series_hours("analyses", 24)
+            conv = STATS.series_days("conversions", 14)
+            fb_up = sum(v for _, v in STATS.series_days("fb:up", 7)); fb_down = sum(v for _, v in STATS.series_days("fb:down", 7))
+            lines = [f"{dk[6:8]}.{dk[4:6]}  {v:>4}  {'▇' * min(20, v * 20 // max(1, max(x for _, x in days)))}" for dk, v in days]
+            txt = ("📈 <b>Тренды</b>\n"
+                   f"Анализы за 24 ч: <code>{sparkline([v for _, v in hours])}</code> ({sum(v for _, v in hours)})\n"
+                   f"Оплаты за 14 дн: <code>{sparkline([v for _, v in conv])}</code> ({sum(v for _, v in conv)})\n"
+                   f"Отзывы за 7 дн: 👍 {fb_up} / 👎 {fb_down}\n\n"
+                   "Анализы по дням:\n<pre>" + "\n".join(lines) + "</pre>")
+            return await q.message.reply_text(txt, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬅️ К статистике", callback_data="admin:stats")]]))
 
         if cmd == "broadcast":
             ADMIN_STATE[uid] = {"await": "broadcast"}
@@ -1168,13 +1815,15 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 CONFIG["FREE_LIMIT"] = max(0, int(CONFIG.get("FREE_LIMIT", DEFAULT_FREE_LIMIT)) + delta)
             if what == "price":
                 CONFIG["PRICE_RUB"] = max(0, int(CONFIG.get("PRICE_RUB", DEFAULT_PRICE_RUB)) + delta)
-            persist_all()
+            persist("config")
             return await q.message.reply_text("⚙️ Настройки обновлены", reply_markup=admin_settings_kb())
 
         if cmd == "subs":
             return await q.message.reply_text("💳 Управление подписками", reply_markup=admin_subs_list_kb())
         if cmd == "subs_list":
             return await q.message.reply_text("💳 Активные подписки:",   reply_markup=admin_subs_list_kb())
+        if cmd == "subs_expiring":
+            return await q.message.reply_text(f"⏳ Истекают в ближайшие {PREMIUM_REMIND_DAYS} дн.:", reply_markup=admin_subs_list_kb(expiring=True))
         if cmd == "subs_user" and len(parts) >= 3 and parts[2].isdigit():
             target=int(parts[2]); u=usage_entry(target)
             exp=datetime.fromtimestamp(u.get('premium_until',0)).strftime("%d.%m.%Y %H:%M") if u.get("premium_until") else "—"
@@ -1187,16 +1836,44 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 till=extend_premium_days(target,30)
                 return await q.message.reply_text(f"✅ Продлено до {datetime.fromtimestamp(till):%d.%м.%Y %H:%M}", reply_markup=admin_subs_user_kb(target))
             if action=="clear":
-                u["premium"]=False; u["premium_until"]=0; persist_all()
+                u["premium"]=False; u["premium_until"]=0; persist("usage"); sched_track(target)
                 return await q.message.reply_text("✅ Премиум снят.", reply_markup=admin_subs_user_kb(target))
 
+        if cmd == "profile":
+            if PROFILER.running:
+                return await q.message.reply_text("⏳ Профайлер уже запущен.", reply_markup=admin_main_keyboard())
+            spawn_bg(_admin_profile(q.message.chat))  # не держим очередь апдейтов админа
+            return await q.message.reply_text(f"🔥 Снимаю профиль {PROFILE_SECONDS} с…")
+
         if cmd == "reload_refs":
             try:
-                REF.reload_all()
+                ok = await asyncio.to_thread(REF.reload_all)
+                await asyncio.to_thread(load_rules)
+                await asyncio.to_thread(load_catalog)
+                await asyncio.to_thread(load_limits)
+                if not ok:
+                    return await q.message.reply_text("⚠️ Таблица недоступна, справочники — из локального кэша.",
+                                                      reply_markup=admin_main_keyboard())
+                set_subsystem("refdata", "up")
                 return await q.message.reply_text("✅ Справочники обновлены.", reply_markup=admin_main_keyboard())
             except Exception as e:
                 return await q.message.reply_text(f"⚠️ Не удалось обновить: {e}", reply_markup=admin_main_keyboard())
 
+async def _admin_profile(chat):
+    res = await asyncio.to_thread(PROFILER.run, PROFILE_SECONDS)
+    if res is None:
+        return await chat.send_message("⏳ Профайлер уже запущен.")
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    try:
+        await chat.send_message(f"<pre>{html_escape(res.summary())}</pre>", parse_mode="HTML")
+        await chat.send_document(res.collapsed().encode("utf-8"), filename=f"stacks-{stamp}.folded",
+                                 caption="collapsed stacks → flamegraph.pl / speedscope")
+        if res.allocs:
+            await chat.send_document(res.top_allocations().encode("utf-8"), filename=f"alloc-{stamp}.txt",
+                                     caption="tracemalloc: топ мест аллокаций")
+    except Exception as e:
+        log.warning("profile send failed: %s", e)
+
 async def on_text(update:Update, context:ContextTypes.DEFAULT_TYPE):
     uid=update.effective_user.id
     # админская рассылка
@@ -1216,37 +1893,163 @@ async def on_text(update:Update, context:ContextTypes.DEFAULT_TYPE):
                 fail += 1
         return await update.message.reply_text(f"📣 Готово: отправлено {sent}, ошибок {fail}.", reply_markup=admin_main_keyboard())
 
+    if uid in ADMINS and ast and ast.get("await") == "user_search":
+        ADMIN_STATE.pop(uid, None)
+        found = USERDIR.search(update.message.text or "")
+        return await update.message.reply_text(f"🔎 Найдено: {len(found)}", reply_markup=admin_users_found_kb(found))
+
     # ожидание промокода
     st = USER_STATE.get(uid)
     if st and st.get("await") == "promo":
         USER_STATE.pop(uid, None)
         code = (update.message.text or "").strip()
-        msg = apply_promo(uid, code)
+        msg = await apply_promo(uid, code)
         return await update.message.reply_text(msg, reply_markup=action_keyboard(uid, context.user_data))
 
 
 # ---------- Flask + сервисные эндпоинты ----------
 def start_flask_endpoints(port:int):
+    from flask import Flask, Response, request, jsonify
     app=Flask(__name__)
 
     @app.get("/healthz")
-    def healthz(): return "ok",200
+    def healthz():
+        body, ok = readiness()
+        return jsonify(body), (200 if ok else 503)
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.get("/debug/profile")
+    def debug_profile():
+        # ?seconds=N&kind=stacks|alloc|summary, заголовок X-Profile-Token
+        if not PROFILER_TOKEN: return "not found",404
+        if not hmac.compare_digest(request.headers.get("X-Profile-Token","").encode(), PROFILER_TOKEN.encode()):
+            return "forbidden",403
+        seconds=min(120.0, max(1.0, float(request.args.get("seconds", PROFILE_SECONDS))))
+        res=PROFILER.run(seconds)
+        if res is None: return "profiler busy",409
+        kind=request.args.get("kind","stacks")
+        body=res.top_allocations() if kind=="alloc" else res.summary() if kind=="summary" else res.collapsed()
+        return Response(body, mimetype="text/plain")
+
+    @app.post("/yk/webhook")
+    def yk_webhook():
+        # уведомление ЮKassa: только фиксируем в журнале, проверка и начисление — в PaymentWorker
+        if YK_WEBHOOK_CHECK_IP and not is_yookassa_ip(request.remote_addr):
+            log.warning("yk webhook from %s rejected", request.remote_addr)
+            return jsonify({"error":"forbidden"}),403
+        body=request.get_json(silent=True) or {}
+        event=str(body.get("event") or ""); obj=body.get("object") or {}
+        if not isinstance(obj, dict) or not obj.get("id"):
+            return jsonify({"error":"bad notification"}),400
+        if event=="payment.succeeded" and YK_LEDGER.add(event, obj) and YK_WORKER:
+            YK_WORKER.notify()
+        return jsonify({"ok":True}),200
 
     th=Thread(target=lambda: app.run(host="0.0.0.0",port=port,debug=False,use_reloader=False))
-    th.daemon=True; th.start(); log.info("Flask: /healthz on %s", port)
+    th.daemon=True; th.start(); log.info("Flask: /healthz, /metrics, /yk/webhook on %s", port)
 
 # ---------- Команды ----------
 async def on_start(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    uid=update.effective_user.id; ensure_user(uid)
-    sheets_log_user(uid, getattr(update.effective_user,"username",None))
+    uid=update.effective_user.id; ensure_user(uid, update.effective_user.username)
+    ctx=user_ctx(uid, context.user_data)
+    run_bg(sheets_log_user, uid, getattr(update.effective_user,"username",None))
     await update.message.reply_text("Привет! Пришли фото — сделаю анализ 💄", reply_markup=action_keyboard(uid, context.user_data))
-    await update.message.reply_text(get_usage_text(uid))
+    await update.message.reply_text(ctx.usage_text())
 
 async def on_ping(update:Update,_): await update.message.reply_text("pong")
 
+# ---------- Фоновый старт интеграций ----------
+def _boot_sheets():
+    if not (SHEETS_ENABLED and SPREADSHEET_ID and SERVICE_JSON_B64): return "disabled"
+    sheets_init()
+    if _sh is None: raise RuntimeError("Sheets init failed")
+
+def _boot_refdata():
+    if not REF.configured: return "disabled"
+    n = REF.reload_all()
+    load_rules()
+    load_catalog()
+    load_limits()
+    if not n: raise RuntimeError("справочники не загружены, работаем на локальном кэше")
+
+def _boot_gemini():
+    # импорт SDK + первый запрос (count_tokens бесплатный) поднимают соединение до первого фото
+    if not GEMINI_WARMUP: return "disabled"
+    gemini_model().count_tokens("ping", request_options={"timeout": BOOT_TIMEOUT_SEC})
+
+async def _boot_one(name:str, fn, timeout:float):
+    # отдельный daemon-поток, а не to_thread: зависшая сеть не должна держать пул и выход процесса
+    t0=time.monotonic(); set_subsystem(name, "starting")
+    loop=asyncio.get_running_loop(); fut=loop.create_future()
+    def _done(result, error):
+        if error is not None:
+            log.warning("%s init failed: %s", name, error)
+            set_subsystem(name, "down", t0, error)
+        else:
+            set_subsystem(name, result or "up", t0)
+        if not fut.done(): fut.set_result(None)
+    def _run():
+        try: res, err = fn(), None
+        except Exception as e: res, err = None, e
+        with suppress(RuntimeError):  # loop уже закрыт — процесс завершается
+            loop.call_soon_threadsafe(_done, res, err)
+    Thread(target=_run, name=f"boot-{name}", daemon=True).start()
+    done,_=await asyncio.wait({fut}, timeout=timeout)
+    if not done:
+        # поток не отменить — пусть доработает; _done переведёт статус, когда ответ придёт
+        log.warning("%s init: нет ответа за %.0f с, работаем без него", name, timeout)
+        set_subsystem(name, "timeout", t0)
+
+async def _boot_integrations():
+    with TRACER.trace("bootstrap"):
+        await asyncio.gather(_boot_one("sheets", _boot_sheets, BOOT_TIMEOUT_SEC),
+                             _boot_one("refdata", _boot_refdata, BOOT_TIMEOUT_SEC),
+                             _boot_one("gemini", _boot_gemini, BOOT_TIMEOUT_SEC))
+    log.info("bootstrap: %s", ", ".join(f"{k}={v['status']}" for k, v in SUBSYSTEMS.items()))
+
 # ---------- main ----------
-def main():
-    app=Application.builder().token(BOT_TOKEN).build()
+async def _post_init(app:Application):
+    global YK_WORKER, JOB_PUMP
+    set_subsystem("telegram", "up")
+    spawn_bg(_boot_integrations())
+    if LOOP_MONITOR != "0": await LOOPMON.start()
+    TRACER.start()
+    await STATE.start()
+    _sched_bootstrap(app.bot)
+    await SCHED.start()
+    spawn_bg(_history_migrate())
+    pool=WorkerPool(JOBS, analysis_job, processes=ANALYSIS_WORKERS, threads=ANALYSIS_WORKER_THREADS, poll_sec=JOB_POLL_SEC)
+    JOB_PUMP=JobPump(JOBS, pool, lambda j: _deliver_job(j, app.bot), poll_sec=JOB_POLL_SEC)
+    await JOB_PUMP.start()
+    if yk_configured():
+        YK_WORKER = PaymentWorker(yk_client(), YK_LEDGER, lambda p: yk_on_succeeded(p, app.bot),
+                                  on_failed=lambda p, e: yk_on_failed(p, e, app.bot))
+        await YK_WORKER.start()
+
+async def _post_shutdown(app:Application):
+    if JOB_PUMP: await JOB_PUMP.stop()
+    await SCHED.stop()
+    if YK_WORKER: await YK_WORKER.stop()
+    if _yk_client: await _yk_client.aclose()
+    await STATE.stop()
+    await LOOPMON.stop()
+
+def build_application() -> Application:
+    """Application со всеми хендлерами (без запуска) — общий для main() и tools/loadtest.py."""
+    builder=(Application.builder().token(BOT_TOKEN)
+             .concurrent_updates(DISPATCHER)
+             .rate_limiter(GOVERNOR)
+             # отдельные пулы: долгий getUpdates не занимает соединения отправок и наоборот
+             .request(HTTPXRequest(connection_pool_size=TG_SEND_POOL, pool_timeout=10.0))
+             .get_updates_request(HTTPXRequest(connection_pool_size=1))
+             .persistence(SqlitePersistence(USER_DATA_DB, update_interval=USER_DATA_FLUSH_SEC))
+             .post_init(_post_init).post_shutdown(_post_shutdown))
+    if BOT_API_URL:
+        builder=builder.base_url(BOT_API_URL.rstrip("/")+"/bot").base_file_url(BOT_API_URL.rstrip("/")+"/file/bot")
+    app=builder.build()
 
     # Профиль — диалог
     profile_conv = ConversationHandler(
@@ -1262,7 +2065,7 @@ def main():
         },
         fallbacks=[CommandHandler("cancel", profile_cancel)],
         name="profile_conv",
-        persistent=False,
+        persistent=True,
     )
 
     app.add_handler(PreCheckoutQueryHandler(tg_precheckout))
@@ -1281,12 +2084,13 @@ def main():
 
     # Текст (рассылка и проч.)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    return app
 
+def main():
+    bootstrap()
+    app=build_application()
+    for name in ("telegram", "sheets", "refdata", "gemini"): set_subsystem(name, "pending")
     start_flask_endpoints(PORT)
-    sheets_init()
-    try: REF.reload_all()
-    except Exception as e: log.warning("RefData init failed: %s", e)
-
     app.run_polling()
 
 if __name__=="__main__":
@@ -0,0 +1,107 @@
+# membudget.py — общий бюджет памяти на фото, которые бот качает и кладёт в очередь: семафор в байтах с очередью FIFO
+import asyncio
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+
+class BudgetExhausted(Exception):
+    """Не дождались места в бюджете за timeout — фото лучше отложить, чем уронить процесс."""
+
+
+def estimate_image_bytes(file_size: Optional[int], width: int, height: int) -> int:
+    """
+    Пик памяти одного фото в процессе бота до скачивания: буфер загрузки и его копия (BytesIO.getvalue).
+    Раскодирование и Gemini — в воркерах анализа, в этот бюджет не входят. file_size Telegram
+    иногда не присылает — тогда полбайта на пиксель, с запасом для JPEG.
+    """
+    if not file_size:
+        file_size = width * height // 2
+    return 2 * file_size
+
+
+def queued_image_bytes(nbytes: int) -> int:
+    """После скачивания: фото и копия, которую sqlite3 делает при записи в очередь."""
+    return 2 * nbytes
+
+
+class Reservation:
+    """Занятые байты; shrink() возвращает часть в бюджет, когда настоящий размер известен."""
+    __slots__ = ("budget", "nbytes")
+
+    def __init__(self, budget: "MemoryBudget", nbytes: int):
+        self.budget = budget
+        self.nbytes = nbytes
+
+    def shrink(self, nbytes: int) -> None:
+        nbytes = max(0, min(nbytes, self.nbytes))
+        freed, self.nbytes = self.nbytes - nbytes, nbytes
+        self.budget._release(freed)
+
+    def release(self) -> None:
+        self.shrink(0)
+
+    async def __aenter__(self) -> "Reservation":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class MemoryBudget:
+    """
+    capacity байт на все фото, которые бот сейчас качает и пишет в очередь. reserve(n) ждёт, пока освободится n байт; очередь честная
+    (FIFO): большое фото не голодает за потоком маленьких. Запрос больше всего бюджета урезается
+    до capacity — такое фото просто идёт одно. Используется только из event loop.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+        self.deferred = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def reserve(self, nbytes: int, timeout: Optional[float] = None) -> Reservation:
+        nbytes = max(0, min(nbytes, self.capacity))
+        if not self._waiters and self.used + nbytes <= self.capacity:
+            self.used += nbytes
+            return Reservation(self, nbytes)
+        fut = asyncio.get_running_loop().create_future()
+        item = (nbytes, fut)
+        self._waiters.append(item)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            if not fut.done():
+                self._forget(item)
+                self.deferred += 1
+                raise BudgetExhausted(f"image memory budget: {self.used}/{self.capacity} bytes in use") from None
+            # место выдали в тот же момент — берём
+        except asyncio.CancelledError:
+            if fut.done():
+                self._release(nbytes)
+            else:
+                self._forget(item)
+            raise
+        return Reservation(self, nbytes)
+
+    def _forget(self, item: Tuple[int, asyncio.Future]) -> None:
+        item[1].cancel()
+        self._waiters.remove(item)
+        self._wake()  # ушла голова очереди — следующим может хватить
+
+    def _release(self, nbytes: int) -> None:
+        self.used -= nbytes
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters:
+            nbytes, fut = self._waiters[0]
+            if self.used + nbytes > self.capacity:
+                break
+            self._waiters.popleft()
+            self.used += nbytes
+            fut.set_result(None)
@@ -0,0 +1,174 @@
+# metrics.py — минимальный реестр метрик в текстовом формате Prometheus (без зависимостей)
+import time, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _fmt_labels(names: Sequence[str], values: LabelKey, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, n: float = 1, **labels: str) -> None:
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Значение задаётся set/inc/dec или считается при экспорте функцией fn."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelKey, float] = {}
+        self.fn = fn
+
+    def set(self, v: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = v
+
+    def inc(self, n: float = 1, **labels: str) -> None:
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+    def dec(self, n: float = 1, **labels: str) -> None:
+        self.inc(-n, **labels)
+
+    def value(self, **labels: str) -> float:
+        if self.fn:
+            return float(self.fn())
+        return self._values.get(self._key(labels), 0)
+
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        self.inc(1, **labels)
+        try:
+            yield
+        finally:
+            self.dec(1, **labels)
+
+    def _samples(self):
+        if self.fn:
+            try:
+                return [f"{self.name} {_fmt_num(self.fn())}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._data: Dict[LabelKey, List[float]] = {}  # [c_b1, ..., c_bn, c_inf, sum]
+
+    def observe(self, v: float, **labels: str) -> None:
+        k = self._key(labels)
+        i = bisect_left(self.buckets, v)
+        with self._lock:
+            d = self._data.get(k)
+            if d is None:
+                d = self._data[k] = [0] * (len(self.buckets) + 1) + [0.0]
+            d[i] += 1
+            d[-1] += v
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _samples(self):
+        out = []
+        with self._lock:
+            items = [(k, list(d)) for k, d in self._data.items()]
+        for k, d in items:
+            acc = 0
+            for b, c in zip(self.buckets + (float("inf"),), d[:-1]):
+                acc += c
+                le = 'le="%s"' % ("+Inf" if b == float("inf") else _fmt_num(b))
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_num(d[-1])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {acc}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, m: _Metric) -> _Metric:
+        self._metrics[m.name] = m
+        return m
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in list(self._metrics.values()):
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,122 @@
+# outbound.py — исходящие вызовы Bot API: лимиты на чат и на бота, RetryAfter, склейка мелких сообщений
+import time, asyncio, logging
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+log = logging.getLogger("beauty-nano-bot.outbound")
+
+TG_MAX_MESSAGE = 4096
+
+
+class _Bucket:
+    """Маркерное ведро с бронированием: take() сразу списывает маркер и говорит, сколько ждать своей очереди."""
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, now
+
+    def take(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.ts) * self.rate >= self.burst
+
+
+class SendGovernor(BaseRateLimiter[int]):
+    """
+    Rate limiter для ExtBot (getUpdates PTB сюда не передаёт):
+      - на чат: личка chat_rate/с с запасом chat_burst (анализ = 2–3 сообщения подряд без пауз),
+        группы group_rate/с — лимиты Telegram для групп строже;
+      - на бота: overall_rate/с на все вызовы;
+      - RetryAfter: все отправки встают на паузу до конца flood wait (иначе следующие вызовы
+        ловят тот же 429 и продлевают его), запрос повторяется до max_retries раз.
+    Очередь — не отдельная задача: каждый вызов бронирует маркер и спит свою задержку.
+    rate_limit_args (int) — переопределить max_retries для одного вызова.
+    """
+
+    def __init__(self, overall_rate: float = 25.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60, group_burst: float = 3.0, max_retries: int = 2,
+                 max_buckets: int = 10000):
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._overall = _Bucket(overall_rate, overall_rate, time.monotonic())
+        self._chats: Dict[Union[int, str], _Bucket] = {}
+        self._paused_until = 0.0
+        self.delayed = 0          # вызовов, ждавших лимита
+        self.delay_seconds = 0.0  # суммарное ожидание
+        self.retry_after = 0      # пойманных RetryAfter
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Union[int, str], now: float) -> _Bucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self.max_buckets:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle(now)}
+            group = isinstance(chat_id, str) or chat_id < 0  # @channel или отрицательный id — группа/канал
+            b = self._chats[chat_id] = (_Bucket(self.group_rate, self.group_burst, now) if group
+                                        else _Bucket(self.chat_rate, self.chat_burst, now))
+        return b
+
+    async def _wait(self, seconds: float) -> None:
+        if seconds > 0:
+            self.delayed += 1
+            self.delay_seconds += seconds
+            await asyncio.sleep(seconds)
+
+    async def _acquire(self, chat_id: Optional[Union[int, str]]) -> None:
+        await self._wait(self._paused_until - time.monotonic())
+        if chat_id is not None:
+            now = time.monotonic()
+            await self._wait(self._chat_bucket(chat_id, now).take(now))
+        await self._wait(self._overall.take(time.monotonic()))
+        # пока спали, кто-то мог поймать RetryAfter
+        await self._wait(self._paused_until - time.monotonic())
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        for attempt in range(retries + 1):
+            await self._acquire(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay + 0.1)
+                log.warning("%s: flood wait %.1fs (chat %s, attempt %d/%d)", endpoint, delay, chat_id,
+                            attempt + 1, retries + 1)
+                if attempt >= retries:
+                    raise
+        raise AssertionError("unreachable")
+
+
+def append_tail(chunks: List[str], tail: Optional[str], limit: int = TG_MAX_MESSAGE) -> List[str]:
+    """Дописать короткий хвост (строка лимитов, подсказка) к последней части, если влезает, иначе — отдельной."""
+    if not tail:
+        return chunks
+    if chunks and len(chunks[-1]) + 2 + len(tail) <= limit:
+        return chunks[:-1] + [chunks[-1] + "\n\n" + tail]
+    return chunks + [tail]
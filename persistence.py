@@ -0,0 +1,194 @@
+# persistence.py — персистентность PTB (user_data, chat_data, состояния диалогов) построчно в SQLite
+import json, time, asyncio, sqlite3, threading
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+Key = Tuple[str, Any]  # ("user"|"chat", id) или ("conv", (name, key_json))
+
+
+class SqlitePersistence(BasePersistence[Dict[str, Any], Dict[str, Any], Dict[str, Any]]):
+    """
+    Вместо PicklePersistence (переписывает весь pickle на каждом сбросе):
+      - одна строка на пользователя/чат, JSON; состояния диалогов — строка на (имя, ключ);
+      - get_user_data/get_chat_data при старте отдают пусто, данные пользователя читаются
+        в refresh_user_data перед первым его апдейтом в этом процессе;
+      - update_* пишет, только если JSON изменился с последней записи/чтения
+        (PTB и так отдаёт только тех, кого трогали за интервал, но «трогали» ≠ «изменили»);
+      - всё, что накопилось за проход update_persistence, уходит одной транзакцией в потоке.
+    bot_data и callback_data бот не использует — не храним.
+    """
+
+    def __init__(self, path: str, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._loaded: Dict[str, set] = {"user": set(), "chat": set()}
+        self._hashes: Dict[Key, int] = {}        # hash последнего JSON, который есть в базе
+        self._pending: Dict[Key, Optional[str]] = {}  # None — удалить строку
+        self._commit_lock = asyncio.Lock()
+        self.loads = self.writes = self.skipped = 0
+
+    # ---- база ----
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            c = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute("""CREATE TABLE IF NOT EXISTS ptb_data (
+                kind       TEXT NOT NULL,
+                id         INTEGER NOT NULL,
+                data       TEXT NOT NULL,
+                updated_at INTEGER,
+                PRIMARY KEY (kind, id)
+            )""")
+            c.execute("""CREATE TABLE IF NOT EXISTS ptb_conversations (
+                name  TEXT NOT NULL,
+                key   TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            )""")
+            c.commit()
+            self._conn = c
+        return self._conn
+
+    def _read_row(self, kind: str, id_: int) -> Optional[str]:
+        with self._db_lock:
+            r = self._db().execute("SELECT data FROM ptb_data WHERE kind=? AND id=?", (kind, id_)).fetchone()
+        return r[0] if r else None
+
+    def _read_conversations(self, name: str) -> Dict[str, str]:
+        with self._db_lock:
+            return dict(self._db().execute("SELECT key, state FROM ptb_conversations WHERE name=?", (name,)))
+
+    def _write(self, batch: Dict[Key, Optional[str]]) -> None:
+        now = int(time.time())
+        with self._db_lock:
+            c = self._db()
+            with c:
+                for (kind, id_), data in batch.items():
+                    if kind == "conv":
+                        name, key = id_
+                        if data is None:
+                            c.execute("DELETE FROM ptb_conversations WHERE name=? AND key=?", (name, key))
+                        else:
+                            c.execute("INSERT OR REPLACE INTO ptb_conversations(name, key, state) VALUES (?, ?, ?)",
+                                      (name, key, data))
+                    elif data is None:
+                        c.execute("DELETE FROM ptb_data WHERE kind=? AND id=?", (kind, id_))
+                    else:
+                        c.execute("INSERT OR REPLACE INTO ptb_data(kind, id, data, updated_at) VALUES (?, ?, ?, ?)",
+                                  (kind, id_, data, now))
+
+    # ---- запись: копим в _pending, сбрасываем одной транзакцией ----
+    def _stage(self, key: Key, data: Any) -> None:
+        if data is None:
+            self._hashes.pop(key, None)
+            self._pending[key] = None
+            return
+        s = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        h = hash(s)
+        if self._hashes.get(key) == h:
+            self.skipped += 1
+            return
+        self._hashes[key] = h
+        self._pending[key] = s
+
+    async def _commit(self) -> None:
+        # update_* приходят пачкой через asyncio.gather: первый забирает уже накопленное,
+        # остальные — что успело добавиться, пока он писал
+        async with self._commit_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, batch)
+                self.writes += len(batch)
+            except Exception:
+                for k in batch:  # при следующем проходе запишем заново
+                    self._hashes.pop(k, None)
+                raise
+
+    # ---- ленивое чтение ----
+    async def _refresh(self, kind: str, id_: int, data: Dict[str, Any]) -> None:
+        if id_ in self._loaded[kind]:
+            return
+        s = await asyncio.to_thread(self._read_row, kind, id_)
+        self._loaded[kind].add(id_)
+        if s is None:
+            return
+        self.loads += 1
+        self._hashes[(kind, id_)] = hash(s)
+        for k, v in json.loads(s).items():
+            data.setdefault(k, v)
+
+    def _update(self, kind: str, id_: int, data: Dict[str, Any]) -> None:
+        if not data and (kind, id_) not in self._hashes:
+            return  # строки нет (или её не читали) — пустой словарь не пишем и ничего им не затираем
+        self._stage((kind, id_), data)
+
+    # ---- BasePersistence ----
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        # активных диалогов немного (завершённые удаляются) — читаем все сразу
+        rows = await asyncio.to_thread(self._read_conversations, name)
+        out = {}
+        for key, state in rows.items():
+            self._hashes[("conv", (name, key))] = hash(state)
+            out[tuple(json.loads(key))] = json.loads(state)
+        return out
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._stage(("conv", (name, json.dumps(list(key)))), new_state)
+        await self._commit()
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        self._update("user", user_id, data)
+        await self._commit()
+
+    async def update_chat_data(self, chat_id: int, data: Dict[str, Any]) -> None:
+        self._update("chat", chat_id, data)
+        await self._commit()
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(("user", user_id), None)
+        await self._commit()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage(("chat", chat_id), None)
+        await self._commit()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[str, Any]) -> None:
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._commit()
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
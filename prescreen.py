@@ -0,0 +1,86 @@
+# prescreen.py — дешёвая проверка фото до вызова Gemini: размер, экспозиция, резкость, однотонность, скриншот
+from typing import Any, Dict, Optional, Tuple
+
+# пороги (ключи листа limits_prices в RefData; целые числа, 0 — проверка выключена)
+DEFAULTS: Dict[str, int] = {
+    "prescreen_min_side": 320,      # меньшая сторона исходника, px
+    "prescreen_dark_pct": 90,       # доля пикселей 0..24, % — «темно»
+    "prescreen_bright_pct": 90,     # доля пикселей 232..255, % — «засвечено»
+    "prescreen_uniform_std": 6,     # СКО яркости меньше — однотонный кадр (стена, закрытый объектив)
+    "prescreen_blur_var": 12,       # дисперсия лапласиана на миниатюре меньше — сильно размыто
+    "prescreen_flat_pct": 88,       # доля соседних пикселей с одинаковой яркостью, % — похоже на скриншот
+}
+
+MESSAGES: Dict[str, str] = {
+    "too_small": "Фото слишком маленькое — пришли снимок хотя бы {min_side}px по меньшей стороне 📷",
+    "too_dark": "Фото слишком тёмное 🌑 Сделай снимок при дневном свете или включи свет.",
+    "too_bright": "Фото засвечено ☀️ Отойди от прямого света или выключи вспышку.",
+    "uniform": "На фото почти ничего не видно — похоже на однотонный кадр. Пришли фото лица или волос 🙂",
+    "blurry": "Фото сильно размыто 🌫 Протри камеру и сфотографируй ещё раз, держа телефон неподвижно.",
+    "screenshot": "Похоже на скриншот 🖼 Для анализа нужна фотография, а не снимок экрана.",
+}
+
+_DARK_MAX, _BRIGHT_MIN = 24, 232
+
+
+class Verdict:
+    __slots__ = ("ok", "reason", "stats")
+
+    def __init__(self, ok: bool, reason: Optional[str] = None, stats: Optional[Dict[str, float]] = None):
+        self.ok, self.reason, self.stats = ok, reason, stats or {}
+
+    def message(self, limits: Dict[str, int]) -> str:
+        return MESSAGES.get(self.reason or "", "").format(min_side=limits.get("prescreen_min_side", 0))
+
+
+def measure(gray: Any) -> Dict[str, float]:
+    """
+    Статистики по миниатюре в оттенках серого (uint8, HxW), всё векторно. Яркость — по каждому
+    второму пикселю (для гистограммы хватает с запасом), резкость и «плоскость» — по всем.
+    """
+    import numpy as np  # не при импорте: main импортирует этот модуль, а numpy нужен только анализу
+    sub = gray[::2, ::2]
+    n = sub.size
+    v = sub.ravel().astype(np.float32)
+    mean = float(v.sum(dtype=np.float64)) / n
+    std = float(np.sqrt(max(0.0, float(v @ v) / n - mean * mean)))
+    # лапласиан 4-соседей в int16 (|значение| <= 1020), дисперсия через скалярное произведение float32
+    gi = gray.astype(np.int16)
+    lap = gi[:-2, 1:-1] + gi[2:, 1:-1]
+    lap += gi[1:-1, :-2]
+    lap += gi[1:-1, 2:]
+    lap -= 4 * gi[1:-1, 1:-1]
+    lf = lap.astype(np.float32).ravel()
+    lm = float(lf.sum(dtype=np.float64)) / lf.size
+    flat = (np.count_nonzero(gray[:, 1:] == gray[:, :-1]) + np.count_nonzero(gray[1:, :] == gray[:-1, :])) \
+        / (gray[:, 1:].size + gray[1:, :].size)
+    return {
+        "mean": round(mean, 1),
+        "std": round(std, 1),
+        "dark_pct": round(100.0 * np.count_nonzero(sub <= _DARK_MAX) / n, 1),
+        "bright_pct": round(100.0 * np.count_nonzero(sub >= _BRIGHT_MIN) / n, 1),
+        "blur_var": round(max(0.0, float(lf @ lf) / lf.size - lm * lm), 1),
+        "flat_pct": round(100.0 * flat, 1),
+    }
+
+
+def check(gray: Any, orig_size: Tuple[int, int], limits: Dict[str, Any]) -> Verdict:
+    """Первая сработавшая проверка определяет причину; порог 0 выключает проверку."""
+    lim = {k: int(limits.get(k, v)) for k, v in DEFAULTS.items()}
+    if lim["prescreen_min_side"] and min(orig_size) < lim["prescreen_min_side"]:
+        return Verdict(False, "too_small", {"min_side": min(orig_size)})
+    s = measure(gray)
+    # скриншот: большие ровные заливки и при этом резкие края (текст, иконки) — раньше экспозиции,
+    # иначе белый/тёмный интерфейс уходит в «засвечено»/«темно»
+    if lim["prescreen_flat_pct"] and s["flat_pct"] >= lim["prescreen_flat_pct"] \
+            and s["blur_var"] >= 10 * max(1, lim["prescreen_blur_var"]):
+        return Verdict(False, "screenshot", s)
+    if lim["prescreen_dark_pct"] and s["dark_pct"] >= lim["prescreen_dark_pct"]:
+        return Verdict(False, "too_dark", s)
+    if lim["prescreen_bright_pct"] and s["bright_pct"] >= lim["prescreen_bright_pct"]:
+        return Verdict(False, "too_bright", s)
+    if lim["prescreen_uniform_std"] and s["std"] < lim["prescreen_uniform_std"]:
+        return Verdict(False, "uniform", s)
+    if lim["prescreen_blur_var"] and s["blur_var"] < lim["prescreen_blur_var"]:
+        return Verdict(False, "blurry", s)
+    return Verdict(True, None, s)
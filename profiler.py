@@ -0,0 +1,88 @@
+# profiler.py — сэмплирующий профайлер по требованию (collapsed stacks для flame graph + tracemalloc)
+import os, sys, time, threading, tracemalloc
+from collections import Counter
+from typing import List, Optional
+
+
+class ProfileResult:
+    def __init__(self, seconds: float, samples: int, stacks: Counter, allocs: List[str]):
+        self.seconds = seconds
+        self.samples = samples
+        self.stacks = stacks
+        self.allocs = allocs
+
+    def collapsed(self) -> str:
+        """Формат flamegraph.pl / speedscope / inferno: «thread;f1;f2;f3 N» на строку."""
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def top_allocations(self) -> str:
+        return "\n".join(self.allocs) + "\n"
+
+    def summary(self, top: int = 10) -> str:
+        leaf = Counter()
+        for stack, n in self.stacks.items():
+            leaf[stack.rsplit(";", 1)[-1]] += n
+        total = sum(leaf.values()) or 1
+        lines = [f"{n * 100 / total:5.1f}%  {fn}" for fn, n in leaf.most_common(top)]
+        return f"{self.samples} сэмплов за {self.seconds:.1f} с\n" + "\n".join(lines)
+
+
+class SamplingProfiler:
+    """
+    Пока не запущен — не стоит ничего (ни хуков, ни потоков, tracemalloc выключен).
+    run() раз в `interval` снимает sys._current_frames() всех потоков (event loop, to_thread-воркеры,
+    Flask) и считает одинаковые стеки. Одновременно работает только один запуск.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._busy = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._busy.locked()
+
+    def run(self, seconds: float, allocations: bool = True, top_allocs: int = 25) -> Optional[ProfileResult]:
+        """Блокирующий вызов (запускать в потоке). None — профайлер уже занят."""
+        if not self._busy.acquire(blocking=False):
+            return None
+        started_tm = False
+        try:
+            if allocations and not tracemalloc.is_tracing():
+                tracemalloc.start(16)
+                started_tm = True
+            me = threading.get_ident()
+            stacks: Counter = Counter()
+            samples = 0
+            t_end = time.monotonic() + seconds
+            while time.monotonic() < t_end:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for tid, frame in sys._current_frames().items():
+                    if tid == me:
+                        continue
+                    stacks[self._collapse(names.get(tid, str(tid)), frame)] += 1
+                samples += 1
+                time.sleep(self.interval)
+            allocs: List[str] = []
+            if tracemalloc.is_tracing():
+                snap = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ))
+                allocs = [str(st) for st in snap.statistics("lineno")[:top_allocs]]
+            return ProfileResult(seconds, samples, stacks, allocs)
+        finally:
+            if started_tm:
+                tracemalloc.stop()
+            self._busy.release()
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        parts: List[str] = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        parts.append(thread_name.replace(";", "_").replace(" ", "_"))
+        return ";".join(reversed(parts))
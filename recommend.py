@@ -0,0 +1,228 @@
+# recommend.py — товары каталога RefData к ответу анализа: инвертированный индекс по тегам, составу и названию
+import re
+import math
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from rules import FIELDS
+
+# вес поля товара: тег проставлен руками, состав — факт, название — слабый сигнал
+FIELD_WEIGHTS = {"tags": 3.0, "ingredients": 2.0, "title": 1.0}
+# вес источника запроса: анкета — то, что пользователь сказал о себе, правила — выводы из неё, ответ Gemini — остальное
+SOURCE_PROFILE, SOURCE_RULES, SOURCE_ANSWER = 3.0, 2.0, 1.0
+MAX_DF = 0.5  # основа в половине каталога и чаще («средство», «крем») ничего не различает — в индекс не берём
+
+_WORD = re.compile(r"[0-9a-zа-яё]{2,}")  # однобуквенные («и», «с») ничего не дают
+# окончания, которые срезаем (одно, самое длинное), дальше основа обрезается до _STEM_LEN:
+# «ретинол»/«ретиноидов», «отдушка»/«отдушек», «сухая»/«сухой» сходятся в одну основу
+_ENDINGS = tuple(sorted((
+    "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий",
+    "ой", "ей", "ую", "юю", "ых", "их", "ым", "им", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "й", "ь", "s",
+), key=len, reverse=True))
+_STEM_LEN = 5
+
+
+@lru_cache(maxsize=65536)
+def stem(word: str) -> str:
+    w = word.replace("ё", "е")
+    for e in _ENDINGS:
+        if w.endswith(e) and len(w) - len(e) >= 3:
+            w = w[:-len(e)]
+            break
+    return w[:_STEM_LEN]
+
+
+_NOT = "!"
+# после этих слов до конца фразы — то, чего надо избегать: «без отдушек», «избегай ретиноидов».
+# True — слово целиком («безопасный» — не отрицание), False — достаточно начала («избегайте»)
+_NEGATIONS = {"без": True, "нельзя": True, "without": True, "избега": False, "исключ": False, "avoid": False}
+_BREAKS = ".;:!?\n"
+_NEGATION_STEMS = frozenset(stem(w) for w in _NEGATIONS)  # сами «без», «избегайте» в основы не идут
+
+
+def _negated_spans(low: str) -> List[Tuple[int, int]]:
+    """[начало, конец) фраз под отрицанием; str.find вместо регулярки — их в ответе единицы, а текст длинный."""
+    spans = []
+    for word, whole in _NEGATIONS.items():
+        i = low.find(word)
+        while i >= 0:
+            j = i + len(word)
+            if (i == 0 or not low[i - 1].isalpha()) and not (whole and j < len(low) and low[j].isalpha()):
+                end = len(low)
+                for b in _BREAKS:
+                    k = low.find(b, j, end)
+                    if k >= 0:
+                        end = k
+                spans.append((i, end))
+            i = low.find(word, j)
+    return spans
+
+
+@lru_cache(maxsize=65536)
+def _token_stems(token: str) -> Tuple[str, ...]:
+    # «ниацинамид/пантенол,» — один токен split(), два слова; числа («50 мл», «шаг 2») не термины
+    return tuple(stem(w) for w in _WORD.findall(token) if not w.isdigit())
+
+
+def _stems(text: str) -> FrozenSet[str]:
+    return frozenset(chain.from_iterable(map(_token_stems, set(text.split()))))
+
+
+def terms(text: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Основы слов текста: (упомянутые, упомянутые под отрицанием). Цикла по словам в Python нет:
+    str.split и set в C, в кэшированный _token_stems идут только разные токены — в ответе Gemini
+    на 6000 знаков их сотня-другая. Регулярка по всему кириллическому тексту в разы медленнее.
+    """
+    low = text.lower()
+    spans = _negated_spans(low)
+    if not spans:
+        return _stems(low), frozenset()
+    spans.sort()
+    neg_parts, rest, pos = [], [], 0
+    for a, b in spans:
+        neg_parts.append(low[a:b])
+        if a > pos:
+            rest.append(low[pos:a])
+        pos = max(pos, b)
+    rest.append(low[pos:])
+    return _stems(" ".join(rest)), _stems(" ".join(neg_parts)) - _NEGATION_STEMS
+
+
+def _split(v: Any) -> List[str]:
+    if isinstance(v, list):
+        return [str(x) for x in v]
+    return [x for x in re.split(r"[;,]", str(v or "")) if x.strip()]
+
+
+def _query(found: Tuple[FrozenSet[str], FrozenSet[str]], weight: float) -> Dict[str, float]:
+    pos, neg = found
+    q = dict.fromkeys(pos, weight)
+    for s in neg:
+        q[_NOT + s] = weight
+    return q
+
+
+class CatalogIndex:
+    """
+    Основа -> (номера товаров, веса) в массивах numpy. Вес в списке — сильнейшее поле товара, где
+    встретилась основа, умноженное на idf (редкий тег весит больше частого). Запрос — по одному
+    векторному сложению на найденную основу и argpartition: в Python цикл по основам запроса,
+    а не по товарам, поэтому тысячи SKU почти ничего не добавляют.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        import numpy as np  # не при импорте: main импортирует модуль, а индекс строится в потоке справочников
+        self._np = np
+        self.items: List[Dict[str, Any]] = []
+        per_item: List[Dict[str, float]] = []
+        for r in rows:
+            sku = str(r.get("sku") or "").strip()
+            title = str(r.get("title") or r.get("name") or "").strip()
+            if not sku or not title:
+                continue
+            weights: Dict[str, float] = {}
+            for field, w in FIELD_WEIGHTS.items():
+                # теги — отдельные фразы: отрицание «без отдушек» не должно перейти на следующий тег
+                text = " . ".join(_split(r.get(field))) if field != "title" else title
+                pos, neg = terms(text)
+                # «без отдушек» у товара — свойство, а не состав: ключ "!отдуш", с правилом «без отдушек» совпадает
+                for s in pos | {_NOT + x for x in neg}:
+                    if weights.get(s, 0.0) < w:
+                        weights[s] = w
+            if not weights:
+                continue
+            try:
+                priority = int(r.get("priority", 0))
+            except (TypeError, ValueError):
+                priority = 0
+            self.items.append({"sku": sku, "title": title, "brand": str(r.get("brand") or "").strip(),
+                               "url": str(r.get("url") or "").strip(), "priority": priority})
+            per_item.append(weights)
+        n = len(self.items)
+        df: Dict[str, List[int]] = {}
+        for i, weights in enumerate(per_item):
+            for s in weights:
+                df.setdefault(s, []).append(i)
+        self.postings: Dict[str, Tuple[Any, Any]] = {}
+        for s, idx in df.items():
+            if len(idx) > max(1, MAX_DF * n):
+                continue
+            idf = math.log(1.0 + n / len(idx))
+            self.postings[s] = (np.array(idx, dtype=np.int32),
+                                np.array([per_item[i][s] * idf for i in idx], dtype=np.float32))
+        # приоритет из листа (0..100) — множитель: при равной релевантности выше приоритетный товар
+        self.boost = np.array([1.0 + max(0, it["priority"]) / 100.0 for it in self.items])
+
+    def search(self, weights: Dict[str, float], exclude: FrozenSet[str], k: int) -> List[Dict[str, Any]]:
+        np = self._np
+        hits = [(self.postings[s], w) for s, w in weights.items() if s in self.postings]
+        if not hits or k <= 0:
+            return []
+        # все списки одним bincount: одно сложение в C вместо своего scores[idx] += … на каждую основу
+        scores = np.bincount(np.concatenate([idx for (idx, _), _ in hits]),
+                             np.concatenate([pw * w for (_, pw), w in hits]), len(self.items))
+        for s in exclude:
+            p = self.postings.get(s)
+            if p is not None:
+                scores[p[0]] = 0.0
+        scores *= self.boost
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(scores, -k)[-k:]
+        return [self.items[i] for i in top[np.argsort(-scores[top], kind="stable")]]
+
+
+class Recommender:
+    """
+    Текущий CatalogIndex + мемоизация запроса по анкете и правилам (LRU): на анализ остаётся разбор
+    ответа Gemini и поиск. load() зовётся из потока (старт, перезагрузка справочников), индекс
+    и пустой кэш подменяются одним присваиванием — как в rules.RuleEngine.
+    """
+
+    def __init__(self, max_memo: int = 4096):
+        self.max_memo = max_memo
+        self._state: Tuple[Optional[CatalogIndex], "OrderedDict[tuple, tuple]"] = (None, OrderedDict())
+
+    def load(self, rows: Optional[List[Dict[str, Any]]]) -> Optional[CatalogIndex]:
+        index = CatalogIndex(rows) if rows else None
+        self._state = (index, OrderedDict())
+        return index
+
+    @property
+    def index(self) -> Optional[CatalogIndex]:
+        return self._state[0]
+
+    def _profile_query(self, memo: "OrderedDict[tuple, tuple]", profile: Dict[str, Any],
+                       rules_text: str) -> Tuple[Dict[str, float], FrozenSet[str]]:
+        key = tuple(profile.get(f) for f in FIELDS) + (rules_text,)
+        q = memo.get(key)
+        if q is not None:
+            memo.move_to_end(key)
+            return q
+        weights = _query(terms(" . ".join(str(profile.get(f) or "") for f in FIELDS)), SOURCE_PROFILE)
+        pos, neg = terms(rules_text)
+        for s, w in _query((pos, neg), SOURCE_RULES).items():
+            weights.setdefault(s, w)
+        q = memo[key] = (weights, neg)
+        if len(memo) > self.max_memo:
+            memo.popitem(last=False)
+        return q
+
+    def recommend(self, profile: Dict[str, Any], rules_text: str, answer: str, k: int = 3) -> List[Dict[str, Any]]:
+        """
+        Топ-k товаров. Отрицания в правилах («без отдушек», «избегай ретиноидов») исключают товары
+        с этой основой и поднимают товары с тем же отрицанием («без отдушек» в тегах); отрицания в ответе
+        Gemini только поднимают — модель пишет и «без SPF пигментация усилится».
+        """
+        index, memo = self._state
+        if index is None or k <= 0:
+            return []
+        base, exclude = self._profile_query(memo, profile, rules_text)
+        weights = _query(terms(answer), SOURCE_ANSWER)
+        weights.update(base)
+        return index.search(weights, exclude, k)
@@ -1,15 +1,10 @@
 # refdata.py
 import os, json, time
 from typing import Any, Dict, List, Optional
-import gspread
-from google.oauth2.service_account import Credentials
 
 STATE_DIR = os.getenv("STATE_DIR", "./state")
-os.makedirs(STATE_DIR, exist_ok=True)
 
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID") or os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
-if not SPREADSHEET_ID:
-    print("[refdata] WARNING: SPREADSHEET_ID/GOOGLE_SHEETS_SPREADSHEET_ID is empty")
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets.readonly",
@@ -17,6 +12,9 @@ SCOPES = [
 ]
 
 def _gc():
+    # gspread/google-auth тянут за собой много модулей — импортируем при первом обращении к таблице
+    import gspread
+    from google.oauth2.service_account import Credentials
     # два способа: путь к файлу или base64 в переменной (как у тебя сейчас)
     creds_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "")
     creds_b64  = os.getenv("GOOGLE_SHEETS_CREDS", "")
@@ -38,8 +36,7 @@ def _open_ws(client, title: str):
     sh = client.open_by_key(SPREADSHEET_ID)
     return sh.worksheet(title)
 
-def _read_table(ws) -> List[Dict[str, Any]]:
-    rows = ws.get_all_records(numericise_ignore=["all"])
+def _norm_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     def norm(v):
         if isinstance(v, str):
             s = v.strip()
@@ -49,6 +46,22 @@ def _read_table(ws) -> List[Dict[str, Any]]:
         return v
     return [{k: norm(v) for k, v in row.items()} for row in rows]
 
+def _read_table(ws) -> List[Dict[str, Any]]:
+    return _norm_rows(ws.get_all_records(numericise_ignore=["all"]))
+
+def _values_to_table(values: List[List[Any]]) -> List[Dict[str, Any]]:
+    # то же, что get_all_records: первая строка — заголовки, короткие строки добиваются пустыми
+    if not values:
+        return []
+    head = [str(h) for h in values[0]]
+    rows = []
+    for v in values[1:]:
+        if not any(str(x).strip() for x in v):
+            continue
+        v = list(v) + [""] * (len(head) - len(v))
+        rows.append(dict(zip(head, v)))
+    return _norm_rows(rows)
+
 def _load_json_fallback(name: str, default: Any):
     path = os.path.join(STATE_DIR, f"ref_{name}.json")
     if not os.path.exists(path):
@@ -60,10 +73,13 @@ def _load_json_fallback(name: str, default: Any):
         return default
 
 def _save_json_fallback(name: str, data: Any):
+    os.makedirs(STATE_DIR, exist_ok=True)
     path = os.path.join(STATE_DIR, f"ref_{name}.json")
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+TABLES = ("admins", "limits_prices", "catalog", "messages", "feature_flags", "profile_rules")
+
 class RefData:
     def __init__(self):
         self._cache: Dict[str, Any] = {}
@@ -73,10 +89,16 @@ class RefData:
     def _expired(self, key: str) -> bool:
         return time.time() - self._ts.get(key, 0) > self.ttl_sec
 
+    @property
+    def configured(self) -> bool:
+        return bool(SPREADSHEET_ID)
+
     def _load_sheet(self, title: str) -> List[Dict[str, Any]]:
         client = _gc()
         ws = _open_ws(client, title)
-        data = _read_table(ws)
+        return self._store(title, _read_table(ws))
+
+    def _store(self, title: str, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         self._cache[title] = data
         self._ts[title] = time.time()
         _save_json_fallback(title, data)
@@ -95,12 +117,34 @@ class RefData:
             return data
 
     # публичные апи
-    def reload_all(self) -> None:
-        for title in ("admins", "limits_prices", "catalog", "messages", "feature_flags"):
+    def reload_all(self) -> int:
+        """
+        Все справочники одним values_batch_get (авторизация и open_by_key — один раз);
+        если batch не прошёл (например, нет какого-то листа) — по листу. Возвращает число загруженных листов.
+        """
+        if not SPREADSHEET_ID:
+            print("[refdata] WARNING: SPREADSHEET_ID/GOOGLE_SHEETS_SPREADSHEET_ID is empty")
+            return 0
+        try:
+            sh = _gc().open_by_key(SPREADSHEET_ID)
+        except Exception as e:
+            print(f"[refdata] reload failed: {e}")
+            return 0
+        try:
+            resp = sh.values_batch_get([f"'{t}'" for t in TABLES])
+            for title, vr in zip(TABLES, resp.get("valueRanges", [])):
+                self._store(title, _values_to_table(vr.get("values", [])))
+            return len(TABLES)
+        except Exception as e:
+            print(f"[refdata] batch reload failed, loading sheet by sheet: {e}")
+        n = 0
+        for title in TABLES:
             try:
-                self._load_sheet(title)
+                self._store(title, _read_table(sh.worksheet(title)))
+                n += 1
             except Exception as e:
                 print(f"[refdata] reload {title} failed: {e}")
+        return n
 
     def is_admin(self, user_id: int) -> bool:
         rows = self._get("admins")
@@ -129,8 +173,11 @@ class RefData:
         for r in rows:
             if active_only and not bool(r.get("is_active", True)):
                 continue
+            r = dict(r)  # строки кэша не трогаем: иначе tags превращается в str(list) при следующем вызове
             tags = r.get("tags") or ""
-            r["tags"] = [t.strip() for t in str(tags).split(";") if t.strip()]
+            if not isinstance(tags, list):
+                tags = [t.strip() for t in str(tags).split(";") if t.strip()]
+            r["tags"] = tags
             try:
                 r["priority"] = int(r.get("priority", 0))
             except Exception:
@@ -151,6 +198,10 @@ class RefData:
                 return str(r.get("text",""))
         return default if default is not None else key
 
+    def get_profile_rules(self) -> List[Dict[str, Any]]:
+        # правила персонализации (rules.py): id | fields | keywords | condition | text | is_active
+        return [r for r in self._get("profile_rules") if str(r.get("text", "")).strip()]
+
     def feature_enabled(self, flag: str, default: bool = False) -> bool:
         rows = self._get("feature_flags")
         for r in rows:
@@ -0,0 +1,205 @@
+# rules.py — правила персонализации промпта по анкете: лист profile_rules в RefData + встроенные по умолчанию
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+FIELDS = ("skin", "hair", "goals")
+_BIT = {f: 1 << i for i, f in enumerate(FIELDS)}
+_ALL = (1 << len(FIELDS)) - 1
+_SEP = "\x1f"  # между полями в тексте для поиска: ключевое слово не может зацепить два поля
+
+_COND = re.compile(r"^\s*age\s*(<=|>=|<|>|==)\s*(\d+)\s*$")
+_OPS = {"<": int.__lt__, "<=": int.__le__, ">": int.__gt__, ">=": int.__ge__, "==": int.__eq__}
+
+# строки в формате листа profile_rules:
+#   id | fields (skin;hair;goals, пусто — все) | keywords (подстроки через ;) | condition | text | is_active
+# condition: пусто, "age<18" (<, <=, >, >=, ==) или "has:goals"; в text подставляются {age} {skin} {hair} {goals}
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    {"id": "under18", "condition": "age<18",
+     "text": "До 18 лет: избегай ретиноидов и сильных кислот (>5%); только мягкий уход."},
+    {"id": "pregnancy", "keywords": "беремен;pregnan;гв;лактац",
+     "text": "Беременность/лактация: без ретиноидов и BHA >1%, без агрессивных отдушек/эфирных масел; приоритет — ниацинамид, пантенол, церамиды, SPF."},
+    {"id": "rosacea", "keywords": "розаце;купероз;rosacea",
+     "text": "Розацеа/купероз: избегай AHA/BHA высокой концентрации и ретиноидов; только деликатные формулы, без спиртов и отдушек; ежедневный SPF."},
+    {"id": "seborrheic", "keywords": "себор;sd;seborr",
+     "text": "Себорейный дерматит: мягкое очищение, противовоспалительные компоненты (цинк PCA, пироктон оламин); избегай агрессивных ПАВ/скрабов."},
+    {"id": "skin_sensitive", "fields": "skin", "keywords": "чувств",
+     "text": "Кожа чувствительная: без отдушек и спиртов; избегай сильных кислот; пантенол/церамиды/алоэ."},
+    {"id": "skin_oily", "fields": "skin", "keywords": "жир;акне",
+     "text": "Кожа жирная/склонная к акне: лёгкие формулы; при необходимости BHA 1–2%; SPF без масел."},
+    {"id": "skin_dry", "fields": "skin", "keywords": "сух",
+     "text": "Кожа сухая: мягкое очищение, липидное восстановление, увлажнение вечером."},
+    {"id": "skin_pigment", "fields": "skin", "keywords": "пигмент",
+     "text": "Пигментация: дневной SPF обязателен; мягкие осветляющие (ниацинамид, арбутин)."},
+    {"id": "hair_curly", "fields": "hair", "keywords": "кудр",
+     "text": "Кудрявые волосы: без сульфатов; кондиционирование; диффузор на низком нагреве."},
+    {"id": "hair_colored", "fields": "hair", "keywords": "крашен;осветл",
+     "text": "Окрашенные/повреждённые: бережные шампуни, маски с протеинами/липидами, термозащита."},
+    {"id": "goals", "condition": "has:goals", "text": "Приоритизируй цели пользователя: {goals}."},
+]
+
+NO_RULES = "Правила персонализации: нет особых ограничений."
+
+
+class _Vars(dict):
+    def __missing__(self, key: str) -> str:
+        return "{" + key + "}"
+
+
+class _Rule:
+    __slots__ = ("id", "mask", "keywords", "cond", "text", "templated")
+
+    def __init__(self, row: Dict[str, Any]):
+        self.id = str(row.get("id") or "")
+        fields = [f.strip().lower() for f in str(row.get("fields") or "").split(";") if f.strip()]
+        self.mask = sum(_BIT[f] for f in set(fields) if f in _BIT) or _ALL
+        self.keywords = [k.strip().lower() for k in str(row.get("keywords") or "").split(";") if k.strip()]
+        self.cond = _parse_condition(str(row.get("condition") or ""))
+        self.text = str(row.get("text") or "").strip()
+        self.templated = "{" in self.text
+
+
+def _parse_condition(s: str):
+    s = s.strip().lower()
+    if not s:
+        return None
+    if s.startswith("has:"):
+        field = s[4:].strip()
+        return lambda p: bool(p.get(field))
+    m = _COND.match(s)
+    if not m:
+        raise ValueError(f"bad condition: {s!r}")
+    op, n = _OPS[m.group(1)], int(m.group(2))
+
+    def check(p: Dict[str, Any]) -> bool:
+        try:
+            return bool(p.get("age")) and op(int(p["age"]), n)
+        except (TypeError, ValueError):
+            return False
+    return check
+
+
+def _trie_regex(words: List[str]) -> str:
+    """Слова -> регулярка-бор с общими префиксами: на каждой позиции re идёт по одной ветке, а не по всем словам."""
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node: Dict[str, Any]) -> str:
+        end = "" in node
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if end:  # слово кончается здесь, но жадно пробуем продолжение — находим самое длинное
+            return ("(?:" + body + ")?") if len(alts) == 1 else body + "?"
+        return body
+    return build(trie)
+
+
+class RuleSet:
+    """
+    Скомпилированный набор: все ключевые слова — одна регулярка-бор (?=(…)), один проход finditer
+    по тексту анкеты находит самое длинное слово в каждой позиции, более короткие слова-префиксы
+    добираются по заранее построенной таблице; дальше смотрим только сработавшие правила
+    и правила без ключевых слов. Стоимость разбора анкеты почти не зависит от числа правил.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rules: List[_Rule] = []
+        self.errors: List[str] = []
+        for row in rows:
+            if row.get("is_active", True) is False:
+                continue
+            try:
+                r = _Rule(row)
+            except ValueError as e:
+                self.errors.append(f"{row.get('id')}: {e}")
+                continue
+            if r.text:
+                self.rules.append(r)
+        by_kw: Dict[str, List[Tuple[int, int]]] = {}
+        for i, r in enumerate(self.rules):
+            for kw in r.keywords:
+                by_kw.setdefault(kw, []).append((i, r.mask))
+        self._by_kw = by_kw
+        kws = sorted(by_kw, key=len, reverse=True)
+        self._prefixes = {kw: [k for k in kws if kw.startswith(k)] for kw in kws}
+        self._pattern = re.compile("(?=(" + _trie_regex(kws) + "))") if kws else None
+        self._unkeyed = [i for i, r in enumerate(self.rules) if not r.keywords]
+
+    def evaluate(self, profile: Dict[str, Any]) -> List[str]:
+        vals = {f: str(profile.get(f) or "").lower() for f in FIELDS}
+        fired = set(self._unkeyed)
+        if self._pattern is not None:
+            text = _SEP.join(vals[f] for f in FIELDS)
+            bounds = []
+            pos = 0
+            for f in FIELDS:
+                pos += len(vals[f])
+                bounds.append((pos, _BIT[f]))
+                pos += 1
+            for m in self._pattern.finditer(text):
+                at = m.start()
+                bit = next(b for end, b in bounds if at < end)
+                for kw in self._prefixes[m.group(1)]:
+                    for i, mask in self._by_kw[kw]:
+                        if mask & bit:
+                            fired.add(i)
+        out = []
+        subst: Optional[_Vars] = None
+        for i in sorted(fired):
+            r = self.rules[i]
+            if r.cond is not None and not r.cond(profile):
+                continue
+            if r.templated:
+                if subst is None:
+                    subst = _Vars(vals, age=profile.get("age") or "")
+                try:
+                    out.append(r.text.format_map(subst))
+                except (ValueError, IndexError):
+                    out.append(r.text)
+            else:
+                out.append(r.text)
+        return out
+
+
+class RuleEngine:
+    """
+    Текущий RuleSet + мемоизация готового блока правил по содержимому анкеты (LRU).
+    load() зовётся из потока (старт, перезагрузка справочников): новый набор и пустой кэш
+    подменяются одним присваиванием, читатели в event loop видят либо старое, либо новое.
+    """
+
+    def __init__(self, max_memo: int = 4096):
+        self.max_memo = max_memo
+        self.source = "default"
+        self._state: Tuple[RuleSet, "OrderedDict[tuple, str]"] = (RuleSet(DEFAULT_RULES), OrderedDict())
+
+    def load(self, rows: Optional[List[Dict[str, Any]]]) -> RuleSet:
+        """Правила из листа; пустой лист — встроенные DEFAULT_RULES."""
+        rs = RuleSet(rows) if rows else RuleSet(DEFAULT_RULES)
+        self.source = "sheet" if rows else "default"
+        self._state = (rs, OrderedDict())
+        return rs
+
+    @property
+    def ruleset(self) -> RuleSet:
+        return self._state[0]
+
+    def block(self, profile: Dict[str, Any]) -> str:
+        rs, memo = self._state
+        key = (profile.get("age"),) + tuple(profile.get(f) for f in FIELDS)
+        text = memo.get(key)
+        if text is not None:
+            memo.move_to_end(key)
+            return text
+        rules = rs.evaluate(profile)
+        text = ("Правила персонализации:\n- " + "\n- ".join(rules)) if rules else NO_RULES
+        memo[key] = text
+        if len(memo) > self.max_memo:
+            memo.popitem(last=False)
+        return text
@@ -0,0 +1,174 @@
+# scheduler.py — события по premium_until: напоминание, автопродление, окончание
+import time, heapq, asyncio, logging
+from bisect import bisect_left, bisect_right, insort
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+log = logging.getLogger("beauty-nano-bot.scheduler")
+
+Handler = Callable[[int, int], Awaitable[None]]  # (user_id, premium_until)
+
+REMIND, RENEW, EXPIRE = "remind", "renew", "expire"
+
+
+class PremiumScheduler:
+    """
+    Два индекса по premium_until:
+      * _heap — min-heap событий (fire_at, kind, uid, until); устаревшие записи не удаляются,
+        а отбрасываются при извлечении (until != текущему до для uid);
+      * _sorted — отсортированный список (until, uid) активных подписок: «активные» и
+        «истекают скоро» — срез с нужного края за O(log n + k), без обхода USAGE.
+    Срабатывания обрабатываются пачками по `batch` с паузой `batch_pause` — чтобы массовое
+    окончание подписок не упёрлось в лимиты Telegram/ЮKassa. Упавшее автопродление (сеть, 5xx)
+    ставится заново через renew_retry_sec, 2×, 4×… — пока повтор успевает до окончания срока.
+    "Активные" — срок ещё не прошёл; Stars-подписки после срока (grace) считаются отдельно.
+    """
+
+    def __init__(self, remind_before: int = 3 * 86400, renew_before: int = 3600,
+                 batch: int = 20, batch_pause: float = 1.0, idle_sec: float = 60.0,
+                 renew_retry_sec: float = 60.0):
+        self.remind_before = remind_before
+        self.renew_before = renew_before
+        self.batch = batch
+        self.batch_pause = batch_pause
+        self.idle_sec = idle_sec
+        self.renew_retry_sec = renew_retry_sec
+        self.handlers: Dict[str, Handler] = {}
+        self._until: Dict[int, int] = {}
+        self._expire_at: Dict[int, int] = {}
+        self._renew_tries: Dict[int, int] = {}
+        self._renew: Set[int] = set()  # у кого автопродление включено сейчас: RENEW в куче без него — устаревший
+        self._sorted: List[Tuple[int, int]] = []
+        self._heap: List[Tuple[int, str, int, int]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.fired: Dict[str, int] = {REMIND: 0, RENEW: 0, EXPIRE: 0}
+        self.renew_retries = 0
+
+    # ---- индекс ----
+    def track(self, uid: int, until: int, grace: int = 0, renew: bool = False) -> None:
+        """Новое значение premium_until пользователя (0 — премиум снят)."""
+        now = int(time.time())
+        old = self._until.pop(uid, None)
+        self._expire_at.pop(uid, None)
+        self._renew_tries.pop(uid, None)
+        self._renew.discard(uid)
+        if old is not None:
+            i = bisect_left(self._sorted, (old, uid))
+            if i < len(self._sorted) and self._sorted[i] == (old, uid):
+                del self._sorted[i]
+        if not until or until + grace <= now:
+            return
+        self._until[uid] = until
+        self._expire_at[uid] = until + grace
+        insort(self._sorted, (until, uid))
+        heapq.heappush(self._heap, (until + grace, EXPIRE, uid, until))
+        if until - self.remind_before > now:
+            heapq.heappush(self._heap, (until - self.remind_before, REMIND, uid, until))
+        if renew:
+            self._renew.add(uid)
+            heapq.heappush(self._heap, (max(now, until - self.renew_before), RENEW, uid, until))
+        if self._wake and self._heap[0][0] <= until + grace:
+            self._wake.set()
+
+    def load(self, items) -> None:
+        """Начальная загрузка: итерируемое (uid, until, grace, renew)."""
+        for uid, until, grace, renew in items:
+            self.track(uid, until, grace, renew)
+
+    def count_active(self, now: Optional[int] = None) -> int:
+        now = int(time.time()) if now is None else now
+        return len(self._sorted) - bisect_right(self._sorted, (now, float("inf")))
+
+    def count_grace(self, now: Optional[int] = None) -> int:
+        """Срок прошёл, но EXPIRE ещё не наступил — Stars-подписки, которые Telegram может продлить."""
+        now = int(time.time()) if now is None else now
+        return bisect_right(self._sorted, (now, float("inf")))
+
+    def active(self, k: int = 12, now: Optional[int] = None) -> List[Tuple[int, int]]:
+        """k подписок с самым дальним сроком: [(uid, until)], по убыванию срока; grace не входит."""
+        if k <= 0:
+            return []
+        now = int(time.time()) if now is None else now
+        i = max(bisect_right(self._sorted, (now, float("inf"))), len(self._sorted) - k)
+        return [(uid, until) for until, uid in reversed(self._sorted[i:])]
+
+    def expiring(self, within_sec: int, k: int = 12, now: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Ближайшие к окончанию (в пределах within_sec): [(uid, until)], по возрастанию срока."""
+        now = int(time.time()) if now is None else now
+        i = bisect_right(self._sorted, (now, float("inf")))
+        out = []
+        for until, uid in self._sorted[i:i + k]:
+            if until > now + within_sec:
+                break
+            out.append((uid, until))
+        return out
+
+    # ---- цикл ----
+    async def start(self) -> None:
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="premium-scheduler")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+
+    def _due(self, now: int) -> List[Tuple[str, int, int]]:
+        out = []
+        while self._heap and self._heap[0][0] <= now and len(out) < self.batch:
+            _, kind, uid, until = heapq.heappop(self._heap)
+            if self._until.get(uid) != until:
+                continue  # срок уже менялся — событие устарело
+            if kind == RENEW and uid not in self._renew:
+                continue  # автопродление отключили
+            if kind == EXPIRE:
+                self._until.pop(uid, None)
+                self._expire_at.pop(uid, None)
+                self._renew_tries.pop(uid, None)
+                self._renew.discard(uid)
+                i = bisect_left(self._sorted, (until, uid))
+                if i < len(self._sorted) and self._sorted[i] == (until, uid):
+                    del self._sorted[i]
+            out.append((kind, uid, until))
+        return out
+
+    def _retry_renew(self, uid: int, until: int) -> None:
+        if self._until.get(uid) != until or uid not in self._renew:
+            return
+        n = self._renew_tries.get(uid, 0)
+        at = int(time.time() + self.renew_retry_sec * 2 ** n)
+        if at >= until:
+            self._renew_tries.pop(uid, None)
+            log.warning("renew for %s: %d attempts failed, no time left before %d", uid, n + 1, until)
+            return
+        self._renew_tries[uid] = n + 1
+        self.renew_retries += 1
+        heapq.heappush(self._heap, (at, RENEW, uid, until))
+
+    async def _run(self) -> None:
+        while True:
+            now = int(time.time())
+            due = self._due(now)
+            for kind, uid, until in due:
+                handler = self.handlers.get(kind)
+                if not handler:
+                    continue
+                try:
+                    await handler(uid, until)
+                    self.fired[kind] += 1
+                    if kind == RENEW:
+                        self._renew_tries.pop(uid, None)
+                except Exception:
+                    log.exception("scheduler %s for %s failed", kind, uid)
+                    if kind == RENEW:
+                        self._retry_renew(uid, until)
+            if len(due) >= self.batch:
+                await asyncio.sleep(self.batch_pause)
+                continue
+            delay = self.idle_sec if not self._heap else min(self.idle_sec, max(0.0, self._heap[0][0] - time.time()))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
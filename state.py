@@ -0,0 +1,144 @@
+# state.py — единственный писатель состояния: команды применяются по порядку в event loop,
+# запись на диск — пачками, с задержкой, из снимков
+import os, json, asyncio, logging
+from typing import Any, Callable, Dict, Optional
+
+log = logging.getLogger("beauty-nano-bot.state")
+
+_TICK = object()
+_STOP = object()
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+class StateWriter:
+    """
+    Все изменения общих словарей (USAGE, HISTORY, ...) происходят в потоке event loop:
+    хендлеры меняют их напрямую (они и так в loop), а фоновые потоки присылают команды через submit().
+    persist(...) только помечает разделы грязными; сам writer раз в `delay` секунд
+    снимает копии грязных разделов (в loop, без await — значит, согласованно) и пишет их в файлы
+    в отдельном потоке. json.dump никогда не видит словарь, который кто-то меняет.
+    """
+
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay
+        self._files: Dict[str, tuple[str, Callable[[], Any]]] = {}
+        self._snaps: Dict[str, Any] = {}
+        self._dirty: set[str] = set()
+        self._q: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._woken = False
+        self.flushes = 0
+
+    def register(self, name: str, path: str, snapshot: Callable[[], Any]) -> None:
+        """snapshot() вызывается в loop и должен вернуть независимую копию данных."""
+        self._files[name] = (path, snapshot)
+
+    # ---- запись ----
+    def persist(self, *names: str) -> None:
+        names = names or tuple(self._files)
+        if not self.running:
+            # до старта loop (bootstrap, скрипты) — пишем сразу
+            self._write({n: self._files[n][1]() for n in names})
+            return
+        if self._in_loop():
+            self._dirty.update(names)
+            self._wake()
+        else:
+            self._loop.call_soon_threadsafe(self.persist, *names)
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        """Применить команду в потоке loop в порядке поступления. Можно звать из любого потока."""
+        if not self.running:
+            fn(*args)
+            return
+        if self._in_loop():
+            self._q.put_nowait((fn, args))
+        else:
+            self._loop.call_soon_threadsafe(self._q.put_nowait, (fn, args))
+
+    def snapshot(self, name: str, default: Any = None) -> Any:
+        """Последний записанный снимок раздела — читать можно из любого потока, без локов."""
+        return self._snaps.get(name, default)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def dirty(self) -> int:
+        return len(self._dirty)
+
+    # ---- жизненный цикл ----
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._q = asyncio.Queue()
+        self._snaps = {n: snap() for n, (_, snap) in self._files.items()}
+        self._task = asyncio.create_task(self._run(), name="state-writer")
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self._q.put_nowait(_STOP)
+        await self._task
+
+    # ---- внутреннее ----
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _wake(self) -> None:
+        if not self._woken:
+            self._woken = True
+            self._q.put_nowait(_TICK)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline: Optional[float] = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                cmd = await asyncio.wait_for(self._q.get(), timeout)
+            except asyncio.TimeoutError:
+                cmd = None
+            if cmd is _STOP:
+                await self._flush()
+                return
+            if cmd is _TICK:
+                self._woken = False
+            elif cmd is not None:
+                fn, args = cmd
+                try:
+                    fn(*args)
+                except Exception:
+                    log.exception("state command %s failed", getattr(fn, "__name__", fn))
+            if self._dirty and deadline is None:
+                deadline = loop.time() + self.delay
+            if deadline is not None and loop.time() >= deadline:
+                deadline = None
+                await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._dirty:
+            return
+        names, self._dirty = self._dirty, set()
+        snaps = {n: self._files[n][1]() for n in names}
+        await asyncio.to_thread(self._write, snaps)
+
+    def _write(self, snaps: Dict[str, Any]) -> None:
+        for name, data in snaps.items():
+            path = self._files[name][0]
+            try:
+                write_json_atomic(path, data)
+            except Exception as e:
+                log.warning("Can't save %s: %s", path, e)
+            self._snaps[name] = data
+        self.flushes += 1
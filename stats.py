@@ -0,0 +1,102 @@
+# stats.py — счётчики, обновляемые по событиям, и компактные почасовые/подневные свёртки
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+HOURS_KEEP = 48
+DAYS_KEEP = 120
+
+
+class StatsCounters:
+    """
+    Вместо пересчёта на экране статистики (обход USAGE, выгрузка листа analyses) —
+    инкремент в момент события. Хранится:
+      totals  — итоги с начала учёта: {"analyses": n, "mode:face": n, "conv:stars": n, "fb:up": n, ...}
+      hours   — {"YYYYMMDDHH": {...}} за последние HOURS_KEEP часов
+      days    — {"YYYYMMDD": {...}} за последние DAYS_KEEP дней
+    Все изменения — в event loop; on_change помечает раздел грязным для StateWriter.
+    """
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None, on_change: Optional[Callable[[], None]] = None):
+        self.on_change = on_change
+        self.load(data)
+
+    def load(self, data: Optional[Dict[str, Any]]) -> None:
+        data = data or {}
+        self.totals: Dict[str, int] = dict(data.get("totals") or {})
+        self.hours: Dict[str, Dict[str, int]] = dict(data.get("hours") or {})
+        self.days: Dict[str, Dict[str, int]] = dict(data.get("days") or {})
+        self.since: int = int(data.get("since") or time.time())
+        self._last_trim = ""
+
+    # ---- события ----
+    def incr(self, *keys: str, n: int = 1, ts: Optional[float] = None) -> None:
+        dt = datetime.fromtimestamp(ts or time.time())
+        hk, dk = dt.strftime("%Y%m%d%H"), dt.strftime("%Y%m%d")
+        hb = self.hours.setdefault(hk, {})
+        db = self.days.setdefault(dk, {})
+        for k in keys:
+            self.totals[k] = self.totals.get(k, 0) + n
+            hb[k] = hb.get(k, 0) + n
+            db[k] = db.get(k, 0) + n
+        if hk != self._last_trim:
+            self._trim(dt)
+            self._last_trim = hk
+        if self.on_change:
+            self.on_change()
+
+    def analysis(self, mode: str) -> None:
+        self.incr("analyses", f"mode:{mode}")
+
+    def conversion(self, source: str) -> None:
+        self.incr("conversions", f"conv:{source}")
+
+    def feedback(self, value: str) -> None:
+        self.incr(f"fb:{value}")
+
+    def new_user(self) -> None:
+        self.incr("new_users")
+
+    # ---- чтение ----
+    def total(self, key: str) -> int:
+        return int(self.totals.get(key, 0))
+
+    def series_days(self, key: str, n: int = 14) -> List[Tuple[str, int]]:
+        now = time.time()
+        out = []
+        for i in range(n - 1, -1, -1):
+            dk = datetime.fromtimestamp(now - i * 86400).strftime("%Y%m%d")
+            out.append((dk, int(self.days.get(dk, {}).get(key, 0))))
+        return out
+
+    def series_hours(self, key: str, n: int = 24) -> List[Tuple[str, int]]:
+        now = time.time()
+        out = []
+        for i in range(n - 1, -1, -1):
+            hk = datetime.fromtimestamp(now - i * 3600).strftime("%Y%m%d%H")
+            out.append((hk, int(self.hours.get(hk, {}).get(key, 0))))
+        return out
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"since": self.since, "totals": dict(self.totals),
+                "hours": {k: dict(v) for k, v in self.hours.items()},
+                "days": {k: dict(v) for k, v in self.days.items()}}
+
+    def _trim(self, dt: datetime) -> None:
+        ts = dt.timestamp()
+        h_min = datetime.fromtimestamp(ts - HOURS_KEEP * 3600).strftime("%Y%m%d%H")
+        d_min = datetime.fromtimestamp(ts - DAYS_KEEP * 86400).strftime("%Y%m%d")
+        for k in [k for k in self.hours if k < h_min]:
+            del self.hours[k]
+        for k in [k for k in self.days if k < d_min]:
+            del self.days[k]
+
+
+SPARK = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values: List[int]) -> str:
+    top = max(values) if values else 0
+    if top <= 0:
+        return SPARK[0] * len(values)
+    return "".join(SPARK[min(len(SPARK) - 1, v * (len(SPARK) - 1) // top)] for v in values)
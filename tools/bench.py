@@ -0,0 +1,391 @@
+# tools/bench.py — микробенчмарки горячих функций бота с базовой линией и проверкой регрессий
+#
+#   python tools/bench.py                    # прогнать и показать
+#   python tools/bench.py --save             # записать базовую линию (tools/bench_baseline.json)
+#   python tools/bench.py --check            # сравнить с базовой линией; медленнее на > tolerance — exit 1
+#   python tools/bench.py --check -k refdata --tolerance 0.4
+#
+# Базовая линия своя на каждой машине (в git не кладём): сначала --save на чистом дереве, потом --check.
+# Замер — минимум по повторам среднего времени вызова; число вызовов в повторе подбирается так,
+# чтобы повтор длился не меньше --min-time; сборщик мусора на время повтора выключен (как в timeit).
+# Sheets/Gemini/Telegram не трогаются.
+import gc, os, sys, json, time, random, atexit, shutil, asyncio, logging, argparse, platform, tempfile
+from typing import Any, Awaitable, Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, "bench_baseline.json")
+
+# до импорта main: состояние пишется во временный каталог, внешние интеграции выключены
+_DATA = tempfile.mkdtemp(prefix="bench-")
+atexit.register(shutil.rmtree, _DATA, ignore_errors=True)
+os.environ.update({
+    "BOT_TOKEN": "123:bench", "GEMINI_API_KEY": "bench", "DATA_DIR": _DATA,
+    "STATE_DIR": os.path.join(_DATA, "state"), "SHEETS_ENABLED": "0", "SPREADSHEET_ID": "",
+    "GOOGLE_SHEETS_SPREADSHEET_ID": "", "TRACE_SAMPLE_RATE": "0", "LOOP_MONITOR": "0",
+    "PERSIST_DELAY_SEC": "1e9",  # в замерах persist() только помечает разделы, запись меряем отдельно
+})
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import main as m  # noqa: E402
+from refdata import REF  # noqa: E402
+from rules import RuleSet, DEFAULT_RULES  # noqa: E402
+import prescreen  # noqa: E402
+from recommend import Recommender  # noqa: E402
+from fakes import fake_answer, sample_jpeg  # noqa: E402
+
+Case = Callable[[int], Any]  # bench(loops) — выполнить тело loops раз
+
+
+# ---------- замер ----------
+def _once(fn: Case, loops: int) -> float:
+    gc.collect(); gc.disable()
+    try:
+        t = time.perf_counter(); fn(loops)
+        return time.perf_counter() - t
+    finally:
+        gc.enable()
+
+
+async def _aonce(fn: Callable[[int], Awaitable[Any]], loops: int) -> float:
+    gc.collect(); gc.disable()
+    try:
+        t = time.perf_counter(); await fn(loops)
+        return time.perf_counter() - t
+    finally:
+        gc.enable()
+
+
+def _timeit(fn: Case, min_time: float, repeat: int) -> tuple[float, int]:
+    loops = 1
+    while True:
+        dt = _once(fn, loops)
+        if dt >= min_time or loops >= 1 << 24:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(dt, 1e-9) * 1.1))
+    best = dt / loops
+    for _ in range(repeat - 1):
+        best = min(best, _once(fn, loops) / loops)
+    return best * 1e6, loops
+
+
+async def _atimeit(fn: Callable[[int], Awaitable[Any]], min_time: float, repeat: int) -> tuple[float, int]:
+    loops = 1
+    while True:
+        dt = await _aonce(fn, loops)
+        if dt >= min_time or loops >= 1 << 20:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(dt, 1e-9) * 1.1))
+    best = dt / loops
+    for _ in range(repeat - 1):
+        best = min(best, await _aonce(fn, loops) / loops)
+    return best * 1e6, loops
+
+
+# ---------- фикстуры ----------
+ANSWER = fake_answer(6000)        # длинный ответ Gemini (около полутора сообщений)
+ANSWER_LONG = fake_answer(20000)  # с запасом на разбиение на 6 частей
+
+PROFILE = {"profile": {"age": "34", "skin": "Комбинированная, чувствительная, пигментация",
+                       "hair": "Окрашенные, кудрявые", "goals": "выровнять тон, меньше жирного блеска, беременность"}}
+
+BIG_RULES = [{"id": f"r{i}", "fields": ("skin", "hair", "goals", "")[i % 4], "keywords": f"триггер{i};kw{i}x;маркер{i % 37}",
+              "condition": "age>=30" if i % 5 == 0 else "", "text": f"Правило {i}: {{goals}}"} for i in range(400)]
+
+
+class _Chat:
+    """Вместо telegram.Chat: send_message ничего не отправляет."""
+    sent = 0
+
+    async def send_message(self, text: str, **kw: Any) -> None:
+        _Chat.sent += 1
+
+
+def fill_users(n: int, seed: int = 1) -> None:
+    rnd = random.Random(seed)
+    now = int(time.time()); month = time.gmtime().tm_mon
+    for c in (m.USERS, m.USERNAMES, m.USAGE, m.HISTORY):
+        c.clear()
+    for uid in range(10_000_000, 10_000_000 + n):
+        m.USERS.add(uid)
+        m.USERNAMES[uid] = f"user{uid}"
+        u: Dict[str, Any] = {"count": rnd.randint(0, 5), "month": month, "premium": False}
+        if rnd.random() < 0.1:
+            u.update(premium=True, premium_until=now + rnd.randint(1, 30) * 86400)
+            if rnd.random() < 0.5:
+                u["yk_payment_method_id"] = f"pm-{uid}"
+        m.USAGE[uid] = u
+        if rnd.random() < 0.2:
+            m.HISTORY[str(uid)] = [{"ts": now - i * 3600, "mode": rnd.choice(list(m.MODES))}
+                                   for i in range(rnd.randint(1, m.HISTORY_LIMIT))]
+
+
+def fill_refdata(skus: int = 3000, seed: int = 2) -> None:
+    rnd = random.Random(seed)
+    tags = ["сухая", "жирная", "чувствительная", "акне", "пигментация", "spf", "ниацинамид", "церамиды",
+            "кудрявые", "окрашенные", "протеины", "пантенол", "ретинол", "bha", "aha", "увлажнение"]
+    inci = ["aqua", "glycerin", "niacinamide", "panthenol", "ceramide np", "retinol", "salicylic acid",
+            "zinc pca", "squalane", "hyaluronic acid", "parfum", "alcohol denat", "allantoin", "tocopherol"]
+    far = time.time() + 10 * 365 * 86400  # кэш не протухает во время замера
+    data = {
+        "admins": [{"user_id": str(100 + i), "is_active": i % 3 != 0} for i in range(50)],
+        "limits_prices": [{"key": f"limit_{i}", "value": str(i)} for i in range(60)],
+        "catalog": [{"sku": f"SKU-{i:05d}", "title": f"Средство {i}", "brand": f"Бренд {i % 40}",
+                     "tags": ";".join(rnd.sample(tags, rnd.randint(1, 5))),
+                     "ingredients": ", ".join(rnd.sample(inci, rnd.randint(3, 8))),
+                     "priority": str(rnd.randint(0, 100)), "is_active": rnd.random() > 0.1,
+                     "url": f"https://shop.example/p/{i}"} for i in range(skus)],
+        "messages": [{"key": f"msg_{i}", "locale": loc, "text": f"Текст сообщения {i} ({loc})"}
+                     for i in range(100) for loc in ("ru", "en")],
+        "feature_flags": [{"flag": f"flag_{i}", "enabled": i % 2 == 0} for i in range(30)],
+    }
+    for title, rows in data.items():
+        REF._cache[title] = rows
+        REF._ts[title] = far
+
+
+# ---------- кейсы ----------
+def sync_cases(sizes: List[int]) -> Dict[str, Callable[[], Case]]:
+    """name -> setup(); setup готовит фикстуры и возвращает bench(loops)."""
+    cases: Dict[str, Callable[[], Case]] = {}
+
+    def text_case(fn, arg):
+        def setup():
+            def bench(loops):
+                for _ in range(loops): fn(arg)
+            return bench
+        return setup
+
+    cases["format.emoji_bullets"] = text_case(m._emoji_bullets, ANSWER)
+    cases["format.themed_headings"] = text_case(m._themed_headings, ANSWER)
+    cases["format.split_chunks"] = text_case(m._split_chunks, m._themed_headings(m._emoji_bullets(ANSWER_LONG)))
+    cases["profile.context"] = text_case(m._profile_context, PROFILE)
+    cases["profile.context_empty"] = text_case(m._profile_context, {})
+    # без мемоизации RuleEngine.block: сам разбор анкеты, встроенные правила и лист на 400 правил
+    cases["rules.evaluate"] = text_case(RuleSet(DEFAULT_RULES).evaluate, PROFILE["profile"])
+    cases["rules.evaluate_400"] = text_case(RuleSet(BIG_RULES + DEFAULT_RULES).evaluate, PROFILE["profile"])
+
+    def prescreen_setup():
+        import io
+        import numpy as np
+        from PIL import Image
+        im = Image.open(io.BytesIO(sample_jpeg((1600, 1200))))
+        im.thumbnail((m.IMAGE_MAX_SIDE, m.IMAGE_MAX_SIDE))
+        gray = np.asarray(im.convert("L"))
+        def bench(loops):
+            for _ in range(loops): prescreen.check(gray, (1600, 1200), prescreen.DEFAULTS)
+        return bench
+
+    cases["prescreen.check"] = prescreen_setup
+
+    def usage_setup(premium: bool):
+        def setup():
+            fill_users(1000)
+            m.CONFIG["FREE_LIMIT"] = 1 << 62
+            uid = 10_000_000
+            m.USAGE[uid] = {"count": 0, "month": time.gmtime().tm_mon, "premium": premium,
+                            "premium_until": int(time.time()) + 86400 if premium else 0}
+            def bench(loops):
+                for _ in range(loops): m.check_usage(uid)
+            return bench
+        return setup
+
+    def usage_entry_setup():
+        fill_users(1000)
+        uids = list(m.USAGE)
+        def bench(loops):
+            for i in range(loops): m.usage_entry(uids[i % len(uids)])
+        return bench
+
+    cases["usage.entry"] = usage_entry_setup
+    cases["usage.check_free"] = usage_setup(False)
+    cases["usage.check_premium"] = usage_setup(True)
+
+    for n in sizes:
+        def snap_setup(n=n):
+            fill_users(n)
+            def bench(loops):
+                for _ in range(loops): {k: f() for k, (_, f) in m.STATE._files.items()}
+            return bench
+
+        def flush_setup(n=n):
+            fill_users(n)
+            def bench(loops):
+                for _ in range(loops): m.STATE._write({k: f() for k, (_, f) in m.STATE._files.items()})
+            return bench
+
+        cases[f"state.snapshot[{n}]"] = snap_setup
+        cases[f"state.persist_all[{n}]"] = flush_setup
+
+    def ref_case(call):
+        def setup():
+            fill_refdata()
+            def bench(loops):
+                for _ in range(loops): call()
+            return bench
+        return setup
+
+    cases["refdata.is_admin_miss"] = ref_case(lambda: REF.is_admin(1))
+    cases["refdata.get_limit_last"] = ref_case(lambda: REF.get_limit("limit_59", 0))
+    cases["refdata.get_catalog"] = ref_case(lambda: REF.get_catalog())
+    cases["refdata.get_sku_last"] = ref_case(lambda: REF.get_sku("SKU-02999"))
+    cases["refdata.msg_miss"] = ref_case(lambda: REF.msg("nope", default=""))
+    cases["refdata.feature_enabled"] = ref_case(lambda: REF.feature_enabled("flag_29"))
+
+    def recommend_setup():
+        # как при доставке анализа: запрос по анкете из кэша, разбор ответа Gemini и поиск по 3000 SKU
+        fill_refdata()
+        reco = Recommender()
+        reco.load(REF.get_catalog())
+        pr = PROFILE["profile"]
+        rules_text = m.RULES.block(pr)
+        def bench(loops):
+            for _ in range(loops): reco.recommend(pr, rules_text, ANSWER, 3)
+        return bench
+
+    cases["recommend.analysis"] = recommend_setup
+    return cases
+
+
+def async_cases() -> Dict[str, Callable[[], Callable[[int], Awaitable[Any]]]]:
+    def send_setup(text):
+        def setup():
+            chat = _Chat()
+            async def bench(loops):
+                for _ in range(loops): await m.send_html_long(chat, text)
+            return bench
+        return setup
+
+    html = m._themed_headings(m._emoji_bullets(ANSWER_LONG))
+    return {
+        "send.html_long": send_setup(html),
+        "send.html_short": send_setup(m._themed_headings(m._emoji_bullets(fake_answer(1500)))),
+    }
+
+
+# ---------- прогон ----------
+async def run(args, base: Dict[str, Dict[str, Any]] | None = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Прогоняет выбранные кейсы. С base: кейс, вышедший за допуск, перемеряется до args.confirm раз
+    (берётся лучший) — одиночный выброс на шумной машине не валит прогон.
+    """
+    # STATE запущен в loop, но с огромной задержкой — persist() в горячих путях только помечает разделы
+    await m.STATE.start()
+    results: Dict[str, Dict[str, Any]] = {}
+    sizes = [int(x) for x in args.users.split(",") if x]
+
+    def want(name: str) -> bool:
+        return not args.k or any(k in name for k in args.k)
+
+    def slow(name: str, us: float) -> bool:
+        b = (base or {}).get(name)
+        return bool(b) and us > b["us"] * (1 + args.tolerance)
+
+    try:
+        for name, setup in sync_cases(sizes).items():
+            if not want(name):
+                continue
+            bench = setup()
+            repeat = 3 if name.startswith("state.") and not args.quick else args.repeat
+            us, loops = _timeit(bench, args.min_time, repeat)
+            for _ in range(args.confirm if slow(name, us) else 0):
+                us = min(us, _timeit(bench, args.min_time, repeat)[0])
+                if not slow(name, us):
+                    break
+            results[name] = {"us": round(us, 3), "loops": loops}
+            _line(name, results[name])
+        for name, setup in async_cases().items():
+            if not want(name):
+                continue
+            bench = setup()
+            us, loops = await _atimeit(bench, args.min_time, args.repeat)
+            for _ in range(args.confirm if slow(name, us) else 0):
+                us = min(us, (await _atimeit(bench, args.min_time, args.repeat))[0])
+                if not slow(name, us):
+                    break
+            results[name] = {"us": round(us, 3), "loops": loops}
+            _line(name, results[name])
+    finally:
+        m.STATE._task.cancel()  # не сбрасываем на диск то, что намусорили фикстуры
+    return results
+
+
+def _fmt(us: float) -> str:
+    if us >= 1e6: return f"{us / 1e6:8.2f} s "
+    if us >= 1e3: return f"{us / 1e3:8.2f} ms"
+    return f"{us:8.2f} µs"
+
+
+def _line(name: str, r: Dict[str, Any], extra: str = "") -> None:
+    print(f"  {name:<30} {_fmt(r['us'])}  x{r['loops']:<7} {extra}", flush=True)
+
+
+def compare(results: Dict[str, Dict[str, Any]], base: Dict[str, Dict[str, Any]], tol: float) -> List[str]:
+    bad = []
+    print(f"\nсравнение с базовой линией (допуск +{tol:.0%}):")
+    for name, r in results.items():
+        b = base.get(name)
+        if not b:
+            print(f"  {name:<30} нет в базовой линии")
+            continue
+        ratio = r["us"] / b["us"] if b["us"] else 1.0
+        mark = "REGRESSION" if ratio > 1 + tol else ("faster" if ratio < 1 - tol else "ok")
+        print(f"  {name:<30} {_fmt(b['us'])} -> {_fmt(r['us'])}  {ratio:6.2f}x  {mark}")
+        if mark == "REGRESSION":
+            bad.append(name)
+    return bad
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Микробенчмарки горячих функций бота")
+    ap.add_argument("-k", action="append", help="только кейсы, содержащие подстроку (можно несколько)")
+    ap.add_argument("--users", default="1000,10000,100000", help="размеры состояния для state.* (через запятую)")
+    ap.add_argument("--min-time", type=float, default=0.05, help="минимальная длительность повтора, с")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--quick", action="store_true", help="меньше повторов и без 100k пользователей")
+    ap.add_argument("--save", action="store_true", help="записать результат как базовую линию")
+    ap.add_argument("--check", action="store_true", help="сравнить с базовой линией, регрессия — exit 1")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление (0.25 = +25%%)")
+    ap.add_argument("--confirm", type=int, default=2, help="перемеров кейса, вышедшего за допуск, перед вердиктом")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--json", help="записать результат в файл")
+    args = ap.parse_args()
+    if args.quick:
+        args.repeat = min(args.repeat, 3)
+        args.users = ",".join(x for x in args.users.split(",") if x and int(x) <= 10000)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    base = None
+    if args.check:
+        if not os.path.exists(args.baseline):
+            raise SystemExit(f"нет базовой линии {args.baseline}: сначала --save")
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)["results"]
+    results = asyncio.run(run(args, base))
+    doc = {"meta": {"python": platform.python_version(), "machine": platform.machine(),
+                    "node": platform.node(), "at": int(time.time())},
+           "results": results}
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+    if args.save:
+        base = {}
+        if os.path.exists(args.baseline) and args.k:  # частичный прогон дополняет линию, а не затирает
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                base = json.load(f).get("results", {})
+        base.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**doc, "results": base}, f, ensure_ascii=False, indent=2)
+        print(f"\nбазовая линия записана: {args.baseline}")
+    if base is not None:
+        bad = compare(results, base, args.tolerance)
+        if bad:
+            print(f"\nмедленнее базовой линии: {', '.join(bad)}")
+            sys.exit(1)
+        print("\nрегрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+# tools/checks.py — сквозные проверки инвариантов бота на заглушках (деньги и лимиты: то, что нельзя сломать молча)
+#
+#   python tools/checks.py              # все проверки; хотя бы одна упала — exit 1
+#   python tools/checks.py -k delivery  # только содержащие подстроку
+#
+# Настоящий main.py со своим DATA_DIR во временном каталоге; Telegram — объект с send_message,
+# который умеет падать на заданных вызовах; Gemini и Sheets не вызываются. ЮKassa — заглушка
+# tools/fake_yookassa.py на локальном порту, вебхук идёт в настоящий /yk/webhook бота (Flask main.py).
+# Каждая проверка начинает с пустых USAGE и очереди заданий.
+import os, sys, time, atexit, shutil, socket, asyncio, logging, argparse, tempfile, threading, traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+YK_PORT, BOT_PORT = _free_port(), _free_port()
+_DATA = tempfile.mkdtemp(prefix="checks-")
+atexit.register(shutil.rmtree, _DATA, ignore_errors=True)
+os.environ.update({
+    "BOT_TOKEN": "123:checks", "GEMINI_API_KEY": "checks", "DATA_DIR": _DATA,
+    "STATE_DIR": os.path.join(_DATA, "state"), "SHEETS_ENABLED": "0", "SPREADSHEET_ID": "",
+    "GOOGLE_SHEETS_SPREADSHEET_ID": "", "TRACE_SAMPLE_RATE": "0", "LOOP_MONITOR": "0",
+    "PERSIST_DELAY_SEC": "1e9",
+    "YK_API_URL": f"http://127.0.0.1:{YK_PORT}/v3", "YK_SHOP_ID": "test", "YK_SECRET_KEY": "test",
+})
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import httpx  # noqa: E402
+import main as m  # noqa: E402
+from telegram.error import NetworkError  # noqa: E402
+from fakes import fake_answer  # noqa: E402
+import fake_yookassa  # noqa: E402
+from yk import PaymentWorker  # noqa: E402
+
+Check = Callable[[], Awaitable[None]]
+CHECKS: Dict[str, Check] = {}
+
+
+def check(name: str):
+    def reg(fn: Check) -> Check:
+        CHECKS[name] = fn
+        return fn
+    return reg
+
+
+class FlakyBot:
+    """send_message падает NetworkError на вызовах с номерами из fail_on (с 1), остальные запоминает."""
+
+    def __init__(self, fail_on: tuple = ()):
+        self.fail_on = set(fail_on)
+        self.calls = 0
+        self.sent: List[str] = []
+
+    async def send_message(self, chat_id: int, text: str, **kw: Any) -> None:
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise NetworkError("checks: connection reset")
+        self.sent.append(text)
+
+
+def _reset(free_limit: int = 3) -> None:
+    m.USAGE.clear()
+    m.CONFIG["FREE_LIMIT"] = free_limit
+    for job in m.JOBS.ready(limit=1000):
+        m.JOBS.mark(job["id"], "delivered")
+
+
+def _done_job(uid: int, chars: int = 10000) -> int:
+    """Задание в статусе done, как после воркера: длинный ответ — несколько сообщений."""
+    job_id = m.JOBS.put({"user_id": uid, "chat_id": uid, "mode": "both", "username": None}, b"")
+    while True:
+        claimed = m.JOBS.claim("checks")
+        assert claimed is not None, "задание не захватилось"
+        if claimed[0] == job_id:
+            break
+    m.JOBS.finish(job_id, claimed[1], {"text": fake_answer(chars)}, None)
+    return job_id
+
+
+def _job(job_id: int) -> Optional[Dict[str, Any]]:
+    return next((j for j in m.JOBS.ready(limit=1000) if j["id"] == job_id), None)
+
+
+async def _deliver_until_done(job_id: int, bot: FlakyBot, attempts: int = 5) -> int:
+    """Как JobPump: повторять доставку, пока задание в ready(); вернуть число упавших попыток."""
+    failed = 0
+    for _ in range(attempts):
+        job = _job(job_id)
+        if job is None:
+            return failed
+        try:
+            await m._deliver_job(job, bot)
+        except NetworkError:
+            failed += 1
+    raise AssertionError(f"задание {job_id} не доставлено за {attempts} попыток")
+
+
+def _count(uid: int) -> int:
+    return int(m.USAGE.get(uid, {}).get("count", 0))
+
+
+# ---------- доставка анализа ----------
+@check("delivery.send_fails_count_unchanged")
+async def _send_fails() -> None:
+    _reset()
+    uid = 501
+    m.USAGE[uid] = {"count": 1, "month": time.gmtime().tm_mon, "premium": False}
+    job_id = _done_job(uid)
+    with m.user_scope():
+        m.user_ctx(uid)  # контекст открыт в области апдейта, как в хендлере
+        try:
+            await m._deliver_job(_job(job_id), FlakyBot(fail_on=(1,)))
+        except NetworkError:
+            pass
+        else:
+            raise AssertionError("отправка не упала")
+    assert _count(uid) == 1, f"отправка упала, а count {_count(uid)} (было 1)"
+
+
+@check("delivery.retries_charge_once")
+async def _retries() -> None:
+    _reset()
+    uid = 502
+    m.USAGE[uid] = {"count": 1, "month": time.gmtime().tm_mon, "premium": False}
+    job_id = _done_job(uid)
+    parts = len(m.append_tail(m._split_chunks(m._style_response(fake_answer(10000), "both", ""), m.SAFE_CHUNK), "x"))
+    bot = FlakyBot(fail_on=(2, 3))
+    failed = await _deliver_until_done(job_id, bot)
+    assert failed == 2, f"упавших попыток {failed}, ждали 2"
+    assert _count(uid) == 2, f"после {failed} повторов count {_count(uid)}, ждали 2"
+    assert len(bot.sent) == parts, f"отправлено {len(bot.sent)} сообщений на {parts} частей — есть дубли"
+
+
+@check("delivery.parallel_jobs_both_charged")
+async def _parallel() -> None:
+    _reset(free_limit=5)
+    uid = 503
+    a, b = _done_job(uid, 500), _done_job(uid, 500)
+    ja, jb = _job(a), _job(b)
+    await asyncio.gather(m._deliver_job(ja, FlakyBot()), m._deliver_job(jb, FlakyBot()))
+    assert _count(uid) == 2, f"два анализа доставлены, а count {_count(uid)}"
+
+
+@check("usage.scope_error_discards_charge")
+async def _scope_error() -> None:
+    _reset()
+    uid = 504
+    try:
+        with m.user_scope():
+            assert m.user_ctx(uid).charge()
+            raise NetworkError("checks: send failed after charge")
+    except NetworkError:
+        pass
+    assert _count(uid) == 0, f"апдейт упал, а списание осталось: count {_count(uid)}"
+    with m.user_scope():
+        m.user_ctx(uid).charge()
+    assert _count(uid) == 1, f"нормальный выход не списал: count {_count(uid)}"
+
+
+@check("usage.grant_during_update_kept")
+async def _grant_kept() -> None:
+    _reset()
+    uid = 508
+    ctx = m.user_ctx(uid)  # вне апдейта: контекст держит доставка, пока приходит оплата
+    assert not ctx.premium
+    m.grant_premium(uid, 30)
+    assert ctx.charge()
+    m._user_changed(ctx)
+    assert m.USAGE[uid].get("premium") is True, "commit старого контекста снял только что начисленный премиум"
+    assert _count(uid) == 1, f"count {_count(uid)}"
+
+
+@check("usage.free_limit_from_refdata")
+async def _ref_limit() -> None:
+    _reset(free_limit=3)
+    uid = 509
+    orig = m.REF_LIMITS
+    m.REF_LIMITS = {"free_limit": 1}
+    try:
+        with m.user_scope():
+            ctx = m.user_ctx(uid)
+            assert ctx.free_limit == 1, f"лимит {ctx.free_limit}, ждали 1 из RefData"
+            assert ctx.charge() and not ctx.charge(), "второе списание сверх лимита RefData прошло"
+    finally:
+        m.REF_LIMITS = orig
+    assert m.user_ctx(uid + 1).free_limit == 3, "без строки в RefData лимит должен быть из CONFIG"
+
+
+# ---------- история ----------
+@check("history.analysis_during_read_visible")
+async def _history_race() -> None:
+    uid = 505
+    m.HISTORY.pop(str(uid), None)
+    m.HCACHE.invalidate(uid)
+    orig = m.list_history
+
+    def slow_read(u: int) -> List[Dict[str, Any]]:
+        entries = orig(u)  # снимок до нового анализа
+        time.sleep(0.2)
+        return entries
+
+    m.list_history = slow_read
+    try:
+        reading = asyncio.create_task(m.history_view(uid))
+        await asyncio.sleep(0.05)
+        m._history_add(str(uid), {"ts": int(time.time()), "mode": "both"})  # анализ доставлен во время чтения
+        await reading
+    finally:
+        m.list_history = orig
+    v = await m.history_view(uid)
+    assert len(v.entries) == 1, f"свежий анализ не виден в истории: {len(v.entries)} записей"
+
+
+@check("history.gc_keeps_entry_not_yet_indexed")
+async def _history_gc_race() -> None:
+    uid, key, now = 506, "506", int(time.time())
+    m.HISTORY[key] = []
+    for i in range(m.HISTORY_LIMIT):
+        ts = m.HSTORE.add(uid, now - 1000 + i, None, f"old {i}", thumb=b"")
+        m.HISTORY[key].insert(0, {"ts": ts, "mode": "both"})
+    # две доставки в одну секунду: обе дописаны в архив, в HISTORY пока только первая
+    ts_a = m.HSTORE.add(uid, now, None, "a", thumb=b"")
+    ts_b = m.HSTORE.add(uid, now, None, "b", thumb=b"")
+    assert ts_a != ts_b, "два анализа за секунду получили один ключ"
+    keep = [ts_a] + [e["ts"] for e in m.HISTORY[key]][:m.HISTORY_LIMIT - 1]
+    m.HSTORE.retain(uid, keep)  # GC первой доставки по снимку без второй
+    m.HISTORY[key] = [{"ts": ts_b, "mode": "both"}] + [{"ts": t, "mode": "both"} for t in keep][:m.HISTORY_LIMIT - 1]
+    m.HSTORE.retain(uid, [e["ts"] for e in m.HISTORY[key]])
+    lost = [e["ts"] for e in m.HISTORY[key] if m.HSTORE.read_text(uid, e["ts"]) is None]
+    assert not lost, f"записи из HISTORY без текста в архиве: {lost}"
+    assert m.HSTORE.read_text(uid, ts_b) == "b"
+
+
+@check("history.migrate_drops_entries_without_text")
+async def _history_migrate() -> None:
+    uid, key = 507, "507"
+    d = os.path.join(m.HISTORY_DIR, key)
+    os.makedirs(d, exist_ok=True)
+    with open(os.path.join(d, "100.txt"), "w", encoding="utf-8") as f:
+        f.write("есть")
+    m.HISTORY[key] = [{"ts": 200, "mode": "both", "txt": os.path.join(d, "200.txt")},
+                      {"ts": 100, "mode": "both", "txt": os.path.join(d, "100.txt")}]
+    await m._history_migrate()
+    assert not os.path.exists(d), "каталог старой раскладки не удалён"
+    assert [e["ts"] for e in m.HISTORY[key]] == [100], f"в истории: {m.HISTORY[key]}"
+    assert m.HSTORE.read_text(uid, 100) == "есть"
+
+
+# ---------- оплата ЮKassa ----------
+_yk_started = False
+
+
+def _start_yk() -> None:
+    """Заглушка ЮKassa и HTTP-эндпоинты бота — один раз на прогон (потоки-демоны)."""
+    global _yk_started
+    if _yk_started:
+        return
+    from werkzeug.serving import make_server
+    fake_yookassa.CFG.update(shop_id="test", secret="test", public=f"http://127.0.0.1:{YK_PORT}",
+                             webhook=f"http://127.0.0.1:{BOT_PORT}/yk/webhook")
+    srv = make_server("127.0.0.1", YK_PORT, fake_yookassa.app, threaded=True)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    m.start_flask_endpoints(BOT_PORT)
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{BOT_PORT}/healthz", timeout=1)
+            break
+        except httpx.TransportError:
+            time.sleep(0.05)
+    _yk_started = True
+
+
+async def _yk_worker(bot: FlakyBot, **kw: Any) -> PaymentWorker:
+    m.YK_WORKER = PaymentWorker(m.yk_client(), m.YK_LEDGER, lambda p: m.yk_on_succeeded(p, bot), retry_sec=0.2,
+                                on_failed=lambda p, e: m.yk_on_failed(p, e, bot), **kw)
+    await m.YK_WORKER.start()
+    return m.YK_WORKER
+
+
+async def _pay(uid: int, webhooks: int) -> str:
+    """Создать платёж как кнопка «Оплатить» и «оплатить» его в заглушке; каждый POST /_pay — вебхук."""
+    url = await m.yk_create_first_payment(uid, 299)
+    for _ in range(webhooks):
+        r = await asyncio.to_thread(httpx.post, url, timeout=10)
+        assert r.status_code == 200, f"заглушка ЮKassa: {r.status_code} {r.text[:200]}"
+    return url.rsplit("/", 1)[-1]
+
+
+async def _ledger_settled(pid: str, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not any(r["payment_id"] == pid for r in await asyncio.to_thread(m.YK_LEDGER.pending)):
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"платёж {pid} не обработан за {timeout} с")
+
+
+def _premium_days(uid: int) -> float:
+    return (int(m.USAGE.get(uid, {}).get("premium_until", 0)) - time.time()) / 86400
+
+
+@check("payments.yk_duplicate_webhook_single_grant")
+async def _yk_duplicate() -> None:
+    _reset()
+    _start_yk()
+    uid = 601
+    bot = FlakyBot()
+    worker = await _yk_worker(bot)
+    try:
+        pid = await _pay(uid, webhooks=2)  # вебхук и его повтор
+        await _ledger_settled(pid)
+        await asyncio.sleep(0.3)  # ещё пара проходов воркера: повтор не должен ничего начислить
+    finally:
+        await worker.stop()
+    grants = [t for t in bot.sent if t.startswith("✅ Оплата получена")]
+    assert len(grants) == 1, f"начислений {len(grants)}, ждали 1"
+    assert 29 < _premium_days(uid) <= 30, f"премиум на {_premium_days(uid):.1f} дн., ждали 30"
+
+
+@check("payments.yk_forged_webhooks_dont_block")
+async def _yk_forged() -> None:
+    _reset()
+    _start_yk()
+    uid = 606
+    bot = FlakyBot()
+    url = f"http://127.0.0.1:{BOT_PORT}/yk/webhook"
+    forged = [f"forged-{uid}-{i}" for i in range(60)]  # больше, чем pending() берёт за проход
+    for pid in forged:
+        r = await asyncio.to_thread(httpx.post, url, json={
+            "event": "payment.succeeded", "object": {"id": pid, "metadata": {"user_id": str(uid)}}}, timeout=10)
+        assert r.status_code == 200, r.text
+    worker = await _yk_worker(bot)
+    try:
+        pid = await _pay(uid, webhooks=1)
+        await _ledger_settled(pid)
+    finally:
+        await worker.stop()
+    assert 29 < _premium_days(uid) <= 30, "настоящий платёж не прошёл за поддельными уведомлениями"
+    left = {r["payment_id"] for r in await asyncio.to_thread(m.YK_LEDGER.pending, 1000)} & set(forged)
+    assert not left, f"поддельные id остались pending: {len(left)}"
+
+
+@check("payments.yk_grant_failure_retried")
+async def _yk_retry() -> None:
+    _reset()
+    _start_yk()
+    uid = 602
+    bot = FlakyBot()
+    orig, calls = m.sched_track, []
+
+    def flaky_track(u: int) -> None:  # падает после того, как премиум уже записан в USAGE
+        calls.append(u)
+        if len(calls) == 1:
+            raise RuntimeError("checks: scheduler unavailable")
+        orig(u)
+
+    m.sched_track = flaky_track
+    worker = await _yk_worker(bot)
+    try:
+        pid = await _pay(uid, webhooks=1)
+        await _ledger_settled(pid)
+    finally:
+        await worker.stop()
+        m.sched_track = orig
+    assert not await asyncio.to_thread(m.YK_LEDGER.failed), "платёж ушёл в failed с первого сбоя"
+    assert 29 < _premium_days(uid) <= 30, f"после повтора премиум на {_premium_days(uid):.1f} дн., ждали 30"
+
+
+@check("payments.yk_failed_alerts_admins")
+async def _yk_alert() -> None:
+    _reset()
+    _start_yk()
+    uid, admin = 603, 9001
+    m.ADMINS.add(admin)
+    bot = FlakyBot()
+    orig = m.grant_premium
+
+    def broken(*a: Any, **kw: Any) -> int:
+        raise RuntimeError("checks: usage store unavailable")
+
+    m.grant_premium = broken
+    worker = await _yk_worker(bot, max_attempts=3)
+    try:
+        pid = await _pay(uid, webhooks=1)
+        await _ledger_settled(pid)
+    finally:
+        await worker.stop()
+        m.grant_premium = orig
+        m.ADMINS.discard(admin)
+    failed = [r for r in await asyncio.to_thread(m.YK_LEDGER.failed) if r["payment_id"] == pid]
+    assert failed and failed[0]["attempts"] == 3, f"ждали failed после 3 попыток: {failed}"
+    assert any(pid in t for t in bot.sent), "админам не пришло уведомление о неначисленном платеже"
+
+
+@check("scheduler.renew_failure_rescheduled")
+async def _renew_retry() -> None:
+    _reset()
+    uid, calls = 604, []
+
+    class FlakyYK:
+        async def create_recurring_payment(self, user_id: int, amount_rub: int, pm: str,
+                                           idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+            calls.append(idempotency_key)
+            if len(calls) == 1:
+                raise httpx.ConnectError("checks: connection refused")
+            return {"id": f"renew-{len(calls)}", "status": "pending", "metadata": {"user_id": str(uid)}}
+
+    m.usage_entry(uid)["yk_payment_method_id"] = "pm-checks"
+    sched = m.PremiumScheduler(renew_before=3600, renew_retry_sec=1)
+    sched.handlers = {m.RENEW: lambda u, t: m._sched_renew(None, u, t)}
+    orig = m.yk_client
+    m.yk_client = FlakyYK
+    await sched.start()
+    try:
+        sched.track(uid, int(time.time()) + 600, renew=True)
+        deadline = time.time() + 5
+        while len(calls) < 2 and time.time() < deadline:
+            await asyncio.sleep(0.1)
+    finally:
+        await sched.stop()
+        m.yk_client = orig
+    assert len(calls) == 2, f"после сбоя автосписание вызвано {len(calls)} раз, ждали повтор"
+    assert calls[0] == calls[1], "повтор должен идти с тем же ключом идемпотентности"
+
+
+@check("scheduler.stars_grace_not_active")
+async def _grace() -> None:
+    sched = m.PremiumScheduler()
+    now = int(time.time())
+    sched.track(1, now + 86400)
+    sched.track(2, now - 60, grace=86400)
+    assert sched.count_active(now) == 1, f"активных {sched.count_active(now)}, ждали 1"
+    assert sched.count_grace(now) == 1, f"в grace {sched.count_grace(now)}, ждали 1"
+    assert [uid for uid, _ in sched.active(12, now)] == [1], f"в списке активных: {sched.active(12, now)}"
+
+
+class _Msg:
+    def __init__(self) -> None:
+        self.replies: List[str] = []
+        self.chat = type("Chat", (), {"id": 0})()
+
+    async def reply_text(self, text: str, **kw: Any) -> None:
+        self.replies.append(text)
+
+
+async def _callback(uid: int, data: str, bot: Any = None) -> _Msg:
+    """on_callback с минимальными update/context: кнопка data от пользователя uid."""
+    msg = _Msg()
+
+    class Query:
+        message = msg
+
+        async def answer(self, *a: Any, **kw: Any) -> None:
+            pass
+
+    Query.data = data
+    update = type("Update", (), {"callback_query": Query(),
+                                 "effective_user": type("User", (), {"id": uid, "username": None})()})()
+    context = type("Context", (), {"user_data": {}, "bot": bot})()
+    with m.user_scope():
+        await m.on_callback(update, context)
+    return msg
+
+
+@check("payments.yk_disable_stops_renew")
+async def _yk_disable() -> None:
+    _reset()
+    uid = 605
+    u = m.usage_entry(uid)
+    u.update(premium=True, premium_until=int(time.time()) + 600, yk_payment_method_id="pm-checks")
+    orig, m.SCHED = m.SCHED, m.PremiumScheduler(renew_before=3600)
+    try:
+        m.sched_track(uid)
+        msg = await _callback(uid, "me:yk_disable")
+        due = [kind for kind, *_ in m.SCHED._due(int(time.time()))]
+    finally:
+        m.SCHED = orig
+    assert "yk_payment_method_id" not in m.USAGE[uid], "способ оплаты не удалён"
+    assert m.RENEW not in due, f"после отключения в очереди остался RENEW: {due}"
+    assert m.has_premium(uid), "отключение автопродления сняло оплаченный премиум"
+    assert msg.replies and "отключено" in msg.replies[0], f"ответ: {msg.replies}"
+
+
+# ---------- запуск ----------
+async def run(names: List[str]) -> List[str]:
+    failed = []
+    for name in names:
+        t = time.perf_counter()
+        try:
+            await CHECKS[name]()
+            print(f"  ok    {name}  ({(time.perf_counter() - t) * 1000:.0f} мс)", flush=True)
+        except Exception:
+            failed.append(name)
+            print(f"  FAIL  {name}\n" + "".join("        " + ln for ln in traceback.format_exc().splitlines(True)),
+                  flush=True)
+    return failed
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Сквозные проверки инвариантов бота")
+    ap.add_argument("-k", action="append", help="только проверки, содержащие подстроку (можно несколько)")
+    args = ap.parse_args()
+    logging.disable(logging.CRITICAL)  # ожидаемые сбои проверок пишут log.exception — в выводе только вердикты
+    m.bootstrap()
+    names = [n for n in CHECKS if not args.k or any(k in n for k in args.k)]
+    failed = asyncio.run(run(names))
+    print(f"\n{len(names) - len(failed)}/{len(names)} ок")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# tools/fake_yookassa.py — локальная заглушка API ЮKassa для проверки оплаты без реальных денег
+#
+#   python tools/fake_yookassa.py --port 8090 --webhook http://127.0.0.1:8080/yk/webhook
+#   YK_API_URL=http://127.0.0.1:8090/v3 YK_SHOP_ID=test YK_SECRET_KEY=test python main.py
+#
+# Создание платежа возвращает confirmation_url на саму заглушку; открытие этой ссылки
+# (или POST /_pay/<id>) переводит платёж в succeeded и шлёт вебхук payment.succeeded боту.
+# Повторный POST /_pay/<id> шлёт вебхук ещё раз — так проверяется идемпотентность.
+import argparse, base64, threading, time, uuid
+
+import httpx
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+PAYMENTS: dict[str, dict] = {}
+IDEMPOTENCY: dict[str, str] = {}
+CFG = {"shop_id": "test", "secret": "test", "webhook": "", "public": "http://127.0.0.1:8090"}
+_lock = threading.Lock()
+
+
+def _authorized() -> bool:
+    want = base64.b64encode(f"{CFG['shop_id']}:{CFG['secret']}".encode()).decode()
+    return request.headers.get("Authorization", "") == f"Basic {want}"
+
+
+@app.post("/v3/payments")
+def create_payment():
+    if not _authorized():
+        return jsonify({"type": "error", "code": "invalid_credentials"}), 401
+    key = request.headers.get("Idempotence-Key")
+    if not key:
+        return jsonify({"type": "error", "code": "invalid_request", "description": "Idempotence-Key required"}), 400
+    body = request.get_json(force=True)
+    with _lock:
+        if key in IDEMPOTENCY:
+            return jsonify(PAYMENTS[IDEMPOTENCY[key]])
+        pid = str(uuid.uuid4())
+        recurring = bool(body.get("payment_method_id"))
+        p = {
+            "id": pid,
+            "status": "succeeded" if recurring else "pending",
+            "paid": recurring,
+            "amount": body["amount"],
+            "description": body.get("description", ""),
+            "metadata": body.get("metadata", {}),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "payment_method": {"type": "bank_card", "id": body.get("payment_method_id") or f"pm-{pid}",
+                               "saved": bool(body.get("save_payment_method") or recurring)},
+        }
+        if not recurring:
+            p["confirmation"] = {"type": "redirect", "confirmation_url": f"{CFG['public']}/_pay/{pid}"}
+        PAYMENTS[pid] = p
+        IDEMPOTENCY[key] = pid
+    if recurring:
+        _send_webhook(p)
+    return jsonify(p)
+
+
+@app.get("/v3/payments/<pid>")
+def get_payment(pid):
+    if not _authorized():
+        return jsonify({"type": "error", "code": "invalid_credentials"}), 401
+    p = PAYMENTS.get(pid)
+    return (jsonify(p), 200) if p else (jsonify({"type": "error", "code": "not_found"}), 404)
+
+
+@app.route("/_pay/<pid>", methods=["GET", "POST"])
+def pay(pid):
+    p = PAYMENTS.get(pid)
+    if not p:
+        return "not found", 404
+    p["status"], p["paid"] = "succeeded", True
+    _send_webhook(p)
+    return f"payment {pid} succeeded"
+
+
+def _send_webhook(p: dict) -> None:
+    if not CFG["webhook"]:
+        return
+    try:
+        r = httpx.post(CFG["webhook"], json={"type": "notification", "event": "payment.succeeded", "object": p}, timeout=5)
+        print(f"webhook {p['id']} -> {r.status_code}")
+    except Exception as e:
+        print(f"webhook {p['id']} failed: {e}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--shop-id", default="test")
+    ap.add_argument("--secret", default="test")
+    ap.add_argument("--webhook", default="", help="URL /yk/webhook бота")
+    a = ap.parse_args()
+    CFG.update(shop_id=a.shop_id, secret=a.secret, webhook=a.webhook, public=f"http://127.0.0.1:{a.port}")
+    app.run(host="127.0.0.1", port=a.port, debug=False, use_reloader=False)
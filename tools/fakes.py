@@ -0,0 +1,293 @@
+# tools/fakes.py — локальная заглушка Telegram Bot API для бенчмарков и нагрузочных прогонов
+#
+#   api = FakeBotApi().start()
+#   api.push(api.message(42, "/start"))
+#   BOT_API_URL=<api.url> python main.py
+#   api.wait_for("sendMessage", chat_id=42)
+#
+# Отвечает на getMe/getUpdates/send*/answerCallbackQuery/getFile правдоподобными объектами,
+# записывает все вызовы (время, метод, параметры) и отдаёт файл фото по /file/bot<token>/<path>.
+# Там же FakeGemini (вместо genai.GenerativeModel) и FakeSpreadsheet (вместо gspread) для tools/loadtest.py.
+import io, json, time, random, logging, itertools, threading
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+
+def sample_jpeg(size=(1024, 768)) -> bytes:
+    """Похоже на фото: градиент и шум (однотонную заливку отбракует prescreen)."""
+    from PIL import Image
+    noise = Image.effect_noise(size, 40).convert("L")
+    base = Image.linear_gradient("L").resize(size)
+    im = Image.merge("RGB", (Image.blend(base, noise, 0.5), noise, Image.new("L", size, 130)))
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+class Call:
+    __slots__ = ("t", "method", "params")
+
+    def __init__(self, method: str, params: Dict[str, Any]):
+        self.t = time.perf_counter()
+        self.method = method
+        self.params = params
+
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, photo: Optional[bytes] = None):
+        self.latency = latency
+        self.photo = photo
+        self.calls: List[Call] = []
+        self._updates: List[Dict[str, Any]] = []
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._msg_ids = itertools.count(1)
+        self._app = self._build()
+        self._srv = make_server(host, port, self._app, threaded=True)
+        self.url = f"http://{host}:{self._srv.server_port}"
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- жизненный цикл ----
+    def start(self) -> "FakeBotApi":
+        self._thread = threading.Thread(target=self._srv.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._srv.shutdown()
+        with self._cond:
+            self._cond.notify_all()
+
+    # ---- апдейты ----
+    def push(self, update: Dict[str, Any]) -> int:
+        with self._cond:
+            update["update_id"] = next(self._ids)
+            self._updates.append(update)
+            self._cond.notify_all()
+            return update["update_id"]
+
+    @staticmethod
+    def _user(uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def message(self, uid: int, text: Optional[str] = None, photo: bool = False) -> Dict[str, Any]:
+        msg: Dict[str, Any] = {"message_id": next(self._msg_ids), "date": int(time.time()),
+                               "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            n = next(self._msg_ids)
+            msg["photo"] = [{"file_id": f"ph{n}", "file_unique_id": f"u{n}", "width": 1024, "height": 768,
+                             "file_size": len(self.photo or b"")}]
+        return {"message": msg}
+
+    def callback(self, uid: int, data: str) -> Dict[str, Any]:
+        return {"callback_query": {"id": str(next(self._msg_ids)), "from": self._user(uid), "chat_instance": "1",
+                                   "data": data, "message": self.message(uid, "…")["message"]}}
+
+    # ---- вызовы ----
+    def wait_for(self, method: str, timeout: float = 30.0, since: int = 0,
+                 match: Optional[Callable[[Call], bool]] = None, **params: Any) -> Optional[Call]:
+        """Первый вызов method (с индекса since) с совпадающими параметрами; None по таймауту."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for c in self.calls[since:]:
+                    if c.method == method and all(str(c.params.get(k)) == str(v) for k, v in params.items()) \
+                            and (match is None or match(c)):
+                        return c
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
+    def last(self, method: str, match: Optional[Callable[[Call], bool]] = None, **params: Any) -> Optional[Call]:
+        """Последний уже записанный вызов method с совпадающими параметрами."""
+        with self._cond:
+            for c in reversed(self.calls):
+                if c.method == method and all(str(c.params.get(k)) == str(v) for k, v in params.items()) \
+                        and (match is None or match(c)):
+                    return c
+        return None
+
+    def _record(self, method: str, params: Dict[str, Any]) -> None:
+        with self._cond:
+            self.calls.append(Call(method, params))
+            self._cond.notify_all()
+
+    def _message_result(self, params: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id") or 0)
+        return {"message_id": next(self._msg_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def _build(self) -> Flask:
+        app = Flask("fake-bot-api")
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+        @app.post("/bot<token>/<method>")
+        def api(token: str, method: str):
+            params: Dict[str, Any] = dict(request.values)
+            params.update(request.get_json(silent=True) or {})
+            if method == "getUpdates":
+                return jsonify({"ok": True, "result": self._get_updates(params)})
+            self._record(method, params)
+            if self.latency:
+                time.sleep(self.latency)
+            if method == "getMe":
+                result: Any = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                               "can_join_groups": False, "can_read_all_group_messages": False,
+                               "supports_inline_queries": False}
+            elif method in ("sendMessage", "editMessageText", "sendInvoice"):
+                result = self._message_result(params, text=params.get("text", ""))
+            elif method == "sendPhoto":
+                n = next(self._msg_ids)
+                result = self._message_result(params, photo=[{"file_id": f"sent{n}", "file_unique_id": f"s{n}",
+                                                              "width": 512, "height": 384}])
+            elif method == "sendDocument":
+                result = self._message_result(params, document={"file_id": "doc", "file_unique_id": "doc"})
+            elif method == "getFile":
+                fid = params.get("file_id", "f")
+                result = {"file_id": fid, "file_unique_id": fid, "file_size": len(self.photo or b""),
+                          "file_path": f"photos/{fid}.jpg"}
+            else:
+                result = True
+            return jsonify({"ok": True, "result": result})
+
+        @app.get("/file/bot<token>/<path:path>")
+        def file(token: str, path: str):
+            return self.photo or b"", 200, {"Content-Type": "image/jpeg"}
+
+        return app
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # подтверждённые (id < offset) больше не нужны
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            return json.loads(json.dumps(self._updates[:limit]))
+
+
+# ---------- Gemini ----------
+_ANSWER_PARTS = [
+    "## Общее впечатление\n",
+    "- Тон кожи ровный, есть лёгкий блеск в Т-зоне\n",
+    "- Волосы тонкие, кончики суховаты\n\n",
+    "Утро: мягкое очищение и защита\n",
+    "1. Гель для умывания без сульфатов\n",
+    "2. Ниацинамид 5% и лёгкий флюид\n",
+    "3. SPF 30+ даже в пасмурный день\n\n",
+    "Вечер — восстановление\n",
+    "- Двойное очищение, затем увлажняющий крем с церамидами\n",
+    "- Маска для волос с протеинами раз в неделю\n\n",
+    "Советы: <не> трогать лицо руками & менять наволочку дважды в неделю\n\n",
+]
+
+
+def fake_answer(chars: int) -> str:
+    out, i = [], 0
+    while sum(map(len, out)) < chars:
+        out.append(_ANSWER_PARTS[i % len(_ANSWER_PARTS)])
+        i += 1
+    return "".join(out)[:chars]
+
+
+class FakeGemini:
+    """generate_content спит latency ± jitter (вызывается из to_thread), с долей error_rate бросает исключение."""
+
+    def __init__(self, latency: float = 1.5, jitter: float = 0.5, error_rate: float = 0.0, chars: int = 2500,
+                 seed: Optional[int] = None):
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.text = fake_answer(chars)
+        self.calls = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, payload: Any, **kw: Any) -> Any:
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError("fake gemini: 503 model overloaded")
+        return SimpleNamespace(text=self.text)
+
+    def count_tokens(self, contents: Any, **kw: Any) -> Any:
+        return SimpleNamespace(total_tokens=1)
+
+
+# ---------- Sheets ----------
+class FakeWorksheet:
+    def __init__(self, owner: "FakeSpreadsheet", title: str, headers: Optional[List[str]] = None):
+        self.owner, self.title = owner, title
+        self.rows: List[List[Any]] = [list(headers)] if headers else []
+
+    def append_row(self, row: List[Any], **kw: Any) -> None:
+        self.owner._io()
+        with self.owner._lock:
+            self.rows.append([str(v) for v in row])
+
+    def get_all_values(self, **kw: Any) -> List[List[Any]]:
+        self.owner._io()
+        with self.owner._lock:
+            return [list(r) for r in self.rows]
+
+    def get_all_records(self, **kw: Any) -> List[Dict[str, Any]]:
+        values = self.get_all_values()
+        if not values:
+            return []
+        head = values[0]
+        return [dict(zip(head, r + [""] * (len(head) - len(r)))) for r in values[1:]]
+
+    def update(self, rng: str, values: List[List[Any]], **kw: Any) -> None:
+        self.owner._io()
+        i = int("".join(ch for ch in rng.split(":")[0] if ch.isdigit())) - 1
+        with self.owner._lock:
+            self.rows[i] = [str(v) for v in values[0]]
+
+
+class FakeSpreadsheet:
+    """Подставляется вместо main._sh: каждый сетевой вызов gspread стоит latency секунд."""
+
+    def __init__(self, latency: float = 0.3, layout: Optional[Dict[str, List[str]]] = None):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._ws = {t: FakeWorksheet(self, t, h) for t, h in (layout or {}).items()}
+
+    def _io(self) -> None:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self._io()
+        if title not in self._ws:
+            raise KeyError(title)
+        return self._ws[title]
+
+    def worksheets(self) -> List[FakeWorksheet]:
+        self._io()
+        return list(self._ws.values())
+
+    def add_worksheet(self, title: str, rows: Any = None, cols: Any = None) -> FakeWorksheet:
+        self._io()
+        ws = self._ws[title] = FakeWorksheet(self, title)
+        return ws
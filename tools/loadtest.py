@@ -0,0 +1,288 @@
+# tools/loadtest.py — нагрузочный прогон настоящего Application из main.py без сети
+#
+#   python tools/loadtest.py --users 50
+#   python tools/loadtest.py --users 200 --ramp 10 --gemini-latency 3 --gemini-error-rate 0.05 --json load.json
+#   python tools/loadtest.py --users 100 --journeys start,photo --concurrency 16
+#
+# Поднимает заглушку Bot API (tools/fakes.py), подменяет модель Gemini на FakeGemini и Sheets на
+# FakeSpreadsheet, запускает Application (build_application + _post_init) в этом процессе и прогоняет
+# сценарии для N виртуальных пользователей: start, profile, photo, history, premium.
+# Время хендлера — от публикации апдейта в getUpdates до конца его обработки диспетчером (с очередью).
+# Ошибка — исключение, дошедшее до PTB, или M_ERRORS.inc внутри обработки (например, сбой Gemini).
+import argparse, asyncio, contextvars, json, logging, math, os, random, sys, tempfile, time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+from fakes import FakeBotApi, FakeGemini, FakeSpreadsheet, sample_jpeg  # noqa: E402
+
+JOURNEYS = ("start", "profile", "photo", "history", "premium")
+PROFILE_ANSWERS = ("28", "комбинированная, чувствительная", "тонкие, окрашенные", "меньше блеска, объём")
+UID_BASE = 100000
+
+_errors_box: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar("loadtest_errors", default=None)
+
+
+def _import_main(api_url: str, data_dir: str, concurrency: Optional[int]):
+    # конфиг main читается при импорте — окружение выставляем до него
+    os.environ.update({
+        "BOT_TOKEN": "123:load", "GEMINI_API_KEY": "load", "BOT_API_URL": api_url,
+        "DATA_DIR": data_dir, "STATE_DIR": os.path.join(data_dir, "state"),
+        "SHEETS_ENABLED": "0", "SPREADSHEET_ID": "", "GOOGLE_SHEETS_SPREADSHEET_ID": "",
+        "GEMINI_WARMUP": "0", "RATE_LIMIT_SECONDS": "0", "FREE_LIMIT": "1000000000",
+        "TRACE_SAMPLE_RATE": "0", "PORT": "0",
+        "ANALYSIS_WORKERS": "0",  # воркер анализа — поток в этом процессе, чтобы работала подмена FakeGemini
+    })
+    if concurrency:
+        os.environ["CONCURRENT_UPDATES"] = str(concurrency)
+    import main
+    return main
+
+
+def _quiet(verbose: bool) -> None:
+    # сбои (в т.ч. подстроенные ошибки Gemini) попадают в отчёт; трейсбеки в консоли только с --verbose
+    if not verbose:
+        for name in ("beauty-nano-bot", "beauty-nano-bot.histstore", "telegram", "httpx"):
+            logging.getLogger(name).setLevel(logging.CRITICAL)
+
+
+def pct(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    s = sorted(xs)
+    return s[max(0, math.ceil(p / 100 * len(s)) - 1)]
+
+
+class Harness:
+    def __init__(self, api: FakeBotApi, m: Any, timeout: float):
+        self.api, self.m, self.timeout = api, m, timeout
+        self.pending: Dict[int, tuple] = {}
+        self.lat: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.error_kinds: Counter = Counter()
+        self.timeouts: Dict[str, int] = defaultdict(int)
+        self.journeys_done = 0
+
+    def install(self, app: Any) -> None:
+        orig = self.m.DISPATCHER.do_process_update
+
+        async def timed(update, coroutine):
+            box: List[str] = []
+            token = _errors_box.set(box)
+            try:
+                await orig(update, coroutine)
+            finally:
+                _errors_box.reset(token)
+                self._done(update, box)
+
+        self.m.DISPATCHER.do_process_update = timed
+
+        inc = self.m.M_ERRORS.inc
+
+        def counting_inc(n: float = 1, **labels: str) -> None:
+            inc(n, **labels)
+            box = _errors_box.get()
+            if box is not None:
+                box.append(labels.get("kind", "?"))
+
+        self.m.M_ERRORS.inc = counting_inc
+
+        async def on_error(update, context):
+            box = _errors_box.get()
+            if box is not None:
+                box.append(f"exception:{type(context.error).__name__}")
+
+        app.add_error_handler(on_error)
+
+    def _done(self, update: Any, box: List[str]) -> None:
+        entry = self.pending.pop(getattr(update, "update_id", None), None)
+        if entry is None:
+            return
+        label, t0, fut = entry
+        self.lat[label].append(time.perf_counter() - t0)
+        if box:
+            self.errors[label] += 1
+            self.error_kinds.update(box)
+        if not fut.done():
+            fut.set_result(None)
+
+    async def send(self, label: str, update: Dict[str, Any]) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        uid = self.api.push(update)
+        self.pending[uid] = (label, t0, fut)  # до ближайшего await — бот ещё не мог его обработать
+        try:
+            await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(uid, None)
+            self.timeouts[label] += 1
+
+    # ---- сценарии ----
+    async def start(self, uid: int) -> None:
+        await self.send("start", self.api.message(uid, "/start"))
+
+    async def profile(self, uid: int) -> None:
+        await self.send("profile", self.api.callback(uid, "profile"))
+        for text in PROFILE_ANSWERS:
+            await self.send("profile:answer", self.api.message(uid, text))
+
+    async def photo(self, uid: int) -> None:
+        since = len(self.api.calls)
+        t0 = time.perf_counter()
+        await self.send("photo", self.api.message(uid, photo=True))
+        # сам анализ идёт в очереди заданий: ответ приходит отдельно, после обработки апдейта
+        # опрос, а не wait_for в to_thread: ждущие потоки заняли бы пул, нужный самому боту
+        deadline = time.monotonic() + self.timeout
+        call = None
+        while call is None and time.monotonic() < deadline:
+            call = self.api.wait_for("sendMessage", 0, since, chat_id=uid)
+            if call is None:
+                await asyncio.sleep(0.02)
+        if call is None:
+            self.timeouts["photo:answer"] += 1
+            return
+        self.lat["photo:answer"].append(call.t - t0)
+        if str(call.params.get("text", "")).startswith("Ошибка анализа"):
+            self.errors["photo:answer"] += 1
+            self.error_kinds["analysis"] += 1
+
+    async def history(self, uid: int) -> None:
+        # запись истории сохраняется в фоне после ответа — даём ей появиться
+        for _ in range(40):
+            if self.m.HISTORY.get(str(uid)):
+                break
+            await asyncio.sleep(0.05)
+        await self.send("history", self.api.callback(uid, "history"))
+        call = self.api.last("sendMessage", chat_id=uid, match=lambda c: "hist:" in str(c.params.get("reply_markup", "")))
+        if call:
+            kb = json.loads(call.params["reply_markup"])["inline_keyboard"]
+            data = next(b["callback_data"] for row in kb for b in row if b.get("callback_data", "").startswith("hist:"))
+            await self.send("hist", self.api.callback(uid, data))
+
+    async def premium(self, uid: int) -> None:
+        await self.send("premium", self.api.callback(uid, "premium"))
+        await self.send("pay:stars", self.api.callback(uid, "pay:stars"))
+
+    async def user(self, uid: int, journeys: List[str], delay: float, think: float) -> None:
+        await asyncio.sleep(delay)
+        for step in journeys:
+            await getattr(self, step)(uid)
+            if think:
+                await asyncio.sleep(random.uniform(0, 2 * think))
+        self.journeys_done += 1
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    api = FakeBotApi(latency=args.api_latency, photo=sample_jpeg()).start()
+    data_dir = tempfile.mkdtemp(prefix="loadtest-")
+    m = _import_main(api.url, data_dir, args.concurrency)
+    _quiet(args.verbose)
+    m.bootstrap()
+    gem = m._model = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, args.gemini_chars,
+                                seed=args.seed)
+    sheets = None
+    if not args.no_sheets:
+        sheets = m._sh = FakeSpreadsheet(args.sheets_latency, m.SHEETS_LAYOUT)
+
+    app = m.build_application()
+    h = Harness(api, m, args.timeout)
+    h.install(app)
+    await app.initialize()
+    await m._post_init(app)
+    await app.start()
+    await app.updater.start_polling(poll_interval=0, timeout=1)
+
+    journeys = [j.strip() for j in args.journeys.split(",") if j.strip()]
+    rng = random.Random(args.seed)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(h.user(UID_BASE + i, journeys, args.ramp * i / max(1, args.users),
+                                  args.think * rng.random()) for i in range(args.users)))
+    wall = time.perf_counter() - t0
+    ds = m.DISPATCHER.stats()
+    loop_max_lag = m.LOOPMON.max_lag
+
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    await m._post_shutdown(app)
+    api.stop()
+
+    total = sum(len(v) for v in h.lat.values())
+    handlers = {}
+    for label in sorted(h.lat, key=lambda k: -len(h.lat[k])):
+        xs = h.lat[label]
+        n = len(xs) + h.timeouts[label]
+        handlers[label] = {
+            "n": n, "p50_ms": round(pct(xs, 50) * 1000, 1), "p95_ms": round(pct(xs, 95) * 1000, 1),
+            "p99_ms": round(pct(xs, 99) * 1000, 1), "max_ms": round(max(xs) * 1000, 1) if xs else 0.0,
+            "errors": h.errors[label], "timeouts": h.timeouts[label],
+            "error_rate": round((h.errors[label] + h.timeouts[label]) / n, 4) if n else 0.0,
+        }
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "wall_s": round(wall, 2),
+        "journeys_done": h.journeys_done,
+        "updates": total,
+        "updates_per_s": round(total / wall, 1) if wall else 0.0,
+        "analyses_per_s": round(len(h.lat.get("photo", [])) / wall, 2) if wall else 0.0,
+        "handlers": handlers,
+        "error_kinds": dict(h.error_kinds),
+        "gemini": {"calls": gem.calls, "errors": gem.errors},
+        "sheets_calls": sheets.calls if sheets else 0,
+        "bot_api_calls": dict(Counter(c.method for c in api.calls)),
+        "dispatcher": {"wait_p95_ms": round(ds["wait_p95"] * 1000, 1), "wait_max_ms": round(ds["wait_max"] * 1000, 1),
+                       "parallelism": ds["parallelism"]},
+        "loop_max_lag_ms": round(loop_max_lag * 1000, 1),
+    }
+
+
+def print_report(r: Dict[str, Any]) -> None:
+    print(f"{r['config']['users']} пользователей, {r['journeys_done']} сценариев за {r['wall_s']} с: "
+          f"{r['updates']} апдейтов ({r['updates_per_s']}/с), анализов {r['analyses_per_s']}/с")
+    print(f"\n{'handler':<16}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'err%':>7}")
+    for label, s in r["handlers"].items():
+        print(f"{label:<16}{s['n']:>6}{s['p50_ms']:>9.0f}{s['p95_ms']:>9.0f}{s['p99_ms']:>9.0f}{s['max_ms']:>9.0f}"
+              f"{s['error_rate'] * 100:>6.1f}%")
+    d = r["dispatcher"]
+    print(f"\nочередь диспетчера: p95 {d['wait_p95_ms']} мс, max {d['wait_max_ms']} мс (parallelism {d['parallelism']}); "
+          f"макс. задержка loop {r['loop_max_lag_ms']} мс")
+    print(f"gemini: {r['gemini']['calls']} вызовов, {r['gemini']['errors']} ошибок; sheets: {r['sheets_calls']} вызовов")
+    if r["error_kinds"]:
+        print("ошибки:", ", ".join(f"{k}={v}" for k, v in r["error_kinds"].items()))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон бота против заглушек Bot API/Gemini/Sheets")
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--journeys", default=",".join(JOURNEYS), help="шаги сценария через запятую: " + ",".join(JOURNEYS))
+    ap.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд подключаются все пользователи")
+    ap.add_argument("--think", type=float, default=0.0, help="средняя пауза пользователя между шагами, с")
+    ap.add_argument("--concurrency", type=int, help="CONCURRENT_UPDATES для бота")
+    ap.add_argument("--gemini-latency", type=float, default=1.5)
+    ap.add_argument("--gemini-jitter", type=float, default=0.5)
+    ap.add_argument("--gemini-error-rate", type=float, default=0.0)
+    ap.add_argument("--gemini-chars", type=int, default=2500, help="размер ответа модели")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="задержка каждого вызова Bot API, с")
+    ap.add_argument("--sheets-latency", type=float, default=0.3)
+    ap.add_argument("--no-sheets", action="store_true", help="без Sheets (как при SHEETS_ENABLED=0)")
+    ap.add_argument("--timeout", type=float, default=120.0, help="таймаут одного апдейта")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="записать результат в файл")
+    ap.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = ap.parse_args()
+    bad = [j for j in args.journeys.split(",") if j.strip() and j.strip() not in JOURNEYS]
+    if bad:
+        ap.error(f"неизвестные шаги: {bad}")
+
+    res = asyncio.run(run(args))
+    print_report(res)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# tools/startup_bench.py — холодный старт: время `import main` и время до ответа на первый апдейт
+#
+#   python tools/startup_bench.py -n 5
+#   python tools/startup_bench.py -n 3 --data-dir ./data --json startup.json
+#
+# Каждый прогон — отдельный процесс python. «Первый апдейт»: до запуска бота в заглушку Bot API
+# (tools/fakes.py) кладётся /start, замеряется время от spawn до первого sendMessage этому чату.
+# Sheets выключены, Gemini не вызывается — меряется именно старт процесса.
+import argparse, json, os, shutil, signal, socket, statistics, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeBotApi  # noqa: E402
+
+UID = 4242
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _env(data_dir: str, **extra: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "123:bench", "GEMINI_API_KEY": "bench", "DATA_DIR": data_dir,
+        "STATE_DIR": os.path.join(data_dir, "state"), "SHEETS_ENABLED": "0",
+        "SPREADSHEET_ID": "", "GOOGLE_SHEETS_SPREADSHEET_ID": "", "GOOGLE_SHEETS_CREDS": "",
+        "TRACE_SAMPLE_RATE": "0", "LOOP_MONITOR": "0", "PORT": str(_free_port()),
+        "PYTHONPATH": ROOT,
+    })
+    env.update(extra)
+    return env
+
+
+def _fresh_data(src: str | None) -> str:
+    d = tempfile.mkdtemp(prefix="bench-data-")
+    if src:
+        shutil.copytree(src, d, dirs_exist_ok=True)
+    return d
+
+
+def bench_interpreter(n: int) -> list[float]:
+    out = []
+    for _ in range(n):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        out.append(time.perf_counter() - t)
+    return out
+
+
+def bench_import(n: int, data_src: str | None) -> tuple[list[float], list[tuple[str, int]]]:
+    out, top = [], []
+    for i in range(n):
+        d = _fresh_data(data_src)
+        try:
+            t = time.perf_counter()
+            p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                               env=_env(d), capture_output=True, text=True)
+            out.append(time.perf_counter() - t)
+            if p.returncode != 0:
+                raise SystemExit(f"import main failed:\n{p.stderr[-2000:]}")
+            if i == n - 1:
+                top = _top_imports(p.stderr)
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+    return out, top
+
+
+def _top_imports(stderr: str, k: int = 12) -> list[tuple[str, int]]:
+    """Прямые импорты main (первый уровень вложенности в выводе -X importtime) по кумулятивному времени, мкс."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cum_us, name = line[len("import time:"):].split("|")
+        if len(name) - len(name.lstrip()) != 3:  # " " + два пробела на уровень
+            continue
+        rows.append((name.strip(), int(cum_us)))
+    return sorted(rows, key=lambda r: -r[1])[:k]
+
+
+def bench_first_update(n: int, data_src: str | None, timeout: float) -> list[float]:
+    out = []
+    for _ in range(n):
+        api = FakeBotApi().start()
+        d = _fresh_data(data_src)
+        api.push(api.message(UID, "/start"))
+        t = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=_env(d, BOT_API_URL=api.url),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        try:
+            call = api.wait_for("sendMessage", timeout=timeout, chat_id=UID)
+            if call is None:
+                proc.kill()
+                raise SystemExit(f"бот не ответил за {timeout} с:\n{proc.communicate()[1][-2000:]}")
+            out.append(call.t - t)
+        finally:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            api.stop()
+            shutil.rmtree(d, ignore_errors=True)
+    return out
+
+
+def _summary(xs: list[float]) -> dict:
+    return {"median_ms": round(statistics.median(xs) * 1000, 1), "min_ms": round(min(xs) * 1000, 1),
+            "max_ms": round(max(xs) * 1000, 1), "runs": len(xs)}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Холодный старт бота: import main и первый апдейт")
+    ap.add_argument("-n", type=int, default=5, help="прогонов на замер")
+    ap.add_argument("--data-dir", help="скопировать этот DATA_DIR в каждый прогон (реалистичный объём состояния)")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--json", help="записать результат в файл")
+    args = ap.parse_args()
+
+    res = {
+        "python": _summary(bench_interpreter(args.n)),
+    }
+    imp, top = bench_import(args.n, args.data_dir)
+    res["import_main"] = _summary(imp)
+    res["first_update"] = _summary(bench_first_update(args.n, args.data_dir, args.timeout))
+    res["top_imports_ms"] = {name: round(us / 1000, 1) for name, us in top}
+
+    for k in ("python", "import_main", "first_update"):
+        s = res[k]
+        print(f"{k:<14} median {s['median_ms']:>8.1f} ms   min {s['min_ms']:>8.1f}   max {s['max_ms']:>8.1f}")
+    print("\nсамые дорогие импорты (кумулятивно):")
+    for name, ms in res["top_imports_ms"].items():
+        print(f"  {ms:>8.1f} ms  {name}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# tracing.py — лёгкая трассировка: trace на апдейт, вложенные span-ы, экспорт в JSONL или OTLP/HTTP
+import os, json, time, queue, random, logging, threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+log = logging.getLogger("beauty-nano-bot.trace")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "error")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attrs: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "name": self.name, "start_ns": self.start_ns, "dur_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+                "attrs": self.attrs, "error": self.error}
+
+
+class _NoopSpan:
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+NOOP = _NoopSpan()
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+# ---------- экспорт ----------
+class JsonlExporter:
+    """Пишет по строке на span, ротирует файл по размеру (file, file.1, ..., file.N)."""
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 3):
+        self.path, self.max_bytes, self.backups = path, max_bytes, backups
+
+    def export(self, spans: List[Span]) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            for sp in spans:
+                f.write(json.dumps(sp.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+class OtlpHttpExporter:
+    """OTLP/HTTP JSON (например, http://localhost:4318/v1/traces у локального collector-а)."""
+
+    def __init__(self, endpoint: str, service: str = "beauty-nano-bot"):
+        import httpx
+        self.endpoint = endpoint
+        self.service = service
+        self._client = httpx.Client(timeout=5)
+
+    @staticmethod
+    def _attr(k: str, v: Any) -> Dict[str, Any]:
+        if isinstance(v, bool):
+            return {"key": k, "value": {"boolValue": v}}
+        if isinstance(v, int):
+            return {"key": k, "value": {"intValue": str(v)}}
+        if isinstance(v, float):
+            return {"key": k, "value": {"doubleValue": v}}
+        return {"key": k, "value": {"stringValue": str(v)}}
+
+    def export(self, spans: List[Span]) -> None:
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [self._attr("service.name", self.service)]},
+            "scopeSpans": [{"scope": {"name": self.service}, "spans": [{
+                "traceId": sp.trace_id, "spanId": sp.span_id, "parentSpanId": sp.parent_id or "",
+                "name": sp.name, "kind": 1,
+                "startTimeUnixNano": str(sp.start_ns), "endTimeUnixNano": str(sp.end_ns),
+                "attributes": [self._attr(k, v) for k, v in sp.attrs.items()],
+                "status": {"code": 2, "message": sp.error} if sp.error else {"code": 1},
+            } for sp in spans]}],
+        }]}
+        self._client.post(self.endpoint, json=body).raise_for_status()
+
+
+# ---------- трассировщик ----------
+class Tracer:
+    """
+    trace(...) открывает корневой span и решает, сэмплировать ли его (sample_rate);
+    span(...) внутри несэмплированного/отсутствующего trace — no-op без аллокаций.
+    Контекст живёт в ContextVar, поэтому проходит через await, create_task и asyncio.to_thread.
+    Готовые span-ы уходят в очередь и экспортируются пачками из отдельного потока.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, exporter: Any = None, batch: int = 256, flush_sec: float = 2.0):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.batch = batch
+        self.flush_sec = flush_sec
+        self.dropped = 0
+        self._q: "queue.Queue[Span]" = queue.Queue(maxsize=10000)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 and self.exporter is not None
+
+    def start(self) -> None:
+        if self.enabled and not self._thread:
+            self._thread = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def trace(self, name: str, **attrs: Any) -> Iterator[Any]:
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield NOOP
+            return
+        with self._open(os.urandom(16).hex(), None, name, attrs) as sp:
+            yield sp
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Any]:
+        parent = _current.get()
+        if parent is None:
+            yield NOOP
+            return
+        with self._open(parent.trace_id, parent.span_id, name, attrs) as sp:
+            yield sp
+
+    def current(self) -> Any:
+        return _current.get() or NOOP
+
+    @contextmanager
+    def _open(self, trace_id: str, parent_id: Optional[str], name: str, attrs: Dict[str, Any]) -> Iterator[Span]:
+        sp = Span(trace_id, parent_id, name, attrs)
+        token = _current.set(sp)
+        try:
+            yield sp
+        except BaseException as e:
+            sp.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            sp.end_ns = time.time_ns()
+            try:
+                self._q.put_nowait(sp)
+            except queue.Full:
+                self.dropped += 1
+
+    def _export_loop(self) -> None:
+        while True:
+            spans = [self._q.get()]
+            deadline = time.monotonic() + self.flush_sec
+            while len(spans) < self.batch:
+                try:
+                    spans.append(self._q.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                log.warning("trace export failed (%d spans): %s", len(spans), e)
@@ -0,0 +1,111 @@
+# userctx.py — пользователь на время одного апдейта: лимит, премиум, админ, режим, профиль — вычисляются один раз
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+def _premium(rec: Dict[str, Any], now: int) -> bool:
+    # как usage_entry + has_premium: флаг гаснет после premium_until, будущий premium_until его включает
+    until = int(rec.get("premium_until", 0))
+    return until > now or (until == now and bool(rec.get("premium")))
+
+
+class UserContext:
+    """
+    Снимок записи USAGE и того, что хендлеры спрашивают по ходу апдейта. resolve() один раз делает
+    то, что раньше делал каждый usage_entry()/has_premium(): сброс счётчика в новом месяце и
+    погашение истёкшего премиума. free_limit — лимит бесплатного плана (RefData или CONFIG, решает
+    вызывающий). Изменения (charge) копятся в объекте; commit() переносит их в запись USAGE —
+    один раз, в конце апдейта.
+    """
+    __slots__ = ("uid", "month", "count", "charged", "premium", "premium_until", "free_limit", "is_admin",
+                 "user_data", "dirty")
+
+    def __init__(self, uid: int, month: int, count: int, premium: bool, premium_until: int,
+                 free_limit: int, is_admin: bool, user_data: Optional[dict], dirty: bool):
+        self.uid = uid
+        self.month, self.count = month, count
+        self.charged = 0  # списано с resolve(); в USAGE переносится приращением, не снимком count
+        self.premium, self.premium_until = premium, premium_until
+        self.free_limit = free_limit
+        self.is_admin = is_admin
+        self.user_data = user_data
+        self.dirty = dirty
+
+    @classmethod
+    def resolve(cls, uid: int, usage: Dict[int, Dict[str, Any]], free_limit: int, is_admin: bool,
+                user_data: Optional[dict] = None, now: Optional[float] = None) -> "UserContext":
+        now = int(now if now is not None else time.time())
+        month = datetime.utcfromtimestamp(now).month
+        rec = usage.get(uid)
+        if rec is None:
+            return cls(uid, month, 0, False, 0, free_limit, is_admin, user_data, dirty=True)
+        until = int(rec.get("premium_until", 0))
+        premium = _premium(rec, now)
+        count = int(rec.get("count", 0))
+        dirty = premium != bool(rec.get("premium"))
+        if rec.get("month") != month:
+            count, dirty = 0, True
+        return cls(uid, month, count, premium, until, free_limit, is_admin, user_data, dirty)
+
+    # ---- чтение ----
+    @property
+    def can_analyze(self) -> bool:
+        return self.premium or self.count < self.free_limit
+
+    @property
+    def left(self) -> int:
+        return max(0, self.free_limit - self.count)
+
+    @property
+    def mode(self) -> str:
+        return (self.user_data or {}).get("mode", "both")
+
+    @property
+    def profile(self) -> Dict[str, Any]:
+        return (self.user_data or {}).get("profile") or {}
+
+    def usage_text(self, pending: int = 0) -> str:
+        """pending — сколько попыток спишется после отправки этого текста."""
+        if self.premium:
+            exp = datetime.fromtimestamp(self.premium_until or time.time()).strftime("%d.%m.%Y")
+            return f"🌟 Премиум активен до {exp}."
+        return f"Осталось бесплатных анализов: {max(0, self.left - pending)} из {self.free_limit}."
+
+    # ---- изменение ----
+    def charge(self) -> bool:
+        """Списать попытку (премиум — без списания). False — лимит исчерпан."""
+        if self.premium:
+            return True
+        if self.count < self.free_limit:
+            self.count += 1
+            self.charged += 1
+            self.dirty = True
+            return True
+        return False
+
+    def commit(self, usage: Dict[int, Dict[str, Any]]) -> bool:
+        """
+        Перенести изменения в запись USAGE. True — запись изменилась, раздел usage надо сохранить.
+        Счётчик — приращением: две доставки одного пользователя в разных апдейтах видели один и тот же
+        count, снимок второй затёр бы списание первой.
+        """
+        if not self.dirty:
+            return False
+        rec = usage.setdefault(self.uid, {})
+        base = int(rec.get("count", 0)) if rec.get("month") == self.month else 0
+        # премиум — по записи на момент commit: начисление (оплата, промокод) после resolve() не затирается снимком
+        self.premium_until = int(rec.get("premium_until", 0))
+        self.premium = _premium(rec, int(time.time()))
+        rec["count"], rec["month"], rec["premium"] = base + self.charged, self.month, self.premium
+        self.charged = 0
+        self.dirty = False
+        return True
+
+
+class UserScope(dict):
+    """uid -> UserContext одного апдейта. Закрытая область (апдейт кончился) новых контекстов не копит."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.closed = False
@@ -0,0 +1,98 @@
+# userdir.py — справочник пользователей для админки: отсортированные индексы, курсоры, поиск
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ALL, PREMIUM, ADMIN = "all", "prem", "adm"
+
+
+class UserDirectory:
+    """
+    Индексы поддерживаются при изменениях, а не пересчитываются на каждый клик:
+      * _lists[фильтр] — отсортированные user_id (все / премиум / админы);
+      * _ids_str — те же id строками: префикс id даёт непрерывный диапазон для bisect;
+      * _by_name — (username в нижнем регистре, user_id) для поиска по началу ника.
+    Страница по курсору — bisect + срез: O(log n + размер страницы).
+    """
+
+    def __init__(self):
+        self._lists: Dict[str, List[int]] = {ALL: [], PREMIUM: [], ADMIN: []}
+        self._ids_str: List[str] = []
+        self._names: Dict[int, str] = {}
+        self._by_name: List[Tuple[str, int]] = []
+
+    # ---- изменения ----
+    def add(self, uid: int, username: Optional[str] = None) -> None:
+        ids = self._lists[ALL]
+        i = bisect_left(ids, uid)
+        if i == len(ids) or ids[i] != uid:
+            ids.insert(i, uid)
+            insort(self._ids_str, str(uid))
+        if username:
+            self.set_username(uid, username)
+
+    def set_username(self, uid: int, username: str) -> None:
+        old = self._names.get(uid)
+        if old == username:
+            return
+        if old:
+            j = bisect_left(self._by_name, (old.lower(), uid))
+            if j < len(self._by_name) and self._by_name[j] == (old.lower(), uid):
+                del self._by_name[j]
+        self._names[uid] = username
+        insort(self._by_name, (username.lower(), uid))
+
+    def set_flag(self, uid: int, flt: str, on: bool) -> None:
+        lst = self._lists[flt]
+        i = bisect_left(lst, uid)
+        present = i < len(lst) and lst[i] == uid
+        if on and not present:
+            lst.insert(i, uid)
+        elif not on and present:
+            del lst[i]
+
+    def load(self, ids: Iterable[int], names: Dict[int, str], premium: Iterable[int], admins: Iterable[int]) -> None:
+        self._lists = {ALL: sorted(set(ids)), PREMIUM: sorted(set(premium)), ADMIN: sorted(set(admins))}
+        self._ids_str = sorted(str(i) for i in self._lists[ALL])
+        self._names = {int(k): v for k, v in names.items() if v}
+        self._by_name = sorted((v.lower(), k) for k, v in self._names.items())
+
+    # ---- чтение ----
+    def username(self, uid: int) -> Optional[str]:
+        return self._names.get(uid)
+
+    def count(self, flt: str = ALL) -> int:
+        return len(self._lists[flt])
+
+    def page(self, flt: str = ALL, after: Optional[int] = None, before: Optional[int] = None,
+             size: int = 10) -> Tuple[List[int], bool, bool]:
+        """Страница id после курсора `after` (или до `before`). Возвращает (ids, есть_назад, есть_вперёд)."""
+        lst = self._lists[flt]
+        if before is not None:
+            end = bisect_left(lst, before)
+            start = max(0, end - size)
+        else:
+            start = bisect_right(lst, after) if after is not None else 0
+            end = min(len(lst), start + size)
+        return lst[start:end], start > 0, end < len(lst)
+
+    def search(self, query: str, limit: int = 10) -> List[int]:
+        """Цифры — префикс user_id, иначе — префикс username (можно с @)."""
+        q = (query or "").strip()
+        if not q:
+            return []
+        if q.isdigit():
+            i = bisect_left(self._ids_str, q)
+            out = []
+            for s in self._ids_str[i:i + limit]:
+                if not s.startswith(q):
+                    break
+                out.append(int(s))
+            return out
+        q = q.lstrip("@").lower()
+        i = bisect_left(self._by_name, (q, float("-inf")))
+        out = []
+        for name, uid in self._by_name[i:i + limit]:
+            if not name.startswith(q):
+                break
+            out.append(uid)
+        return out
@@ -0,0 +1,259 @@
+# yk.py — асинхронная ЮKassa: пул соединений httpx, приём вебхуков, идемпотентная обработка платежей
+import os, json, time, uuid, asyncio, sqlite3, logging, ipaddress
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+log = logging.getLogger("beauty-nano-bot.yk")
+
+YK_API_URL = os.getenv("YK_API_URL", "https://api.yookassa.ru/v3")
+# адреса, с которых ЮKassa шлёт уведомления (документация «Входящие уведомления»)
+YK_NOTIFY_NETWORKS = tuple(ipaddress.ip_network(n) for n in (
+    "185.71.76.0/27", "185.71.77.0/27", "77.75.153.0/25", "77.75.156.11/32", "77.75.156.35/32",
+    "77.75.154.128/25", "2a02:5180::/32"))
+
+
+def is_yookassa_ip(addr: Optional[str]) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr or "")
+    except ValueError:
+        return False
+    return any(ip in net for net in YK_NOTIFY_NETWORKS)
+
+
+class YooKassaError(RuntimeError):
+    def __init__(self, message: str, status: int = 0):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def rejected(self) -> bool:
+        """4xx, кроме 429: запрос не пройдёт и при повторе (платежа нет, id чужой)."""
+        return 400 <= self.status < 500 and self.status != 429
+
+
+class YooKassaClient:
+    """Тонкий клиент REST API ЮKassa поверх одного httpx.AsyncClient (keep-alive, пул)."""
+
+    def __init__(self, shop_id: str, secret_key: str, base_url: str = YK_API_URL,
+                 timeout: float = 15.0, max_connections: int = 10):
+        self._client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            auth=(shop_id, secret_key),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def _request(self, method: str, path: str, body: Optional[dict] = None,
+                       idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        headers = {"Idempotence-Key": idempotency_key} if idempotency_key else None
+        r = await self._client.request(method, path, json=body, headers=headers)
+        if r.status_code >= 400:
+            raise YooKassaError(f"{method} {path}: HTTP {r.status_code} {r.text[:300]}", r.status_code)
+        return r.json()
+
+    async def create_payment(self, user_id: int, amount_rub: int, return_url: str,
+                             idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Первый платёж с сохранением карты (для автопродления). Возвращает объект платежа."""
+        return await self._request("POST", "/payments", {
+            "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
+            "capture": True,
+            "confirmation": {"type": "redirect", "return_url": return_url},
+            "save_payment_method": True,
+            "description": f"Beauty Nano Premium 30d (uid {user_id})",
+            "metadata": {"user_id": str(user_id), "purpose": "premium_monthly", "first": "1"},
+        }, idempotency_key or str(uuid.uuid4()))
+
+    async def create_recurring_payment(self, user_id: int, amount_rub: int, payment_method_id: str,
+                                       idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Автосписание по сохранённому способу оплаты."""
+        return await self._request("POST", "/payments", {
+            "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
+            "capture": True,
+            "payment_method_id": payment_method_id,
+            "description": f"Beauty Nano Premium 30d renew (uid {user_id})",
+            "metadata": {"user_id": str(user_id), "purpose": "premium_monthly", "first": "0"},
+        }, idempotency_key or str(uuid.uuid4()))
+
+    async def get_payment(self, payment_id: str) -> Dict[str, Any]:
+        return await self._request("GET", f"/payments/{payment_id}")
+
+
+# ---------- журнал платежей (идемпотентность) ----------
+class PaymentLedger:
+    """
+    SQLite-таблица, ключ — payment_id. Вебхук только кладёт строку 'pending' (INSERT OR IGNORE),
+    воркер переводит её в 'done'/'skipped'. Повторный вебхук того же платежа ничего не делает.
+    Сбой чтения платежа или начисления оставляет строку 'pending' (attempts + 1); после max_attempts — 'failed'.
+    Каждый вызов открывает своё соединение — можно звать из потока Flask и из to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._conn() as c:
+            c.execute("""CREATE TABLE IF NOT EXISTS yk_payments (
+                payment_id   TEXT PRIMARY KEY,
+                user_id      INTEGER,
+                event        TEXT,
+                status       TEXT NOT NULL,
+                payload      TEXT,
+                received_at  INTEGER,
+                processed_at INTEGER,
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                error        TEXT
+            )""")
+            cols = {r[1] for r in c.execute("PRAGMA table_info(yk_payments)")}
+            if "attempts" not in cols:
+                c.execute("ALTER TABLE yk_payments ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            if "error" not in cols:
+                c.execute("ALTER TABLE yk_payments ADD COLUMN error TEXT")
+            c.execute("CREATE INDEX IF NOT EXISTS yk_payments_status ON yk_payments(status)")
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, event: str, obj: Dict[str, Any]) -> bool:
+        """True — платёж новый и поставлен в очередь."""
+        pid = str(obj.get("id") or "")
+        if not pid:
+            return False
+        try:
+            uid = int((obj.get("metadata") or {}).get("user_id") or 0)
+        except (TypeError, ValueError):
+            uid = 0
+        with self._conn() as c:
+            cur = c.execute(
+                "INSERT OR IGNORE INTO yk_payments(payment_id, user_id, event, status, payload, received_at) "
+                "VALUES (?, ?, ?, 'pending', ?, ?)",
+                (pid, uid, event, json.dumps(obj, ensure_ascii=False), int(time.time())))
+            return cur.rowcount == 1
+
+    def pending(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._conn() as c:
+            rows = c.execute("SELECT payment_id, user_id, event FROM yk_payments WHERE status='pending' "
+                             "ORDER BY received_at LIMIT ?", (limit,)).fetchall()
+        return [{"payment_id": r[0], "user_id": r[1], "event": r[2]} for r in rows]
+
+    def mark(self, payment_id: str, status: str) -> None:
+        with self._conn() as c:
+            c.execute("UPDATE yk_payments SET status=?, processed_at=? WHERE payment_id=?",
+                      (status, int(time.time()), payment_id))
+
+    def retry(self, payment_id: str, error: str, max_attempts: int) -> bool:
+        """Обработка не прошла: True — остаётся pending для повтора, False — попытки кончились, теперь failed."""
+        with self._conn() as c:
+            c.execute("UPDATE yk_payments SET attempts=attempts+1, error=?, processed_at=?, "
+                      "status=CASE WHEN attempts+1>=? THEN 'failed' ELSE 'pending' END WHERE payment_id=?",
+                      (error[:500], int(time.time()), max_attempts, payment_id))
+            row = c.execute("SELECT status FROM yk_payments WHERE payment_id=?", (payment_id,)).fetchone()
+        return bool(row) and row[0] == "pending"
+
+    def failed(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Оплаченные, но не начисленные — для админки и ручного разбора."""
+        with self._conn() as c:
+            rows = c.execute("SELECT payment_id, user_id, attempts, error, processed_at FROM yk_payments "
+                             "WHERE status='failed' ORDER BY processed_at DESC LIMIT ?", (limit,)).fetchall()
+        return [{"payment_id": r[0], "user_id": r[1], "attempts": r[2], "error": r[3], "processed_at": r[4]}
+                for r in rows]
+
+
+# ---------- воркер ----------
+class PaymentWorker:
+    """
+    Разбирает 'pending' из PaymentLedger. Данные вебхука не считаются доверенными:
+    платёж перечитывается через API, и только status == succeeded приводит к on_succeeded(payment).
+    id, который API отвергает (404 и прочие 4xx — поддельное или чужое уведомление), — 'skipped' сразу;
+    прочие ошибки чтения повторяются, как и сбои начисления, иначе такие строки вечно стояли бы
+    первыми в pending() и не пускали настоящие платежи.
+    Упавший on_succeeded повторяется каждые retry_sec, до max_attempts раз; потом строка 'failed'
+    и on_failed(payment, error) — деньги списаны, премиума нет, нужен человек.
+    """
+
+    def __init__(self, client: YooKassaClient, ledger: PaymentLedger,
+                 on_succeeded: Callable[[Dict[str, Any]], Awaitable[None]], retry_sec: float = 30.0,
+                 max_attempts: int = 5,
+                 on_failed: Optional[Callable[[Dict[str, Any], str], Awaitable[None]]] = None):
+        self.client = client
+        self.ledger = ledger
+        self.on_succeeded = on_succeeded
+        self.retry_sec = retry_sec
+        self.max_attempts = max_attempts
+        self.on_failed = on_failed
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._wake.set()  # разобрать то, что осталось с прошлого запуска
+        self._task = asyncio.create_task(self._run(), name="yk-worker")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+
+    def notify(self) -> None:
+        """Можно звать из любого потока (вебхук Flask)."""
+        if self._loop and self._wake:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.retry_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                for row in await asyncio.to_thread(self.ledger.pending):
+                    await self._process(row["payment_id"])
+            except Exception:
+                log.exception("yk worker iteration failed")
+
+    async def _process(self, payment_id: str) -> None:
+        try:
+            payment = await self.client.get_payment(payment_id)
+        except YooKassaError as e:
+            if e.rejected:
+                log.warning("yk get_payment %s rejected, skipping: %s", payment_id, e)
+                await asyncio.to_thread(self.ledger.mark, payment_id, "skipped")
+                return
+            await self._retry_read(payment_id, e)
+            return
+        except Exception as e:
+            await self._retry_read(payment_id, e)
+            return
+        status = payment.get("status")
+        if status == "pending" or status == "waiting_for_capture":
+            return  # придёт следующий вебхук / повторим по таймеру
+        if status != "succeeded" or not payment.get("paid", True):
+            await asyncio.to_thread(self.ledger.mark, payment_id, "skipped")
+            return
+        try:
+            await self.on_succeeded(payment)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if await asyncio.to_thread(self.ledger.retry, payment_id, error, self.max_attempts):
+                log.exception("yk on_succeeded %s failed, retry later", payment_id)
+                return
+            log.exception("yk on_succeeded %s failed, giving up after %d attempts", payment_id, self.max_attempts)
+            if self.on_failed:
+                try:
+                    await self.on_failed(payment, error)
+                except Exception:
+                    log.exception("yk on_failed %s", payment_id)
+            return
+        await asyncio.to_thread(self.ledger.mark, payment_id, "done")
+
+    async def _retry_read(self, payment_id: str, e: Exception) -> None:
+        if await asyncio.to_thread(self.ledger.retry, payment_id, f"get_payment: {type(e).__name__}: {e}",
+                                   self.max_attempts):
+            log.warning("yk get_payment %s failed, retry later: %s", payment_id, e)
+        else:
+            log.error("yk get_payment %s failed, giving up after %d attempts: %s", payment_id, self.max_attempts, e)